@@ -24,7 +24,11 @@ CREATE TABLE battle_log (
     loser_pot_moves INT NOT NULL,
     loser_moves INT NOT NULL,
     moves INT NOT NULL,
-    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Starting board and moves of the game in the binary replay format of encode_replay
+    replay BLOB,
+    winner_id INT REFERENCES ai_bots(id),
+    loser_id INT REFERENCES ai_bots(id)
 );
 
 END;
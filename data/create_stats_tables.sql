@@ -0,0 +1,34 @@
+BEGIN IMMEDIATE;
+
+-- Create table to store the battle results of every bot summed by day, updated with every batch of
+-- battle results written to battle_log. The moves are the bot's own ones, game_moves the ones of both players
+CREATE TABLE IF NOT EXISTS bot_stats (
+    bot_id INT NOT NULL REFERENCES ai_bots(id),
+    day DATE NOT NULL,
+    games INT NOT NULL DEFAULT 0,
+    wins INT NOT NULL DEFAULT 0,
+    soldiers INT NOT NULL DEFAULT 0,
+    tanks INT NOT NULL DEFAULT 0,
+    pot_moves INT NOT NULL DEFAULT 0,
+    moves INT NOT NULL DEFAULT 0,
+    game_moves INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (bot_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS bot_stats_day ON bot_stats (day, bot_id);
+CREATE INDEX IF NOT EXISTS battle_log_winner ON battle_log (winner_id, created_at);
+CREATE INDEX IF NOT EXISTS battle_log_loser ON battle_log (loser_id, created_at);
+
+-- Sum the battles logged before the bot_stats table existed
+INSERT INTO bot_stats (bot_id, day, games, wins, soldiers, tanks, pot_moves, moves, game_moves)
+SELECT bot_id, day, COUNT(*), SUM(won), SUM(soldiers), SUM(tanks), SUM(pot_moves), SUM(bot_moves), SUM(moves)
+FROM (SELECT winner_id AS bot_id, date(created_at) AS day, 1 AS won, winner_soldiers AS soldiers,
+             winner_tanks AS tanks, winner_pot_moves AS pot_moves, winner_moves AS bot_moves, moves
+      FROM battle_log WHERE winner_id IS NOT NULL
+      UNION ALL
+      SELECT loser_id, date(created_at), 0, loser_soldiers, loser_tanks, loser_pot_moves, loser_moves, moves
+      FROM battle_log WHERE loser_id IS NOT NULL)
+WHERE NOT EXISTS (SELECT 1 FROM bot_stats)
+GROUP BY bot_id, day;
+
+COMMIT;
@@ -0,0 +1,35 @@
+BEGIN;
+
+-- Create table to store the round-robin tournaments between the Soviet and German AI bots
+CREATE TABLE IF NOT EXISTS tournament (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    games_per_pairing INT NOT NULL CHECK (games_per_pairing > 0),
+    seed INT,
+    finished INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create table to store the finished batches of games of every pairing, a tournament is resumed
+-- by playing the batches missing from this table
+CREATE TABLE IF NOT EXISTS tournament_match (
+    tournament_id INT NOT NULL REFERENCES tournament(id),
+    p1_id INT NOT NULL REFERENCES ai_bots(id),
+    p2_id INT NOT NULL REFERENCES ai_bots(id),
+    first_game INT NOT NULL,
+    games INT NOT NULL,
+    p1_wins INT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tournament_id, p1_id, p2_id, first_game)
+);
+
+-- Create table to store the Elo rating of every bot, updated after every finished batch
+CREATE TABLE IF NOT EXISTS tournament_standings (
+    tournament_id INT NOT NULL REFERENCES tournament(id),
+    bot_id INT NOT NULL REFERENCES ai_bots(id),
+    rating REAL NOT NULL,
+    games INT NOT NULL DEFAULT 0,
+    wins INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (tournament_id, bot_id)
+);
+
+END;
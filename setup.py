@@ -37,5 +37,7 @@ setup(
     license='',
     author='Alex Forascu',
     author_email='alexforascu@gmail.com',
-    description=''
+    description='',
+    # NumPy is only needed by the batch simulator, tictank_batch.py
+    extras_require={'batch': ['numpy']}
 )
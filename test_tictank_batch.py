@@ -0,0 +1,77 @@
+import random
+import unittest
+
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_batch import BOARD_CELLS, np, play_batch
+from tictank_game_logic import GAME, STARTING_BOARDS, get_starting_board
+
+# Games played by every test, for each starting board
+GAMES = 1000
+# Largest differences allowed between the batch games and the games of GAME played by the same kind of bots,
+# about 4 standard errors of the two samples
+MAX_WIN_RATE_DIFFERENCE = 0.09
+MAX_MOVES_DIFFERENCE = 1.5
+
+# iq of the random and the greedy bots
+DEPTH_IQ = {0: 80, 1: 100}
+
+
+def new_bots(depths):
+    return (AIBot(player_id='P1', marker=TANK_P1, opponentmarker=TANK_P2, name='P1', iq=DEPTH_IQ[depths[0]]),
+            AIBot(player_id='P2', marker=TANK_P2, opponentmarker=TANK_P1, name='P2', iq=DEPTH_IQ[depths[1]]))
+
+
+def play(starting_board, bots, first, rng=random):
+    """ Play a game of GAME, bot ``first`` moving first, and return it in the format of play_batch
+        :return: (index of the winning bot, moves, soldiers and tanks deployed by each bot)
+    """
+    game = GAME(starting_board, bots[first], bots[1 - first], rng)
+    for _ in game.play_moves():
+        pass
+    return (0 if game.winner == bots[0].marker else 1,
+            len(game.move_history),
+            [game.soldiers_deployed[bot.marker] for bot in bots],
+            [game.tanks_deployed[bot.marker] for bot in bots])
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class PlayBatchTest(unittest.TestCase):
+    """ The batch games follow the rules and the move choices of the bots of GAME
+    """
+
+    def test_greedy_games(self):
+        # the greedy bots never draw a random number, the batch games are the games of the same boards
+        depths = (1, 1)
+        for board_id in sorted(STARTING_BOARDS):
+            results = play_batch(GAMES, depths, board_id, np.random.RandomState(board_id))
+            # the starting boards and the first players drawn by play_batch
+            random_state = np.random.RandomState(board_id)
+            order = random_state.random_sample((GAMES, BOARD_CELLS)).argsort(axis=1)
+            first = random_state.randint(0, 2, size=GAMES)
+            self.assertEqual(results['first'].tolist(), first.tolist())
+            for game in range(GAMES):
+                starting_board = [STARTING_BOARDS[board_id][i] for i in order[game]]
+                self.assertEqual(play(starting_board, new_bots(depths), first[game]),
+                                 (results['winner'][game], results['moves'][game],
+                                  results['soldiers'][game].tolist(), results['tanks'][game].tolist()))
+
+    def test_random_games(self):
+        # the random choices differ, the results have the same distribution
+        rng = random.Random(6)
+        for depths in ((0, 0), (1, 0)):
+            for board_id in sorted(STARTING_BOARDS):
+                results = play_batch(GAMES, depths, board_id, np.random.RandomState(board_id))
+                self.assertEqual((results['soldiers'].sum(axis=1) + results['tanks'].sum(axis=1)).tolist(),
+                                 results['moves'].tolist())
+                first = [rng.randint(0, 1) for _ in range(GAMES)]
+                games = [play(get_starting_board(board_id, rng), new_bots(depths), bot, rng) for bot in first]
+                winner = np.array([game[0] for game in games])
+                self.assertLess(abs(results['winner'].mean() - winner.mean()), MAX_WIN_RATE_DIFFERENCE)
+                self.assertLess(abs((results['winner'] == results['first']).mean() - (winner == first).mean()),
+                                MAX_WIN_RATE_DIFFERENCE)
+                self.assertLess(abs(results['moves'].mean() - np.mean([game[1] for game in games])),
+                                MAX_MOVES_DIFFERENCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_game_logic import MOVES_LIST_ENTRY, REPLAY_GEOMETRY_VERSION, REPLAY_VERSION, STARTING_BOARDS, \
+    encode_replay, format_moves_list, get_geometry, replay_board_bytes, start_game
+from tictank_replay import decode_replay, read_replay
+
+# Seeded games played on each starting board of the tic tac toe battlefield and of the larger ones
+GAMES = 100
+LARGE_GAMES = 10
+# (size, win length) of the larger battlefields
+LARGE_GEOMETRIES = ((4, 3), (5, 4), (7, 4))
+
+
+def new_bots():
+    return (AIBot(player_id='P1', marker=TANK_P1, opponentmarker=TANK_P2, name='P1', iq=0),
+            AIBot(player_id='P2', marker=TANK_P2, opponentmarker=TANK_P1, name='P2', iq=0))
+
+
+def played_games(games, geometry):
+    """ Return finished seeded games of random bots on every starting board
+    """
+    played = []
+    for board_id in sorted(STARTING_BOARDS):
+        for seed in range(games):
+            p1, p2 = new_bots()
+            game, _ = start_game(p1, p2, board_id=board_id, seed=seed, geometry=geometry)
+            for _ in game.play_moves():
+                pass
+            played.append(game)
+    return played
+
+
+class ReplayTest(unittest.TestCase):
+    """ Replays give back the games of GAME with their move history
+    """
+
+    def assertReplay(self, game, version):
+        data = game.replay()
+        self.assertEqual(bytearray(data)[0] >> 2, version)
+        geometry, first_is_p2, first_player_won, starting_board, positions = read_replay(data)
+        self.assertIs(geometry, game.geometry)
+        self.assertEqual(first_is_p2, game.p1.player_id == 'P2')
+        self.assertEqual(starting_board, game.starting_board)
+        self.assertEqual(positions, [pos for _, pos, _, _ in game.move_history])
+
+        replay = decode_replay(data)
+        self.assertEqual((replay['board_size'], replay['win_length']), (geometry.size, geometry.win_length))
+        self.assertEqual(replay['first_player'], game.p1.player_id)
+        self.assertEqual(replay['first_player_won'], game.winner == game.p1.marker)
+        self.assertEqual(replay['moves'], game.move_history)
+        self.assertEqual(replay['ending_board'], game.board)
+        return data
+
+    def test_version_1(self):
+        for game in played_games(GAMES, get_geometry()):
+            data = self.assertReplay(game, REPLAY_VERSION)
+            # two moves per byte after the starting board
+            self.assertEqual(len(data), 1 + replay_board_bytes(9) + (len(game.move_history) + 1) // 2)
+
+    def test_version_2(self):
+        for size, win_length in LARGE_GEOMETRIES:
+            geometry = get_geometry(size, win_length)
+            for game in played_games(LARGE_GAMES, geometry):
+                data = self.assertReplay(game, REPLAY_GEOMETRY_VERSION)
+                self.assertEqual(len(data), 2 + replay_board_bytes(geometry.cells) + len(game.move_history))
+
+    def test_moves_list(self):
+        # the replays of the battle results written before are encoded from their moves_list
+        for game in played_games(GAMES, get_geometry()):
+            moves_list = format_moves_list(game.move_history)
+            moves = [(player_id, int(pos), int(value), int(marker))
+                     for player_id, pos, value, marker in MOVES_LIST_ENTRY.findall(moves_list)]
+            self.assertEqual(moves, game.move_history)
+            self.assertEqual(encode_replay(game.starting_board, moves, game.winner == game.p1.marker), game.replay())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import random
+import unittest
+
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_game_logic import GAME, MAX_MOVES, STARTING_BOARDS, get_starting_board
+from tictank_search import AlphaBetaSearch, TranspositionTable
+from tictank_state import BoardState
+
+# Positions searched by every test and the deepest full width minimax they are compared with
+POSITIONS = 40
+MAX_DEPTH = 4
+
+
+def new_bots():
+    return (AIBot(player_id='P1', marker=TANK_P1, opponentmarker=TANK_P2, name='P1', iq=200),
+            AIBot(player_id='P2', marker=TANK_P2, opponentmarker=TANK_P1, name='P2', iq=200))
+
+
+def random_positions(count, seed):
+    """ Return games of random starting boards played for a random number of random moves,
+    none of them is over
+    """
+    rng = random.Random(seed)
+    games = []
+    while len(games) < count:
+        p1, p2 = new_bots()
+        game = GAME(get_starting_board(rng.choice(sorted(STARTING_BOARDS)), rng), p1, p2, rng)
+        for ply in range(rng.randint(0, 24)):
+            player = p1 if ply // MAX_MOVES % 2 == 0 else p2
+            game.move(player.player_id, player.marker, rng.choice(game.get_available_moves()))
+            if game.is_gameover():
+                break
+        if not game.is_gameover():
+            games.append(game)
+    return games
+
+
+class AlphaBetaSearchTest(unittest.TestCase):
+    """ The alpha-beta search chooses the moves of the full width AIBot.minimax
+    """
+
+    def setUp(self):
+        self.games = random_positions(POSITIONS, seed=1)
+
+    def test_best_move(self):
+        for game in self.games:
+            board = list(game.board)
+            for depth in range(1, MAX_DEPTH + 1):
+                search = AlphaBetaSearch(game.p1.marker, game.p1.opponentmarker, table=TranspositionTable())
+                self.assertEqual(search.best_move(game, depth), game.p1.minimax(game, depth))
+                self.assertEqual(game.board, board)
+
+    def test_shared_table(self):
+        # the entries left by the searches of other positions and depths never change a move
+        search = AlphaBetaSearch(TANK_P1, TANK_P2, table=TranspositionTable())
+        for depth in range(1, MAX_DEPTH + 1):
+            for game in self.games:
+                self.assertEqual(search.best_move(game, depth), game.p1.minimax(game, depth))
+
+    def test_node_budget(self):
+        # iterative deepening that finishes its full depth plays the move of the full depth search
+        for game in self.games:
+            search = AlphaBetaSearch(TANK_P1, TANK_P2, table=TranspositionTable())
+            move = search.best_move(game, MAX_DEPTH, node_budget=10 ** 6)
+            self.assertEqual(search.depth_reached, MAX_DEPTH)
+            self.assertEqual(move, game.p1.minimax(game, MAX_DEPTH))
+
+    def test_value(self):
+        # the score of a level below the root is the exact minimax score of the level
+        search = AlphaBetaSearch(TANK_P1, TANK_P2, table=TranspositionTable())
+        for game in self.games:
+            for pos in game.get_available_moves():
+                game.move('P1', TANK_P1, pos)
+                for depth in range(MAX_DEPTH):
+                    self.assertEqual(search.value(BoardState.from_game(game), depth, False),
+                                     game.p1.min_value(game, depth))
+                    self.assertEqual(search.value(BoardState.from_game(game), depth, True),
+                                     game.p1.max_value(game, depth))
+                game.revert_last_move()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import random
+import unittest
+
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_game_logic import GAME, MAX_MOVES, STARTING_BOARDS, get_starting_board
+from tictank_state import BoardState
+
+# Random games played on each starting board
+GAMES = 200
+
+
+class BoardStateTest(unittest.TestCase):
+    """ BoardState follows the board, the moves and the winner of GAME
+    """
+
+    def assertSameState(self, state, game):
+        self.assertEqual(state.to_board(), game.board)
+        self.assertEqual(list(state.available_moves()), game.get_available_moves())
+        self.assertEqual(state.winner(), game.winner if game.is_gameover() else None)
+        self.assertEqual(BoardState(game.board, TANK_P1, TANK_P2).cells, state.cells)
+
+    def test_random_games(self):
+        rng = random.Random(2)
+        p1 = AIBot(player_id='P1', marker=TANK_P1, opponentmarker=TANK_P2, name='P1', iq=0)
+        p2 = AIBot(player_id='P2', marker=TANK_P2, opponentmarker=TANK_P1, name='P2', iq=0)
+        for board_id in sorted(STARTING_BOARDS):
+            for _ in range(GAMES):
+                game = GAME(get_starting_board(board_id, rng), p1, p2, rng)
+                state = BoardState.from_game(game)
+                self.assertSameState(state, game)
+                boards = [list(game.board)]
+                positions = []
+                while not game.is_gameover():
+                    player = p1 if len(positions) // MAX_MOVES % 2 == 0 else p2
+                    pos = rng.choice(game.get_available_moves())
+                    game.move(player.player_id, player.marker, pos)
+                    state.make_move(pos, player.marker)
+                    positions.append(pos)
+                    boards.append(list(game.board))
+                    self.assertSameState(state, game)
+                # taking the moves back goes through the same boards
+                for pos in reversed(positions):
+                    boards.pop()
+                    state.unmake_move(pos)
+                    self.assertEqual(state.to_board(), boards[-1])
+                    self.assertEqual(state.winner(), None)
+                self.assertEqual(state.cells, BoardState(boards[0], TANK_P1, TANK_P2).cells)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_game_logic import GAME, MAX_MOVES, PLAY_TILES, STARTING_BOARDS, get_starting_board
+from tictank_state import BOARD_CELLS, CELL_BITS, CELL_MASK
+from tictank_tablebase import BOARD_BITS, MY_TANK, SYMMETRIES, THEIR_TANK, UNKNOWN, WIN_FLAG, Tablebase, \
+    TablebaseBuilder, canonical, encode_board, swap_sides
+
+# Positions solved by the tests, with at most this many troop deployments left until every cell holds a tank
+POSITIONS = 30
+MAX_DEPLOYMENTS = 8
+
+
+def new_bots():
+    return (AIBot(player_id='P1', marker=TANK_P1, opponentmarker=TANK_P2, name='P1', iq=0),
+            AIBot(player_id='P2', marker=TANK_P2, opponentmarker=TANK_P1, name='P2', iq=0))
+
+
+def deployments_left(board):
+    return sum(PLAY_TILES[-1] + 1 - value for value in board if value in PLAY_TILES)
+
+
+def late_positions(count, seed):
+    """ Return (game, player to move, opponent, moves left in the turn) of random games close to their end
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        p1, p2 = new_bots()
+        game = GAME(get_starting_board(rng.choice(sorted(STARTING_BOARDS)), rng), p1, p2, rng)
+        ply = 0
+        while not game.is_gameover() and deployments_left(game.board) > MAX_DEPLOYMENTS:
+            player = p1 if ply // MAX_MOVES % 2 == 0 else p2
+            game.move(player.player_id, player.marker, rng.choice(game.get_available_moves()))
+            ply += 1
+        if not game.is_gameover():
+            player, opponent = (p1, p2) if ply // MAX_MOVES % 2 == 0 else (p2, p1)
+            positions.append((game, player, opponent, MAX_MOVES - ply % MAX_MOVES))
+    return positions
+
+
+def symmetric_cells(cells, symmetry, swap_tanks=False):
+    """ Return the packed board moved by one of SYMMETRIES, with the tanks of the two players swapped
+    """
+    moved = 0
+    for pos in range(BOARD_CELLS):
+        code = (cells >> (pos * CELL_BITS)) & CELL_MASK
+        if swap_tanks and code in (MY_TANK, THEIR_TANK):
+            code = MY_TANK + THEIR_TANK - code
+        moved |= code << (symmetry[pos] * CELL_BITS)
+    return moved
+
+
+def position_key(game, player, opponent, moves_left):
+    """ Return the tablebase key of a GAME position with ``player`` to move
+    """
+    return canonical(encode_board(game.board, player.marker, opponent.marker)) | ((moves_left - 1) << BOARD_BITS)
+
+
+def solve(game, player, opponent, moves_left, keys):
+    """ Return the table entry of the position from the point of view of ``player`` by playing every move
+    on the GAME, the keys of the positions and their entries are added to ``keys``
+    """
+    if game.is_gameover():
+        entry = WIN_FLAG if game.winner == player.marker else 0
+    else:
+        wins = []
+        losses = []
+        for pos in game.get_available_moves():
+            game.move(player.player_id, player.marker, pos)
+            if moves_left > 1:
+                child = solve(game, player, opponent, moves_left - 1, keys)
+            else:
+                child = solve(game, opponent, player, MAX_MOVES, keys) ^ WIN_FLAG
+            game.revert_last_move()
+            (wins if child & WIN_FLAG else losses).append(child & ~WIN_FLAG)
+        # the winner takes the shortest way to the end of the battle, the loser the longest one
+        entry = WIN_FLAG | min(wins) + 1 if wins else max(losses) + 1
+    keys[position_key(game, player, opponent, moves_left)] = entry
+    return entry
+
+
+class CanonicalTest(unittest.TestCase):
+    """ The canonical key is shared by the rotations and reflections of a position
+    """
+
+    def test_symmetries(self):
+        for game, player, opponent, _ in late_positions(POSITIONS, seed=3):
+            cells = encode_board(game.board, player.marker, opponent.marker)
+            boards = [symmetric_cells(cells, symmetry) for symmetry in SYMMETRIES]
+            self.assertEqual(canonical(cells), min(boards))
+            for board in boards:
+                self.assertEqual(canonical(board), canonical(cells))
+
+    def test_swap_sides(self):
+        for game, player, opponent, _ in late_positions(POSITIONS, seed=4):
+            cells = encode_board(game.board, player.marker, opponent.marker)
+            self.assertEqual(swap_sides(cells), encode_board(game.board, opponent.marker, player.marker))
+            self.assertEqual(swap_sides(cells), symmetric_cells(cells, SYMMETRIES[0], swap_tanks=True))
+            self.assertEqual(swap_sides(swap_sides(cells)), cells)
+
+
+class TablebaseTest(unittest.TestCase):
+    """ The solved entries and the perfect play moves are the ones of a full search of GAME
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.positions = late_positions(POSITIONS, seed=5)
+        cls.keys = {}
+        cls.entries = []
+        builder = TablebaseBuilder()
+        for game, player, opponent, moves_left in cls.positions:
+            cells = encode_board(game.board, player.marker, opponent.marker)
+            cls.entries.append((builder.solve(cells, moves_left), solve(game, player, opponent, moves_left, cls.keys)))
+        cls.solved = builder.positions
+        cls.builder_entries = dict((key, builder.table[key]) for key in cls.keys)
+        cls.path = os.path.join(cls.directory, 'test.tb')
+        builder.save(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_builder(self):
+        for builder_entry, entry in self.entries:
+            self.assertEqual(builder_entry, entry)
+        self.assertEqual(self.solved, len(self.keys))
+        self.assertEqual(self.builder_entries, self.keys)
+
+    def test_saved_table(self):
+        tablebase = Tablebase(self.path)
+        try:
+            for key, entry in self.keys.items():
+                self.assertEqual(tablebase.find(key), entry)
+                # the neighbouring keys are mostly missing, the bitmap tells them apart
+                for other in (key - 1, key + 1, key ^ 1 << 12):
+                    self.assertEqual(tablebase.find(other), self.keys.get(other, UNKNOWN))
+            # the perfect play move leads to the position one deployment closer to the best end of the battle
+            for (game, player, opponent, moves_left), (_, best) in zip(self.positions, self.entries):
+                pos = tablebase.best_move(game.board, player.marker, opponent.marker, moves_left)
+                game.move(player.player_id, player.marker, pos)
+                if moves_left > 1:
+                    entry = self.keys[position_key(game, player, opponent, moves_left - 1)]
+                else:
+                    entry = self.keys[position_key(game, opponent, player, MAX_MOVES)] ^ WIN_FLAG
+                game.revert_last_move()
+                self.assertEqual(entry & WIN_FLAG, best & WIN_FLAG)
+                self.assertEqual(entry & ~WIN_FLAG, (best & ~WIN_FLAG) - 1)
+        finally:
+            tablebase.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
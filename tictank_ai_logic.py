@@ -1,20 +1,39 @@
-from random import shuffle
+import time
+
 from tictank_db import get_bots, get_random_bots
+from tictank_metrics import METRICS
+from tictank_parallel import PARALLEL_SEARCH_MIN_DEPTH, get_search_pool
+from tictank_search import AlphaBetaSearch, TranspositionTable
+from tictank_tablebase import get_tablebase
 
 # markers for player's tanks
 TANK_P1 = 7
 TANK_P2 = 8
 
+# thinking_depth of the bots that play perfectly when the tablebase is loaded
+PERFECT_PLAY_DEPTH = 6
+
+# Nodes the bots may search for a move by thinking_depth, so no position makes their moves slow. The deepest
+# search level finished within the budget decides the move. The full depth of the positions of the starting
+# boards and of the games played from them took at most 6173 and 44211 nodes, the budgets are above them
+# so the bots keep their thinking_depth, the budgets only bound the cost of a position costlier than those.
+MOVE_NODE_BUDGETS = {5: 10000, 6: 60000}
+# Seconds the bots may think per move on the battlefields other than tic tac toe, where every searched
+# level multiplies the nodes by the number of cells, so the moves take the same time whatever the size
+LARGE_BOARD_MOVE_TIME = 0.05
+
 
-def get_ai_players(p1_id=None, p2_id=None):
+def get_ai_players(p1_id=None, p2_id=None, move_time=None, rng=None):
     """ Return two AIBot instances based on their ids
     If the player ids are not provided return random AI players
         :param p1_id: Player 1's id
         :param p2_id: Player 2's id
+        :param move_time: optional number of seconds the bots may think per move
+        :param rng: optional random number generator of the game choosing the random AI players
         :return: Two AIBot instances
     """
     if p1_id is None and p2_id is None:
-        p1, p2 = get_random_bots()
+        p1, p2 = get_random_bots(rng)
     else:
         p1, p2 = get_bots(p1_id, p2_id)
 
@@ -22,12 +41,14 @@ def get_ai_players(p1_id=None, p2_id=None):
                     opponentmarker=TANK_P2,
                     name=p1[0],
                     iq=p1[1],
-                    player_id='P1')
+                    player_id='P1',
+                    move_time=move_time)
     player2 = AIBot(marker=TANK_P2,
                     opponentmarker=TANK_P1,
                     name=p2[0],
                     iq=p2[1],
-                    player_id='P2')
+                    player_id='P2',
+                    move_time=move_time)
     return player1, player2
 
 
@@ -35,13 +56,20 @@ class AIBot:
     """ Class for the Computer Player
     """
 
-    def __init__(self, player_id, marker, opponentmarker, name, iq):
+    def __init__(self, player_id, marker, opponentmarker, name, iq, move_time=None, evaluator=None):
         self.player_id = player_id
         self.marker = marker
         self.opponentmarker = opponentmarker
         self.name = name
         self.iq = iq
         self.thinking_depth = self.get_thinking_depth(iq)
+        self.move_time = move_time
+        self.move_nodes = MOVE_NODE_BUDGETS.get(self.thinking_depth)
+        # name of the evaluator of tictank_evaluation scoring the searched positions, None for the default one
+        self.evaluator = evaluator
+        self.search = AlphaBetaSearch(marker=marker, opponentmarker=opponentmarker, evaluator=evaluator)
+        # nodes expanded for the bot by the parallel search
+        self.parallel_nodes = 0
 
     @staticmethod
     def get_thinking_depth(iq):
@@ -72,27 +100,101 @@ class AIBot:
         """ Perform a troop or tank deployment on the board based on
         the bot iq level
         """
-
-        if self.thinking_depth == 0:
-            move_position = self.random_move(gameinstance)
-        else:
-            move_position = self.minimax(gameinstance, self.thinking_depth)
+        weight = METRICS.sample()
+        if weight:
+            started = time.time()
+            nodes = self.nodes_searched
+
+        move_position = None
+        depth_reached = self.thinking_depth
+        classic = gameinstance.geometry.classic
+        move_time = self.move_time
+        if move_time is None and not classic:
+            move_time = LARGE_BOARD_MOVE_TIME
+        if self.thinking_depth == PERFECT_PLAY_DEPTH and classic and get_tablebase() is not None:
+            # solved positions are looked up instead of searched
+            move_position = self.perfect_move(gameinstance)
+        if move_position is None:
+            if self.thinking_depth == 0:
+                move_position = self.random_move(gameinstance)
+            else:
+                if classic:
+                    move_position = self.parallel_move(gameinstance)
+                if move_position is None:
+                    if self.move_nodes is not None and self.search.own_table is None:
+                        # the depth a node budget reaches depends on the table hits, so the bots with one search
+                        # with a table of their own game and a seeded game plays the same moves whatever the
+                        # process played before. It is created by the first search, the bots of the sessions
+                        # are built again for every request and most of them do not search.
+                        self.search.use_table(TranspositionTable())
+                    move_position = self.search.best_move(gameinstance, self.thinking_depth,
+                                                          time_budget=move_time,
+                                                          node_budget=self.move_nodes)
+                    depth_reached = self.search.depth_reached
+                    # the searched troop deployments count as potential moves, like the ones tried by minimax
+                    gameinstance.potential_moves[self.marker] += self.search.nodes
         gameinstance.move(self.player_id, self.marker, move_position)
+        if weight:
+            self.record_move(time.time() - started, self.nodes_searched - nodes, depth_reached, weight)
+
+    def record_move(self, seconds, nodes, depth_reached, weight):
+        """ Record the search metrics of a move, counted ``weight`` times when the moves are sampled
+        """
+        METRICS.inc('tictank_search_moves_total', weight, depth=self.thinking_depth)
+        METRICS.inc('tictank_search_nodes_total', nodes * weight, depth=self.thinking_depth)
+        METRICS.observe('tictank_search_move_seconds', seconds, weight, depth=self.thinking_depth)
+        METRICS.observe('tictank_search_depth_reached', depth_reached, weight, depth=self.thinking_depth)
+
+    @property
+    def nodes_searched(self):
+        """ Number of positions expanded by the bot's searches so far
+        """
+        return self.search.total_nodes + self.parallel_nodes
+
+    def parallel_move(self, gameinstance):
+        """ Returns the move of the parallel search, or None when the bot searches in its own process:
+        there is no search pool, the search is too shallow to gain from it, the bot has a time budget or its own
+        evaluator, or the pool is busy with the move of another bot. The parallel search has no budget, the
+        node budgets of MOVE_NODE_BUDGETS are above the full depth of the bots so they play the same moves.
+            :param gameinstance: The game instance
+        """
+        pool = get_search_pool()
+        if pool is None or self.thinking_depth < PARALLEL_SEARCH_MIN_DEPTH or self.move_time is not None or \
+                self.evaluator is not None:
+            return None
+        result = pool.best_move(gameinstance, self.marker, self.opponentmarker, self.thinking_depth)
+        if result is None:
+            return None
+        move_position, nodes = result
+        gameinstance.potential_moves[self.marker] += nodes
+        self.parallel_nodes += nodes
+        return move_position
+
+    def perfect_move(self, gameinstance):
+        """ Returns the perfect play move from the tablebase or None if the position is not in the table
+            :param gameinstance: The game instance
+        """
+        try:
+            return get_tablebase().best_move(gameinstance.board, self.marker, self.opponentmarker,
+                                             gameinstance.turn_moves)
+        except KeyError:
+            return None
 
     @staticmethod
     def random_move(gameinstance):
-        """ Returns a valid random move position on the board
+        """ Returns a valid random move position on the board, drawn from the random numbers of the game
             :param gameinstance: The game instance
         """
         moves = gameinstance.get_available_moves()
         if not moves:
             return
-        shuffle(moves)
+        gameinstance.rng.shuffle(moves)
         return moves[0]
 
     def minimax(self, gameinstance, depth):
         """ Minimax decision making AI to calculate the best move
-        with a maximum depth
+        with a maximum depth. This is the full width reference search, ``move`` gets the
+        same decision from the pruned ``AlphaBetaSearch``
             :param gameinstance: The game instance
             :param depth: Maximum number of search in the tree before aborting
             :return The best available move
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import sys
+import time
+
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tictank_ai_logic import AIBot
+from tictank_db import get_bots
+from tictank_game_logic import MAX_MOVES, PLAY_TILES, STARTING_BOARDS, WIN_POSITIONS
+from tictank_simulation import new_statistics, simulation_results
+
+# Games played at once, the arrays of a batch take about 100 bytes per game
+BATCH_SIZE = 100000
+# Highest thinking_depth the batch engine can play: random bots and bots that take a winning tank at once
+MAX_BATCH_DEPTH = 1
+
+# Cells hold the battle tiles -1..4, the tanks of the player moving first are 5 and the other player's 6
+TANK_READY = PLAY_TILES[-1]
+FIRST_TANK = TANK_READY + 1
+SECOND_TANK = TANK_READY + 2
+BOARD_CELLS = 9
+
+
+def require_numpy():
+    """ Raise RuntimeError when NumPy, the optional dependency of the batch simulator, is not installed
+    """
+    if np is None:
+        raise RuntimeError("Error: NumPy is required by the batch simulator, install it with pip install numpy")
+
+
+def play_batch(games, depths, board_id=None, random_state=None):
+    """ Play ``games`` games at once between two bots with the rules of ``GAME.move`` and ``GAME.is_gameover``
+        :param depths: thinking_depth of the two bots, 0 or 1
+        :param board_id: optional starting board id, a random one is used for every game by default
+        :param random_state: numpy RandomState
+        :return: dict of arrays with one value per game: board_id, first (index of the bot that moved first),
+        winner (index of the winning bot), moves, soldiers and tanks (deployed by each bot)
+    """
+    require_numpy()
+    rng = random_state if random_state is not None else np.random.RandomState()
+    rows = np.arange(games)
+
+    # shuffled starting boards, like get_starting_board
+    board_ids = sorted(STARTING_BOARDS)
+    if board_id is None:
+        game_boards = rng.randint(board_ids[0], board_ids[-1] + 1, size=games)
+    else:
+        game_boards = np.full(games, board_id, dtype=np.int64)
+    layouts = np.zeros((max(board_ids) + 1, BOARD_CELLS), dtype=np.int8)
+    for starting_board_id, starting_board in STARTING_BOARDS.items():
+        layouts[starting_board_id] = starting_board
+    order = rng.random_sample((games, BOARD_CELLS)).argsort(axis=1)
+    board = layouts[game_boards][rows[:, None], order]
+
+    # the seats are the order of play, seat_bot holds the bot sitting in each seat
+    first = rng.randint(0, 2, size=games)
+    seat_bot = np.stack([first, 1 - first], axis=1)
+    seat_depth = np.asarray(depths)[seat_bot]
+    seat = np.zeros(games, dtype=np.int64)
+    turn_moves = np.full(games, MAX_MOVES, dtype=np.int64)
+    winner_seat = np.full(games, -1, dtype=np.int64)
+    moves = np.zeros(games, dtype=np.int64)
+    soldiers = np.zeros((games, 2), dtype=np.int64)
+    tanks = np.zeros((games, 2), dtype=np.int64)
+    lines = np.array(WIN_POSITIONS)
+
+    active = rows
+    while active.size:
+        b = board[active]
+        s = seat[active]
+        count = active.size
+        local = np.arange(count)
+        own_tank = (FIRST_TANK + s)[:, None]
+        available = b <= TANK_READY
+
+        # random bots: every available cell is as likely, like the shuffle of AIBot.random_move
+        draw = rng.random_sample((count, BOARD_CELLS))
+        draw[~available] = -1
+        position = draw.argmax(axis=1)
+
+        # greedy bots: the first cell where a tank wins at once, otherwise the first available cell,
+        # like the depth 1 search that only replaces its first move with a strictly better one
+        greedy = seat_depth[active, s] > 0
+        if greedy.any():
+            ready = b == TANK_READY
+            own = b == own_tank
+            line_win = np.zeros((count, BOARD_CELLS), dtype=bool)
+            for i, j, k in WIN_POSITIONS:
+                line_win[:, i] |= own[:, j] & own[:, k]
+                line_win[:, j] |= own[:, i] & own[:, k]
+                line_win[:, k] |= own[:, i] & own[:, j]
+            # the last free cell ends the battle, the bot wins it with more tanks
+            own_count = own.sum(axis=1)
+            last_cell = available.sum(axis=1) == 1
+            full_win = (last_cell & (own_count + 1 > BOARD_CELLS - own_count - 1))[:, None]
+            winning = ready & (line_win | full_win)
+            greedy_position = np.where(winning.any(axis=1), winning.argmax(axis=1), available.argmax(axis=1))
+            position = np.where(greedy, greedy_position, position)
+
+        # deploy a soldier, or a tank on a full stack of soldiers
+        value = b[local, position]
+        soldier = value < TANK_READY
+        b[local, position] = np.where(soldier, value + 1, own_tank[:, 0])
+        soldiers[active, seat_bot[active, s]] += soldier
+        tanks[active, seat_bot[active, s]] += ~soldier
+        moves[active] += 1
+
+        # the first complete line decides the battle, then the tank count of a full battlefield
+        cells = b[:, lines]
+        complete = (cells[:, :, 0] == cells[:, :, 1]) & (cells[:, :, 1] == cells[:, :, 2]) & \
+                   (cells[:, :, 0] > TANK_READY)
+        won_line = complete.any(axis=1)
+        line_owner = cells[local, complete.argmax(axis=1), 0] - FIRST_TANK
+        first_tanks = (b == FIRST_TANK).sum(axis=1)
+        second_tanks = (b == SECOND_TANK).sum(axis=1)
+        full = first_tanks + second_tanks == BOARD_CELLS
+        over = won_line | full
+        winner_seat[active] = np.where(won_line, line_owner,
+                                       np.where(full, (first_tanks <= second_tanks).astype(np.int64), -1))
+        board[active] = b
+
+        # the turn ends after MAX_MOVES deployments
+        left = turn_moves[active] - 1
+        end_turn = left == 0
+        turn_moves[active] = np.where(end_turn, MAX_MOVES, left)
+        seat[active] = np.where(end_turn, 1 - s, s)
+        active = active[~over]
+
+    return {'board_id': game_boards,
+            'first': first,
+            'winner': seat_bot[rows, winner_seat],
+            'moves': moves,
+            'soldiers': soldiers,
+            'tanks': tanks}
+
+
+def add_batch(statistics, names, results):
+    """ Add the results of play_batch to statistics of tictank_simulation
+        :param names: names of the two bots
+    """
+    games = len(results['winner'])
+    winner = results['winner']
+    rows = np.arange(games)
+    first_won = winner == results['first']
+    statistics['games'] += games
+    statistics['first_player_wins'] += int(first_won.sum())
+    for bot, name in enumerate(names):
+        statistics['bot_games'][name] += games
+        statistics['bot_wins'][name] += int((winner == bot).sum())
+    for moves, count in enumerate(np.bincount(results['moves'])):
+        if count:
+            statistics['moves'][moves] += int(count)
+    for key in ('soldiers', 'tanks'):
+        statistics[key]['winner'] += int(results[key][rows, winner].sum())
+        statistics[key]['loser'] += int(results[key][rows, 1 - winner].sum())
+    for board_id in np.unique(results['board_id']):
+        on_board = results['board_id'] == board_id
+        board = statistics['boards'].setdefault(int(board_id), {'games': 0,
+                                                                'first_player_wins': 0,
+                                                                'moves': 0,
+                                                                'bot_wins': Counter()})
+        board['games'] += int(on_board.sum())
+        board['first_player_wins'] += int(first_won[on_board].sum())
+        board['moves'] += int(results['moves'][on_board].sum())
+        for bot, name in enumerate(names):
+            board['bot_wins'][name] += int((winner[on_board] == bot).sum())
+
+
+def simulate_batch(games, p1_id, p2_id, board_id=None, seed=None, batch_size=BATCH_SIZE):
+    """ Play ``games`` games between two bots of thinking_depth 0 or 1 with NumPy, ``batch_size`` games at once
+    The games follow the rules and the move choices of the bots of ``play_game``, the random choices come
+    from NumPy so the games differ but the results have the same distribution. The battle results are not
+    written in the battle_log table.
+        :param p1_id: Player 1's id
+        :param p2_id: Player 2's id
+        :param board_id: optional starting board id, a random one is used for every game by default
+        :param seed: optional seed to replay the same games
+        :return: statistics dict of tictank_simulation
+    """
+    require_numpy()
+    bots = get_bots(p1_id, p2_id)
+    if None in bots:
+        raise ValueError("Error: No bots in database for provided Parameters")
+    names = [name for name, _ in bots]
+    depths = [AIBot.get_thinking_depth(iq) for _, iq in bots]
+    if max(depths) > MAX_BATCH_DEPTH:
+        raise ValueError("Error: The batch simulator only plays bots with a thinking depth up to {}".format(
+            MAX_BATCH_DEPTH))
+    random_state = np.random.RandomState(seed)
+    statistics = new_statistics()
+    while statistics['games'] < games:
+        batch_games = min(batch_size, games - statistics['games'])
+        add_batch(statistics, names, play_batch(batch_games, depths, board_id, random_state))
+    return statistics
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Play many games between two random or greedy bots with NumPy")
+    parser.add_argument("--p1_id", type=int, required=True)
+    parser.add_argument("--p2_id", type=int, required=True)
+    parser.add_argument("--games", type=int, default=1000000)
+    parser.add_argument("--board_id", type=int, choices=sorted(STARTING_BOARDS), default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    started = time.time()
+    try:
+        statistics = simulate_batch(args.games, args.p1_id, args.p2_id, board_id=args.board_id, seed=args.seed)
+    except (RuntimeError, ValueError) as e:
+        sys.exit(str(e))
+    elapsed = time.time() - started
+    logging.info("{} games played in {:.1f}s, {:.0f} games per minute".format(
+        args.games, elapsed, args.games * 60 / elapsed))
+    print(json.dumps(simulation_results(statistics), indent=2, sort_keys=True))
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from random import Random
+
+import tictank_db
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_codec import BINARY_STREAM_TYPE, BINARY_TYPE
+from tictank_db import DATABASE_NAME, BattleLogWriter, get_battle_log_writer
+from tictank_evaluation import HEURISTIC, TERMINAL
+from tictank_game_logic import CLASSIC, MAX_MOVES, STARTING_BOARDS, GAME, draw_game_setup, get_geometry, \
+    play_game, start_game
+from tictank_search import get_transposition_table
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+BENCHMARK_NAME = "benchmark.json"
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tictank_server.py")
+
+# IQ of a bot of every thinking_depth tier of AIBot.get_thinking_depth
+TIER_IQS = {0: 80, 1: 100, 2: 110, 3: 130, 4: 140, 5: 170, 6: 190}
+# Positions searched by every tier on every starting board, each one from its own fixed seed
+SEARCH_POSITIONS = 8
+# Most troop deployments played at random on a starting board before the bot to benchmark moves
+SEARCH_OPENING_MOVES = 6
+
+# Games played by the game loop benchmark: name, IQ of both bots and number of games
+GAME_MATCHUPS = [
+    ('random', 80, 80, 500),
+    ('greedy', 100, 100, 500),
+    ('depth_2_vs_3', 110, 130, 100),
+    ('depth_4', 140, 140, 20),
+]
+
+# Battlefields of the board scaling benchmark: board size, win length and number of games
+BOARD_SCALING = [(3, 3, 20), (4, 3, 6), (4, 4, 6), (5, 4, 4), (6, 4, 2), (7, 4, 2)]
+# IQ of the bots playing the board scaling benchmark, a depth 4 and a depth 2 one
+BOARD_SCALING_IQS = (140, 110)
+
+# Self-play of the evaluation benchmark on tic tac toe battlefields: thinking_depth tiers of the bots scoring
+# the positions with the heuristic, played against the depth 4 bots of minimax, and the number of starting
+# setups, each one played twice with the bots swapping sides
+EVALUATION_TIERS = (1, 2, 3, 4)
+EVALUATION_OPPONENT_TIER = 4
+EVALUATION_SETUPS = 50
+
+# Battle results written by the battle log benchmark
+BATTLE_LOG_ROWS = 20000
+
+# Requests sent to every handler of the game server and the number of clients sending them at once
+HTTP_REQUESTS = {
+    'check': ("/", 1000),
+    'get_bots': ("/get_bots", 1000),
+    'tournament': ("/tournament", 500),
+    'stats': ("/stats", 1000),
+    'leaderboard': ("/leaderboard", 1000),
+    'play_random': ("/play_random?seed={seed}", 200),
+    'play_game': ("/play_game?p1_id=4&p2_id=13&seed={seed}", 200),
+    'play_game_5x5': ("/play_game?p1_id=4&p2_id=13&board_size=5&seed={seed}", 20),
+    'stream_game': ("/stream_game?p1_id=4&p2_id=13&seed={seed}", 200),
+    'simulate': ("/simulate?p1_id=6&p2_id=14&games=20&seed={seed}", 50),
+    'get_bots_gzip': ("/get_bots", 1000),
+    'leaderboard_gzip': ("/leaderboard", 1000),
+    'play_game_binary': ("/play_game?p1_id=4&p2_id=13&seed={seed}", 200),
+    'stream_game_binary': ("/stream_game?p1_id=4&p2_id=13&seed={seed}", 200),
+}
+# Headers of the requests of the handlers asking for gzip or for the binary encoding
+HTTP_HEADERS = {
+    'get_bots_gzip': {'Accept-Encoding': 'gzip'},
+    'leaderboard_gzip': {'Accept-Encoding': 'gzip'},
+    'play_game_binary': {'Accept': BINARY_TYPE},
+    'stream_game_binary': {'Accept': BINARY_STREAM_TYPE},
+}
+HTTP_CLIENTS = 4
+# Seconds to wait for the game server to accept requests
+SERVER_START_TIMEOUT = 30
+
+# Relative slowdown of a metric, compared to the baseline, reported as a regression
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+
+@contextmanager
+def scratch_database():
+    """ Run the benchmarks in a temporary directory with a copy of the database, so the battle results
+    they write do not end up in the real battle_log table
+    """
+    directory = tempfile.mkdtemp(prefix="tictank_benchmark_")
+    shutil.copy(DATABASE_NAME, directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        get_battle_log_writer().close()
+        tictank_db.close_connection()
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def percentile(values, fraction):
+    """ Return the value below which ``fraction`` of the sorted ``values`` fall
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def search_position(board_id, seed):
+    """ Return a game on a shuffled starting board after a few random troop deployments, where the bot
+    with the TANK_P1 tanks moves next
+    """
+    rng = Random(seed)
+    starting_board, _ = draw_game_setup(rng, board_id)
+    player1 = AIBot('P1', TANK_P1, TANK_P2, 'P1', TIER_IQS[0])
+    player2 = AIBot('P2', TANK_P2, TANK_P1, 'P2', TIER_IQS[0])
+    game = GAME(starting_board, player1, player2, rng=rng)
+    # whole turns, so the bot moves at the start of its turn
+    for move in range(rng.randint(0, SEARCH_OPENING_MOVES // MAX_MOVES) * MAX_MOVES):
+        player = player1 if move // MAX_MOVES % 2 == 0 else player2
+        moves = game.get_available_moves()
+        if not moves or game.is_gameover():
+            break
+        game.move(player.player_id, player.marker, rng.choice(moves))
+    return game
+
+
+def benchmark_search(positions=SEARCH_POSITIONS):
+    """ Time the moves of a bot of every thinking_depth tier on every starting board
+        :return: dict of results by "depth_<tier>/board_<id>"
+    """
+    results = {}
+    for depth, iq in sorted(TIER_IQS.items()):
+        for board_id in sorted(STARTING_BOARDS):
+            moves = nodes = 0
+            elapsed = 0.0
+            for seed in range(positions):
+                game = search_position(board_id, seed)
+                if game.is_gameover() or not game.get_available_moves():
+                    continue
+                # the transposition table is shared by the bots of the process, it is emptied so no move
+                # gains from the search of the previous one
+                get_transposition_table(CLASSIC).clear()
+                bot = AIBot('P1', TANK_P1, TANK_P2, 'Benchmark', iq)
+                game.p1 = bot
+                started = time.time()
+                bot.move(game)
+                elapsed += time.time() - started
+                moves += 1
+                nodes += bot.nodes_searched
+            name = 'depth_{}/board_{}'.format(depth, board_id)
+            results[name] = {'moves': moves,
+                             'nodes': nodes,
+                             'ms_per_move': round(elapsed * 1000 / moves, 3) if moves else None,
+                             'nodes_per_sec': round(nodes / elapsed) if nodes and elapsed else None}
+            logging.info("Search {}: {}".format(name, results[name]))
+    return results
+
+
+def benchmark_games(matchups=GAME_MATCHUPS):
+    """ Time whole games of play_game, battle log included
+        :return: dict of results by matchup name
+    """
+    results = {}
+    for name, p1_iq, p2_iq, games in matchups:
+        moves = 0
+        started = time.time()
+        for seed in range(games):
+            player1 = AIBot('P1', TANK_P1, TANK_P2, 'P1', p1_iq)
+            player2 = AIBot('P2', TANK_P2, TANK_P1, 'P2', p2_iq)
+            moves += play_game(player1, player2, seed=seed)['moves_count']
+        elapsed = time.time() - started
+        results[name] = {'games': games,
+                         'moves': moves,
+                         'games_per_sec': round(games / elapsed, 2),
+                         'ms_per_game': round(elapsed * 1000 / games, 3)}
+        logging.info("Games {}: {}".format(name, results[name]))
+    get_battle_log_writer().flush()
+    return results
+
+
+def benchmark_boards(battlefields=BOARD_SCALING, iqs=BOARD_SCALING_IQS):
+    """ Time whole games and every move on battlefields of growing size, battle log included
+        :return: dict of results by battlefield
+    """
+    results = {}
+    for size, win_length, games in battlefields:
+        geometry = get_geometry(size, win_length)
+        move_times = []
+        started = time.time()
+        for seed in range(games):
+            player1 = AIBot('P1', TANK_P1, TANK_P2, 'P1', iqs[0])
+            player2 = AIBot('P2', TANK_P2, TANK_P1, 'P2', iqs[1])
+            game, _ = start_game(player1, player2, seed=seed, geometry=geometry)
+            moved = time.time()
+            for _ in game.play_moves():
+                now = time.time()
+                move_times.append(now - moved)
+                moved = now
+            game.game_results()
+        elapsed = time.time() - started
+        move_times.sort()
+        name = '{0}x{0}_k{1}'.format(size, win_length)
+        results[name] = {'cells': geometry.cells,
+                         'games': games,
+                         'moves': len(move_times),
+                         'games_per_sec': round(games / elapsed, 2),
+                         'moves_per_sec': round(len(move_times) / elapsed, 2),
+                         'move_p50_ms': round(percentile(move_times, 0.5) * 1000, 3),
+                         'move_p99_ms': round(percentile(move_times, 0.99) * 1000, 3)}
+        logging.info("Boards {}: {}".format(name, results[name]))
+    get_battle_log_writer().flush()
+    return results
+
+
+def benchmark_evaluation(tiers=EVALUATION_TIERS, opponent_tier=EVALUATION_OPPONENT_TIER, setups=EVALUATION_SETUPS):
+    """ Play bots of the heuristic evaluator against the bots of minimax, whose search only scores the won and
+    lost battles, battle log included
+        :return: dict of results by matchup, with the wins and the nodes searched per win of both evaluators
+    """
+    results = {}
+    opponent_iq = TIER_IQS[opponent_tier]
+    for tier in tiers:
+        wins = {HEURISTIC: 0, TERMINAL: 0}
+        nodes = {HEURISTIC: 0, TERMINAL: 0}
+        # the searches of every matchup start from empty tables, not the ones filled by the previous matchup
+        for evaluator in (HEURISTIC, TERMINAL):
+            get_transposition_table(CLASSIC, evaluator).clear()
+        started = time.time()
+        for seed in range(setups):
+            for heuristic_first in (True, False):
+                heuristic = (HEURISTIC, TIER_IQS[tier])
+                terminal = (TERMINAL, opponent_iq)
+                first, second = (heuristic, terminal) if heuristic_first else (terminal, heuristic)
+                player1 = AIBot('P1', TANK_P1, TANK_P2, first[0], first[1], evaluator=first[0])
+                player2 = AIBot('P2', TANK_P2, TANK_P1, second[0], second[1], evaluator=second[0])
+                game, _ = start_game(player1, player2, seed=seed)
+                for _ in game.play_moves():
+                    pass
+                game.game_results()
+                wins[player1.name if game.winner == player1.marker else player2.name] += 1
+                for player in (player1, player2):
+                    nodes[player.name] += player.nodes_searched
+        elapsed = time.time() - started
+        games = setups * 2
+        name = 'heuristic_depth_{}_vs_minimax_depth_{}'.format(tier, opponent_tier)
+        results[name] = {'games': games,
+                         'games_per_sec': round(games / elapsed, 2)}
+        for evaluator, prefix in ((HEURISTIC, 'heuristic'), (TERMINAL, 'minimax')):
+            results[name].update({prefix + '_wins': wins[evaluator],
+                                  prefix + '_win_rate': round(float(wins[evaluator]) / games, 3),
+                                  prefix + '_nodes_per_win': nodes[evaluator] // wins[evaluator] if wins[evaluator]
+                                  else None})
+        logging.info("Evaluation {}: {}".format(name, results[name]))
+    get_battle_log_writer().flush()
+    return results
+
+
+def benchmark_battle_log(rows=BATTLE_LOG_ROWS):
+    """ Time the battle results queued on a BattleLogWriter until they are all written
+        :return: dict of results
+    """
+    # bots of the database, so the bot_stats rows are updated like for real games
+    bots = tictank_db.get_all_bots()
+    game_data = (bots[0][1], 4, 3, 20, 7, bots[-1][1], 5, 1, 18, 6, 13, None)
+    writer = BattleLogWriter()
+    started = time.time()
+    for _ in range(rows):
+        writer.add(game_data)
+    writer.flush()
+    elapsed = time.time() - started
+    writer.close()
+    results = {'rows': rows,
+               'rows_per_sec': round(rows / elapsed)}
+    logging.info("Battle log: {}".format(results))
+    return {'battle_log': results}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@contextmanager
+def game_server(python=sys.executable, workers=None):
+    """ Start a local game server without the game cache, so every game request plays a game, and without the
+    client rate and wait limits of the game scheduler, so every request is answered
+        :return: base url of the server
+    """
+    port = free_port()
+    url = "http://127.0.0.1:{}".format(port)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([python, SERVER_SCRIPT, "--port={}".format(port), "--game_cache=0",
+                                   "--client_rate=0", "--max_wait=0",
+                                   "--game_workers={}".format(workers or cpu_count()), "--logging=warning"],
+                                  stdout=devnull, stderr=devnull)
+    try:
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                urlopen(url + "/").read()
+                break
+            except IOError:
+                if server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("Error: The game server did not start")
+                time.sleep(0.2)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def benchmark_handler(url, path, requests, clients=HTTP_CLIENTS, headers=None):
+    """ Send ``requests`` requests to a handler from ``clients`` threads and time them
+        :param path: path of the request, ``{seed}`` is replaced by the number of the request
+        :param headers: optional headers of the requests
+        :return: dict of results
+    """
+    latencies = []
+    errors = [0]
+    received = [0]
+    lock = threading.Lock()
+    next_request = [0]
+
+    def client():
+        while True:
+            with lock:
+                seed = next_request[0]
+                next_request[0] += 1
+            if seed >= requests:
+                return
+            started = time.time()
+            try:
+                body = urlopen(Request(url + path.format(seed=seed), headers=headers or {})).read()
+            except (HTTPError, IOError):
+                with lock:
+                    errors[0] += 1
+                continue
+            latency = time.time() - started
+            with lock:
+                latencies.append(latency)
+                received[0] += len(body)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    latencies.sort()
+    results = {'requests': requests,
+               'errors': errors[0],
+               'requests_per_sec': round(len(latencies) / elapsed, 2)}
+    if latencies:
+        for name, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+            results[name] = round(percentile(latencies, fraction) * 1000, 3)
+        results['bytes'] = received[0] // len(latencies)
+    return results
+
+
+def benchmark_http(python=sys.executable, workers=None, clients=HTTP_CLIENTS, handlers=HTTP_REQUESTS):
+    """ Time the requests to every handler of a local game server
+        :return: dict of results by handler
+    """
+    results = {}
+    with game_server(python, workers) as url:
+        for name, (path, requests) in sorted(handlers.items()):
+            results[name] = benchmark_handler(url, path, requests, clients, HTTP_HEADERS.get(name))
+            logging.info("HTTP {}: {}".format(name, results[name]))
+    return results
+
+
+def run_benchmarks(suites, python=sys.executable, workers=None, clients=HTTP_CLIENTS):
+    """ Run the benchmark ``suites``: any of search, games, boards, evaluation, db and http
+        :return: dict of the environment and results by suite
+    """
+    results = {'environment': {'python': platform.python_version(),
+                               'platform': platform.platform(),
+                               'cpu_count': cpu_count(),
+                               'time': time.strftime("%Y-%m-%d %H:%M:%S")},
+               'benchmarks': {}}
+    benchmarks = results['benchmarks']
+    with scratch_database():
+        if 'search' in suites:
+            benchmarks['search'] = benchmark_search()
+        if 'games' in suites:
+            benchmarks['games'] = benchmark_games()
+        if 'boards' in suites:
+            benchmarks['boards'] = benchmark_boards()
+        if 'evaluation' in suites:
+            benchmarks['evaluation'] = benchmark_evaluation()
+        if 'db' in suites:
+            benchmarks['db'] = benchmark_battle_log()
+        if 'http' in suites:
+            benchmarks['http'] = benchmark_http(python, workers, clients)
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """ Compare the results to the baseline ones
+    The ``_per_sec`` metrics are better when higher and the ``_ms`` ones when lower, the counts are
+    not compared
+        :param threshold: relative slowdown reported as a regression
+        :return: list of (suite, benchmark, metric, baseline value, value, relative change) of the regressions,
+        the change is positive when slower
+    """
+    regressions = []
+    for suite, benchmarks in sorted(results['benchmarks'].items()):
+        for name, metrics in sorted(benchmarks.items()):
+            baseline_metrics = baseline.get('benchmarks', {}).get(suite, {}).get(name, {})
+            for metric, value in sorted(metrics.items()):
+                baseline_value = baseline_metrics.get(metric)
+                if not value or not baseline_value:
+                    continue
+                if metric.endswith('_per_sec'):
+                    change = float(baseline_value) / value - 1
+                elif metric.endswith('_ms'):
+                    change = float(value) / baseline_value - 1
+                else:
+                    continue
+                if change > threshold:
+                    regressions.append((suite, name, metric, baseline_value, value, round(change, 4)))
+    return regressions
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark the search, the game loop, the database and the server")
+    parser.add_argument("--suites", nargs='+', choices=['search', 'games', 'boards', 'evaluation', 'db', 'http'],
+                        default=['search', 'games', 'boards', 'evaluation', 'db', 'http'])
+    parser.add_argument("--output", default=BENCHMARK_NAME, help="JSON file of the results")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument("--python", default=sys.executable, help="interpreter running the game server")
+    parser.add_argument("--game_workers", type=int, default=None, help="game worker processes of the server")
+    parser.add_argument("--clients", type=int, default=HTTP_CLIENTS, help="HTTP requests sent at once")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.suites, python=args.python, workers=args.game_workers, clients=args.clients)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    logging.info("Results written to {}".format(args.output))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for suite, name, metric, baseline_value, value, change in regressions:
+            logging.info("Regression {}/{} {}: {} -> {} ({:+.1%})".format(suite, name, metric, baseline_value,
+                                                                         value, change))
+        if regressions:
+            sys.exit("Error: {} metrics regressed more than {:.0%}".format(len(regressions), args.threshold))
+        logging.info("No regression above {:.0%}".format(args.threshold))
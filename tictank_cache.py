@@ -0,0 +1,82 @@
+import time
+
+from collections import OrderedDict
+
+from tictank_ai_logic import AIBot
+from tictank_db import get_bots, get_random_bots
+from tictank_game_logic import draw_game_setup, game_random
+
+# Game results kept in memory by default
+DEFAULT_CACHE_SIZE = 4096
+# Default number of seconds a game result is served from the cache, 0 keeps it until it is evicted
+DEFAULT_CACHE_TTL = 3600
+
+
+def game_key(p1_id, p2_id, seed):
+    """ Return the cache key of the game ``run_game`` plays with the same params, None if there are no such bots
+    The key holds the bots with their IQ, the starting board and whether the second bot moves first, all
+    drawn from the seed like in the game. The bots that search play the same moves from the same starting
+    position whatever the seed, so the seed is only part of the key when one of the bots moves randomly.
+        :param p1_id: Player 1's id, random AI players are drawn from the seed when both ids are None
+        :param p2_id: Player 2's id
+        :param seed: seed of the game
+    """
+    rng, seed = game_random(seed)
+    if p1_id is None and p2_id is None:
+        bots = get_random_bots(rng)
+    else:
+        bots = get_bots(p1_id, p2_id)
+    if bots is None or None in bots:
+        return None
+    starting_board, swap_players = draw_game_setup(rng)
+    key = (tuple(bots[0]), tuple(bots[1]), tuple(starting_board), swap_players)
+    if min(AIBot.get_thinking_depth(iq) for _, iq in bots) == 0:
+        key += (seed,)
+    return key
+
+
+class GameCache:
+    """ Results of the games played by the server, so a repeated game is served without searching again
+    At most ``size`` results are kept, the least recently used one is evicted first, and a result older
+    than ``ttl`` seconds is played again.
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # key: (time the result was stored, game results), from the least to the most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return the cached game results or None
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or (self.ttl and time.time() - entry[0] > self.ttl):
+            self.misses += 1
+            return None
+        # back at the most recently used end
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, game_results):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), game_results)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+# Game cache of the server process, None when the games are always played
+GAME_CACHE = None
+
+
+def start_game_cache(size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+    global GAME_CACHE
+    GAME_CACHE = GameCache(size=size, ttl=ttl)
+    return GAME_CACHE
+
+
+def get_game_cache():
+    return GAME_CACHE
@@ -0,0 +1,408 @@
+import gzip
+import hashlib
+import json
+import re
+import struct
+
+from io import BytesIO
+
+from tictank_ai_logic import TANK_P1, TANK_P2
+from tictank_game_logic import PLAY_TILES, format_moves_list
+
+# Media types of the responses: JSON and the compact binary encoding of ``encode``, and the streamed
+# records of /stream_game and /replay, one JSON document per line or one binary one per length-prefixed frame
+JSON_TYPE = "application/json"
+NDJSON_TYPE = "application/x-ndjson"
+BINARY_TYPE = "application/x-tictank"
+BINARY_STREAM_TYPE = "application/x-tictank-stream"
+# Media types offered by the responses and by the streams, the first one is sent to the clients without
+# a preference
+RESPONSE_TYPES = (JSON_TYPE, BINARY_TYPE)
+STREAM_TYPES = (NDJSON_TYPE, BINARY_STREAM_TYPE)
+
+# Version of the binary encoding, in the first byte of every binary response and stream record
+BINARY_VERSION = 1
+
+# Tags of the binary values: integers are varints, negative ones are stored as their opposite, floats are
+# 8 bytes doubles, strings, lists and dicts are prefixed by their length
+NONE, FALSE, TRUE, INTEGER, NEGATIVE, FLOAT, STRING, LIST, DICT, BOARD, MOVES = range(11)
+FLOAT_FORMAT = struct.Struct('<d')
+
+# Keys of the responses, stored as their index in the binary dicts. New keys are only ever appended, the
+# other keys are stored as the index past the last one plus their length, followed by their UTF-8 bytes.
+KEYS = ('starting_board', 'board_size', 'win_length', 'seed', 'player_1', 'player_2', 'name', 'iq', 'tank',
+        'soldiers_deployed', 'tanks_deployed', 'pot_moves', 'nodes_searched', 'moves_list', 'moves_count',
+        'ending_board', 'winner', 'player_id', 'pos', 'value', 'id', 'created_at', 'board', 'player', 'bot',
+        'turn_moves', 'available_moves', 'bot_moves', 'results', 'games', 'bots', 'first_player_win_rate',
+        'moves', 'average', 'distribution', 'soldiers', 'winner_average', 'loser_average', 'tanks', 'boards',
+        'average_moves', 'wins', 'losses', 'win_rate', 'bot_games', 'bot_wins', 'finished', 'games_per_pairing',
+        'games_played', 'games_total', 'standings', 'rating', 'team', 'order', 'days', 'stats', 'avg_game_moves',
+        'avg_moves', 'tank_ratio', 'soviet_ai', 'german_ai', 'connected')
+KEY_INDEX = dict((key, index) for index, key in enumerate(KEYS))
+
+# Keys of the boards of the game results, their tiles and tanks separated by slashes are packed two cells
+# per byte, and of the move history entries, packed one move per byte with the starting board of the
+# same dict: the position in the low 7 bits and the highest bit set for the moves of P2
+BOARD_KEYS = frozenset(('starting_board', 'ending_board', 'board'))
+MOVES_KEY = 'moves_list'
+MOVE_PLAYER_BIT = 0x80
+MAX_MOVE_POS = 0x7F
+# Player ids and tanks of the packed moves
+MOVE_TANKS = {'P1': TANK_P1, 'P2': TANK_P2}
+MOVE_PLAYER_BITS = {'1': 0, '2': MOVE_PLAYER_BIT}
+# Whole moves_list packed by ``pack_moves``, the numbers written like Python writes them and the tanks of
+# MOVE_TANKS, and the players and positions of its moves
+MOVES_LIST = re.compile(r"(?:\('P1', {0}, -?{0}, {1}\)|\('P2', {0}, -?{0}, {2}\))*\Z".format(
+    r"(?:0|[1-9]\d*)", TANK_P1, TANK_P2))
+MOVES_LIST_MOVE = re.compile(r"\('P([12])', (\d+), ")
+# Low nibble padding the last byte of a board with an odd number of cells
+BOARD_PADDING = 0xF
+
+# Responses written at once of at least this many bytes are gzipped for the clients accepting it, like the
+# batches of /simulate, /leaderboard and /replay, the results of a single tic tac toe game are not worth the CPU
+GZIP_MIN_LENGTH = 2048
+# Compression level of the gzipped responses, the one of Tornado
+GZIP_LEVEL = 6
+
+try:
+    TEXT_TYPES = (str, unicode)
+except NameError:
+    TEXT_TYPES = (str,)
+
+
+def negotiate(accept, offers=RESPONSE_TYPES):
+    """ Return the media type of ``offers`` the client prefers, the first one when it has no preference
+        :param accept: Accept header of the request or None
+        :param offers: media types of the response, the first one is the default
+    """
+    # the clients that do not ask for the binary encoding get the default without parsing their header,
+    # the media types are case insensitive
+    accept = accept.lower() if accept else ''
+    if 'x-tictank' not in accept:
+        return offers[0]
+    best, best_quality = offers[0], 0.0
+    for offer in offers:
+        offer_type = offer.split('/')[0]
+        # quality of the most specific media range matching the offer
+        quality, specificity = 0.0, -1
+        for media_range in accept.split(','):
+            params = media_range.split(';')
+            media_type = params[0].strip()
+            if media_type == offer:
+                match = 2
+            elif media_type == offer_type + '/*':
+                match = 1
+            elif media_type == '*/*':
+                match = 0
+            else:
+                continue
+            if match > specificity:
+                specificity = match
+                quality = 1.0
+                for param in params[1:]:
+                    name, _, value = param.partition('=')
+                    if name.strip() == 'q':
+                        try:
+                            quality = float(value)
+                        except ValueError:
+                            quality = 0.0
+        if quality > best_quality:
+            best, best_quality = offer, quality
+    return best
+
+
+def write_varint(out, number):
+    while number > 0x7F:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def read_varint(data, offset):
+    """ Return the varint at ``offset`` of a bytearray and the offset past it
+    """
+    number = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def pack_board(text):
+    """ Return the packed cells of a board of the game results, two per byte, or None when it is not one
+    """
+    try:
+        board = [int(tile) - PLAY_TILES[0] for tile in text.split('/')]
+    except ValueError:
+        return None
+    if min(board) < 0 or max(board) >= BOARD_PADDING:
+        return None
+    if len(board) % 2:
+        board.append(BOARD_PADDING)
+    return bytearray(board[i] << 4 | board[i + 1] for i in range(0, len(board), 2))
+
+
+def unpack_board(data, cells):
+    board = []
+    for byte in data:
+        board.append((byte >> 4) + PLAY_TILES[0])
+        board.append((byte & 0xF) + PLAY_TILES[0])
+    return board[:cells]
+
+
+def play_moves(starting_board, moves):
+    """ Return the move history entries of the packed moves, deployed on the starting board with the rules
+    of GAME.move
+    """
+    board = list(starting_board)
+    entries = []
+    for byte in moves:
+        player_id = 'P2' if byte & MOVE_PLAYER_BIT else 'P1'
+        pos = byte & MAX_MOVE_POS
+        if board[pos] < len(PLAY_TILES) - 2:
+            board[pos] += 1
+        else:
+            board[pos] = MOVE_TANKS[player_id]
+        entries.append((player_id, pos, board[pos], MOVE_TANKS[player_id]))
+    return entries
+
+
+def pack_moves(text, cells):
+    """ Return the packed moves of a moves_list, one byte per move, or None when it is not one
+    Only the positions and players are kept, the values are the ones GAME.move deploys from the starting board
+    of the game results like in every moves_list.
+        :param cells: number of cells of the battlefield
+    """
+    if cells > MAX_MOVE_POS + 1 or not MOVES_LIST.match(text):
+        return None
+    return bytearray([int(pos) | MOVE_PLAYER_BITS[player] for player, pos in MOVES_LIST_MOVE.findall(text)])
+
+
+def encode(value):
+    """ Return the binary encoding of a JSON response, a few times smaller than its JSON
+    The binary values decode to the values ``json.loads`` returns for the JSON of the same response.
+    """
+    out = bytearray((BINARY_VERSION,))
+    encode_value(out, value)
+    return bytes(out)
+
+
+def encode_value(out, value):
+    # the most frequent types first: the counters and the names
+    value_type = type(value)
+    if value_type is int and 0 <= value <= 0x7F:
+        out.append(INTEGER)
+        out.append(value)
+    elif value_type in TEXT_TYPES:
+        encode_string(out, value, STRING)
+    elif value_type is dict:
+        out.append(DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            index = KEY_INDEX.get(key)
+            if index is not None:
+                write_varint(out, index)
+            else:
+                if not isinstance(key, TEXT_TYPES):
+                    # like in JSON, the keys are strings
+                    key = json.dumps(key)
+                encode_string(out, key, None)
+            if key in BOARD_KEYS and isinstance(item, TEXT_TYPES):
+                board = pack_board(item)
+                if board is not None:
+                    out.append(BOARD)
+                    write_varint(out, item.count('/') + 1)
+                    out += board
+                    continue
+            elif key == MOVES_KEY and isinstance(item, TEXT_TYPES):
+                starting_board = value.get('starting_board')
+                moves = pack_moves(item, starting_board.count('/') + 1) \
+                    if isinstance(starting_board, TEXT_TYPES) else None
+                if moves is not None:
+                    out.append(MOVES)
+                    write_varint(out, len(moves))
+                    out += moves
+                    continue
+            encode_value(out, item)
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += FLOAT_FORMAT.pack(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        write_varint(out, len(value))
+        for item in value:
+            encode_value(out, item)
+    elif isinstance(value, dict):
+        encode_value(out, dict(value))
+    elif value >= 0:
+        out.append(INTEGER)
+        write_varint(out, value)
+    else:
+        out.append(NEGATIVE)
+        write_varint(out, -value)
+
+
+def encode_string(out, text, tag):
+    """ Append a string prefixed by its length, or a dict key prefixed by the index past KEYS plus its length
+    when ``tag`` is None
+    """
+    data = text if isinstance(text, bytes) else text.encode('utf-8')
+    if tag is None:
+        write_varint(out, len(KEYS) + len(data))
+    else:
+        out.append(tag)
+        write_varint(out, len(data))
+    out += data
+
+
+def decode(data):
+    """ Return the response of its binary encoding
+    Raises a ValueError when ``data`` is not one
+    """
+    data = bytearray(data)
+    if not data or data[0] != BINARY_VERSION:
+        raise ValueError("Error: Unknown binary format")
+    try:
+        value, offset = decode_value(data, 1)
+    except (IndexError, KeyError, struct.error):
+        raise ValueError("Error: Truncated binary response")
+    if offset != len(data):
+        raise ValueError("Error: Trailing bytes after the binary response")
+    return value
+
+
+def decode_value(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    if tag == TRUE:
+        return True, offset
+    if tag == FALSE:
+        return False, offset
+    if tag == INTEGER:
+        return read_varint(data, offset)
+    if tag == NEGATIVE:
+        number, offset = read_varint(data, offset)
+        return -number, offset
+    if tag == FLOAT:
+        return FLOAT_FORMAT.unpack_from(bytes(data[offset:offset + FLOAT_FORMAT.size]))[0], \
+            offset + FLOAT_FORMAT.size
+    if tag == STRING:
+        length, offset = read_varint(data, offset)
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    if tag == LIST:
+        length, offset = read_varint(data, offset)
+        items = []
+        for _ in range(length):
+            item, offset = decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == DICT:
+        length, offset = read_varint(data, offset)
+        items = {}
+        moves = None
+        for _ in range(length):
+            index, offset = read_varint(data, offset)
+            if index < len(KEYS):
+                key = KEYS[index]
+            else:
+                end = offset + index - len(KEYS)
+                key, offset = data[offset:end].decode('utf-8'), end
+            if data[offset] == MOVES:
+                length, offset = read_varint(data, offset + 1)
+                moves, offset = data[offset:offset + length], offset + length
+            else:
+                items[key], offset = decode_value(data, offset)
+        if moves is not None:
+            board = [int(tile) for tile in items['starting_board'].split('/')]
+            items[MOVES_KEY] = format_moves_list(play_moves(board, moves))
+        return items, offset
+    if tag == BOARD:
+        cells, offset = read_varint(data, offset)
+        end = offset + (cells + 1) // 2
+        return '/'.join(map(str, unpack_board(data[offset:end], cells))), end
+    raise ValueError("Error: Unknown binary value tag {}".format(tag))
+
+
+def frame(record):
+    """ Return a binary stream record prefixed by its length
+    """
+    body = encode(record)
+    out = bytearray()
+    write_varint(out, len(body))
+    return bytes(out) + body
+
+
+def decode_stream(data):
+    """ Return the records of a binary stream of ``frame``
+    """
+    data = bytearray(data)
+    records = []
+    offset = 0
+    while offset < len(data):
+        length, offset = read_varint(data, offset)
+        records.append(decode(data[offset:offset + length]))
+        offset += length
+    return records
+
+
+def gzip_body(body):
+    out = BytesIO()
+    with gzip.GzipFile(mode='wb', fileobj=out, compresslevel=GZIP_LEVEL) as gzip_file:
+        gzip_file.write(body)
+    return out.getvalue()
+
+
+class Payload:
+    """ A response served many times unchanged, like the bot roster: its body is encoded once in every media
+    type of RESPONSE_TYPES and gzipped once, with the ETag of every body
+    """
+
+    def __init__(self, value, json_body=None):
+        """ :param value: the response
+            :param json_body: optional JSON of the response already encoded
+        """
+        self.value = value
+        self.bodies = {}
+        if json_body is not None:
+            if not isinstance(json_body, bytes):
+                json_body = json_body.encode('utf-8')
+            self.bodies[(JSON_TYPE, False)] = json_body
+        self.etags = {}
+
+    @classmethod
+    def from_json(cls, json_body):
+        return cls(json.loads(json_body), json_body)
+
+    def body(self, media_type, gzipped=False):
+        """ Return the body of the response in one of RESPONSE_TYPES, gzipped or not
+        """
+        key = (media_type, gzipped)
+        body = self.bodies.get(key)
+        if body is None:
+            if gzipped:
+                body = gzip_body(self.body(media_type))
+            elif media_type == BINARY_TYPE:
+                body = encode(self.value)
+            else:
+                body = json.dumps(self.value).encode('utf-8')
+            self.bodies[key] = body
+        return body
+
+    def etag(self, media_type):
+        """ Return the ETag of the response in one of RESPONSE_TYPES, the one of its body like Tornado computes it
+        """
+        etag = self.etags.get(media_type)
+        if etag is None:
+            etag = self.etags[media_type] = '"{}"'.format(hashlib.sha1(self.body(media_type)).hexdigest())
+        return etag
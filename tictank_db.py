@@ -1,12 +1,76 @@
 #!/usr/bin/python
+import atexit
+import json
 import logging
+import os
 import sqlite3
 import sys
+import threading
+import time
 
-from random import shuffle
+from multiprocessing.util import Finalize
+from random import choice
+
+from tictank_metrics import METRICS
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 DATABASE_NAME = "tic_tank.db"
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+# SQL scripts of the database, found from any working directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+GAME_TABLES = os.path.join(DATA_DIR, "create_game_tables.sql")
+DEFAULT_BOTS = os.path.join(DATA_DIR, "populate_ai_bots.sql")
+STATS_TABLES = os.path.join(DATA_DIR, "create_stats_tables.sql")
+
+# Pragmas set on every new connection, change them before the first query to tune the database.
+# WAL lets the workers read while another process writes the battle results.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -8000,
+    'temp_store': 'MEMORY',
+}
+# Number of prepared statements kept by each connection
+CACHED_STATEMENTS = 64
+
+INSERT_BATTLE_LOG = "INSERT INTO battle_log " \
+                    "(winner_name, winner_soldiers, winner_tanks, winner_pot_moves, winner_moves, " \
+                    "loser_name, loser_soldiers, loser_tanks, loser_pot_moves, loser_moves, moves, replay, " \
+                    "winner_id, loser_id) " \
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+# Columns added to battle_log after the first databases were created, with their type and the optional
+# statement filling them in the existing rows
+BATTLE_LOG_NEW_COLUMNS = [
+    ('replay', 'BLOB', None),
+    ('winner_id', 'INT REFERENCES ai_bots(id)',
+     "UPDATE battle_log SET winner_id = (SELECT MIN(id) FROM ai_bots WHERE name = winner_name)"),
+    ('loser_id', 'INT REFERENCES ai_bots(id)',
+     "UPDATE battle_log SET loser_id = (SELECT MIN(id) FROM ai_bots WHERE name = loser_name)"),
+]
+INSERT_BOT_STATS_DAY = "INSERT OR IGNORE INTO bot_stats (bot_id, day) VALUES (?, ?)"
+UPDATE_BOT_STATS = "UPDATE bot_stats SET games = games + ?, wins = wins + ?, soldiers = soldiers + ?, " \
+                   "tanks = tanks + ?, pot_moves = pot_moves + ?, moves = moves + ?, game_moves = game_moves + ? " \
+                   "WHERE bot_id = ? AND day = ?"
+
+# Battle results kept in memory before the games that produce them have to wait for the writer
+BATTLE_LOG_BUFFER = 10000
+# Battle results written in one transaction
+BATTLE_LOG_BATCH = 500
+# Maximum number of seconds a battle result waits before being written
+BATTLE_LOG_FLUSH_INTERVAL = 1.0
+# Times a batch is written while the database is locked by another writer before it is dropped, the flush
+# interval apart
+BATTLE_LOG_WRITE_ATTEMPTS = 10
+
+# Minimum number of seconds between two checks of the ai_bots table for changes
+BOT_REGISTRY_CHECK_INTERVAL = 1.0
+
+# Long lived connections, one per process and thread since SQLite connections can not be shared by them
+_local = threading.local()
 
 
 def create_connection(db_file):
@@ -15,13 +79,39 @@ def create_connection(db_file):
         :return: Connection object or None
     """
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, cached_statements=CACHED_STATEMENTS)
+        for pragma, value in PRAGMAS.items():
+            conn.execute("PRAGMA {}={}".format(pragma, value))
         return conn
     except sqlite3.Error as e:
         print(e)
     return None
 
 
+def get_connection(db_file=DATABASE_NAME):
+    """ Return the connection of the current process and thread to the ``db_file`` database
+    The connection is created on first use and kept open, forked processes get their own one
+        :param db_file: database file
+        :return: Connection object or None
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.pid != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    connection = connections.get(db_file)
+    if connection is None:
+        connection = connections[db_file] = create_connection(db_file)
+    return connection
+
+
+def close_connection(db_file=DATABASE_NAME):
+    """ Close the connection of the current process and thread to the ``db_file`` database
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections and _local.pid == os.getpid() and db_file in connections:
+        connections.pop(db_file).close()
+
+
 def create_tables(connection, sql_script):
     """ Creates the ai_bots and battle_log tables using the SQL script from ``sql_script`` param
         :param sql_script: SQL script to create the bots and history tables
@@ -52,45 +142,362 @@ def populate_bots_table(connection, sql_script):
         print(row)
 
 
-def get_random_bots():
-    """ Get two random bot players from the database
+def prepare_database(db_file=DATABASE_NAME):
+    """ Create the tables of a new database and add the default bots when there are none
+    Done once by the server before it forks its processes, so they do not race on it. The connection
+    is closed afterwards, every process opens its own one.
     """
-    connection = create_connection(DATABASE_NAME)
-    cursor = connection.cursor()
-    cursor.execute("SELECT name, iq FROM ai_bots WHERE team=0")
-    data_soviet = cursor.fetchall()
-    cursor.execute("SELECT name, iq FROM ai_bots WHERE team=1")
-    data_german = cursor.fetchall()
-    connection.close()
+    connection = get_connection(db_file)
+    create_tables(connection, GAME_TABLES)
+    close_connection(db_file)
+    connection = get_connection(db_file)
+    migrate_battle_log(connection)
+    if not connection.execute("SELECT COUNT(*) FROM ai_bots").fetchone()[0]:
+        populate_bots_table(connection, DEFAULT_BOTS)
+    create_stats_tables(connection)
+    close_connection(db_file)
+
+
+def migrate_battle_log(connection):
+    """ Add the battle_log columns missing from a database created before them
+    """
+    columns = set(row[1] for row in connection.execute("PRAGMA table_info(battle_log)"))
+    for column, column_type, backfill in BATTLE_LOG_NEW_COLUMNS:
+        if column in columns:
+            continue
+        try:
+            with connection:
+                connection.execute("ALTER TABLE battle_log ADD COLUMN {} {}".format(column, column_type))
+            logging.debug("Column {} added to the battle_log table".format(column))
+        except sqlite3.OperationalError:
+            # added by another process in the meantime
+            continue
+        if backfill is not None:
+            with connection:
+                connection.execute(backfill)
+
+
+def create_stats_tables(connection):
+    """ Create the bot_stats table and the indexes of the stats queries when they are missing
+    The battles logged before are summed in bot_stats when it is created
+    """
+    connection.executescript(open(STATS_TABLES, "r").read())
+
+
+def bot_stats_deltas(rows):
+    """ Sum battle results by bot for the UPDATE_BOT_STATS statement
+        :param rows: tuples of the values of the INSERT_BATTLE_LOG columns
+        :return: dict of bot id: [games, wins, soldiers, tanks, pot_moves, moves, game_moves]
+    """
+    deltas = {}
+    for row in rows:
+        for bot_id, won, soldiers, tanks, pot_moves, moves in ((row[12], 1) + row[1:5], (row[13], 0) + row[6:10]):
+            if bot_id is None:
+                continue
+            delta = deltas.get(bot_id)
+            if delta is None:
+                delta = deltas[bot_id] = [0] * 7
+            delta[0] += 1
+            delta[1] += won
+            delta[2] += soldiers
+            delta[3] += tanks
+            delta[4] += pot_moves
+            delta[5] += moves
+            delta[6] += row[10]
+    return deltas
+
+
+def get_all_bots(db_file=DATABASE_NAME):
+    """ Get the id, name, team and iq of all the bots from the database
+    """
+    return get_connection(db_file).execute("SELECT id, name, team, iq FROM ai_bots ORDER BY id").fetchall()
+
+
+class BotRegistry:
+    """ In memory copy of the ai_bots table indexed by id and team
+    At most every ``check_interval`` seconds the SQLite data_version is compared to the one of the last
+    load, when another connection committed since then the table is read again and the indexes are
+    rebuilt if the bots changed, so new bots show up without a restart
+    """
+
+    def __init__(self, db_file=DATABASE_NAME, check_interval=BOT_REGISTRY_CHECK_INTERVAL):
+        self.db_file = db_file
+        self.check_interval = check_interval
+        self.checked_at = None
+        self.data_version = None
+        self.rows = None
+        self.by_id = {}
+        self.by_team = {}
+        self.by_name = {}
+        self.bots_json = None
+        self.pid = os.getpid()
+
+    def refresh(self, force=False):
+        """ Reload the bots if the ai_bots table may have changed since the last load
+        """
+        now = time.time()
+        if not force and self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        connection = get_connection(self.db_file)
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if METRICS.enabled:
+            METRICS.observe('tictank_db_query_seconds', time.time() - now, query='data_version')
+        if not force and data_version == self.data_version:
+            return
+        self.data_version = data_version
+        started = time.time()
+        rows = get_all_bots(self.db_file)
+        if METRICS.enabled:
+            METRICS.observe('tictank_db_query_seconds', time.time() - started, query='ai_bots')
+        if rows != self.rows:
+            self.load(rows)
+
+    def load(self, rows):
+        by_id = {}
+        by_team = {}
+        by_name = {}
+        bot_dict = {'soviet_ai': {},
+                    'german_ai': {}}
+        for id, name, team, iq in rows:
+            by_id[id] = (name, iq, team)
+            by_team.setdefault(team, []).append((name, iq))
+            by_name.setdefault(name, id)
+            bot_data = {'name': name, 'iq': iq}
+            if team == 0:
+                bot_dict['soviet_ai'][id] = bot_data
+            else:
+                bot_dict['german_ai'][id] = bot_data
+        self.rows = rows
+        self.by_id = by_id
+        self.by_team = by_team
+        self.by_name = by_name
+        self.bots_json = json.dumps(bot_dict)
+        logging.debug("Bot registry loaded with {} bots".format(len(rows)))
+
+    def get_bot(self, bot_id):
+        """ Return the (name, iq, team) of a bot or None if there is no bot with this id
+        """
+        self.refresh()
+        return self.by_id.get(bot_id)
+
+    def get_bot_id(self, name):
+        """ Return the id of the bot named ``name``, the lowest one when several bots share it, or None
+        """
+        self.refresh()
+        return self.by_name.get(name)
+
+    def get_team_bots(self, team):
+        self.refresh()
+        return self.by_team.get(team, [])
+
+    def get_bots_json(self):
+        """ Return the /get_bots response body
+        """
+        self.refresh()
+        return self.bots_json
+
+
+# Bot registry of the process, every forked worker loads its own
+_bot_registry = None
+
+
+def get_bot_registry():
+    global _bot_registry
+    if _bot_registry is None or _bot_registry.pid != os.getpid():
+        registry = BotRegistry()
+        if _bot_registry is not None and _bot_registry.rows is not None:
+            # a forked process starts with the bots loaded by its parent and checks them with its own connection
+            registry.load(_bot_registry.rows)
+        _bot_registry = registry
+    return _bot_registry
+
+
+def get_random_bots(rng=None):
+    """ Get two random bot players from the bot registry
+        :param rng: optional random number generator, like the random.Random of a seeded game
+    """
+    registry = get_bot_registry()
+    data_soviet = registry.get_team_bots(0)
+    data_german = registry.get_team_bots(1)
     # Check if bots exist in the db table for both teams
     if not data_soviet or not data_german:
         logging.debug("Error: No bots found in the database")
         return
-    # Randomize lists to get a random AI player
-    shuffle(data_soviet)
-    shuffle(data_german)
-    p1, p2 = data_soviet[0], data_german[0]
+    pick = rng.choice if rng is not None else choice
+    p1, p2 = pick(data_soviet), pick(data_german)
     return p1, p2
 
 
 def get_bots(p1_id, p2_id):
-    """ Get two bots from the database
+    """ Get two bots from the bot registry
         :param p1_id: player 1 optional id
         :param p2_id: player 2 optional id
     """
-    connection = create_connection(DATABASE_NAME)
-    cursor = connection.cursor()
-    cursor.execute("SELECT name, iq FROM ai_bots WHERE id={}".format(p1_id))
-    p1 = cursor.fetchone()
-    cursor.execute("SELECT name, iq FROM ai_bots WHERE id={}".format(p2_id))
-    p2 = cursor.fetchone()
-    connection.close()
-    return p1, p2
+    registry = get_bot_registry()
+    p1 = registry.get_bot(p1_id)
+    p2 = registry.get_bot(p2_id)
+    return p1 and p1[:2], p2 and p2[:2]
+
+
+def get_bot_team(bot_id):
+    """ Get the team of a bot from the bot registry
+        :param bot_id: bot id
+        :return: The team column value or None if there is no bot with this id
+    """
+    bot = get_bot_registry().get_bot(bot_id)
+    return bot[2] if bot else None
+
+
+class BattleLogWriter:
+    """ Writes the battle results to the battle_log table from a background thread
+    The results are queued and inserted with executemany, one transaction per batch of ``batch_size``
+    results or every ``flush_interval`` seconds. When ``buffer_size`` results are waiting, ``add`` blocks
+    the game until the writer catches up. ``close`` writes everything still queued.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db_file=DATABASE_NAME, buffer_size=BATTLE_LOG_BUFFER, batch_size=BATTLE_LOG_BATCH,
+                 flush_interval=BATTLE_LOG_FLUSH_INTERVAL):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name="battle-log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, game_data, block=True, timeout=None):
+        """ Queue a battle result
+            :param game_data: tuple of the values of the INSERT_BATTLE_LOG columns but the bot ids
+            :param block: wait for room in the buffer, otherwise raise queue.Full
+        """
+        if self.closed:
+            raise RuntimeError("The battle log writer is closed")
+        self.queue.put(game_data, block, timeout)
+
+    def flush(self):
+        """ Wait until all the queued battle results are written
+        """
+        self.queue.join()
+
+    def close(self):
+        """ Write the queued battle results and stop the writer thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def run(self):
+        connection = get_connection(self.db_file)
+        migrate_battle_log(connection)
+        create_stats_tables(connection)
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                game_data = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                game_data = None
+            stop = game_data is self._STOP
+            if game_data is not None and not stop:
+                batch.append(game_data)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            if batch and (stop or len(batch) >= self.batch_size or time.time() >= deadline):
+                self.write(connection, batch)
+                batch = []
+                deadline = None
+            if stop:
+                self.queue.task_done()
+                close_connection(self.db_file)
+                return
+
+    def write(self, connection, batch):
+        """ Insert a batch of battle results with the ids of their bots and add them to bot_stats
+        in the same transaction
+        The write is tried again while the database is locked by another writer, at most
+        BATTLE_LOG_WRITE_ATTEMPTS times. A batch that can not be written is logged and dropped, so the games
+        waiting for room in the buffer are not blocked forever.
+        """
+        try:
+            for attempt in range(1, BATTLE_LOG_WRITE_ATTEMPTS + 1):
+                try:
+                    self.insert(connection, batch)
+                    return
+                except sqlite3.OperationalError as e:
+                    message = str(e)
+                    if ('locked' not in message and 'busy' not in message) or attempt == BATTLE_LOG_WRITE_ATTEMPTS:
+                        raise
+                    logging.warning("Battle log write of {} results failed, attempt {}: {}".format(
+                        len(batch), attempt, e))
+                    time.sleep(self.flush_interval)
+        except sqlite3.Error as e:
+            self.dropped += len(batch)
+            logging.error("Battle log write of {} results failed, the results are dropped: {}".format(
+                len(batch), e))
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def insert(self, connection, batch):
+        registry = get_bot_registry()
+        rows = [game_data + (registry.get_bot_id(game_data[0]), registry.get_bot_id(game_data[5]))
+                for game_data in batch]
+        deltas = bot_stats_deltas(rows)
+        started = time.time()
+        # the day of the transaction, like the CURRENT_TIMESTAMP of the created_at column
+        day = time.strftime('%Y-%m-%d', time.gmtime(started))
+        with connection:
+            connection.executemany(INSERT_BATTLE_LOG, rows)
+            connection.executemany(INSERT_BOT_STATS_DAY, [(bot_id, day) for bot_id in deltas])
+            connection.executemany(UPDATE_BOT_STATS, [tuple(delta) + (bot_id, day)
+                                                      for bot_id, delta in deltas.items()])
+        self.written += len(batch)
+        if METRICS.enabled:
+            METRICS.observe('tictank_db_commit_seconds', time.time() - started)
+            METRICS.inc('tictank_battle_log_rows_total', len(batch))
+
+
+# Battle log writer of the process, every forked worker starts its own
+_battle_log_writer = None
+
+
+def get_battle_log_writer():
+    """ Return the battle log writer of the current process, started on first use
+    It is closed, writing the queued results, when the process exits
+    """
+    global _battle_log_writer
+    if _battle_log_writer is None or _battle_log_writer.pid != os.getpid():
+        writer = BattleLogWriter()
+        # multiprocessing runs the finalizers of its worker processes, atexit covers the main process
+        Finalize(writer, writer.close, exitpriority=10)
+        atexit.register(writer.close)
+        _battle_log_writer = writer
+    return _battle_log_writer
+
+
+def add_battle_log(game_data):
+    """ Queue a battle result for the battle_log table
+        :param game_data: tuple of the values of the INSERT_BATTLE_LOG columns but the bot ids, which the
+        writer looks up by name
+    """
+    get_battle_log_writer().add(game_data)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
     # Create the database with the tables ai_bots and battle_log and populates ai_bots
     connection = create_connection(DATABASE_NAME)
-    create_tables(connection, "data/create_game_tables.sql")
-    populate_bots_table(connection, "data/populate_ai_bots.sql")
+    create_tables(connection, GAME_TABLES)
+    populate_bots_table(connection, DEFAULT_BOTS)
+    create_stats_tables(connection)
     connection.close()
@@ -0,0 +1,133 @@
+from tictank_state import CELL_BITS, CELL_MASK, P1_TANK_CODE, P2_TANK_CODE, TANK_READY_CODE
+
+# Evaluators the searches score the positions of battles still going on with
+TERMINAL = 'terminal'
+HEURISTIC = 'heuristic'
+EVALUATORS = (TERMINAL, HEURISTIC)
+
+# Evaluator of the searches that do not choose one: on tic tac toe battlefields only the won and lost battles
+# score, so the bots play the moves of AIBot.minimax, the larger battlefields are scored with the heuristic.
+# The server sets it from its --evaluator option.
+DEFAULT_EVALUATOR = TERMINAL
+LARGE_BOARD_EVALUATOR = HEURISTIC
+
+# Heuristic scores stay within this range, below the SCORE_WON and SCORE_LOST of the finished battles
+HEURISTIC_RANGE = 0.9
+# Share of the winning positions and of the tank count margin in the heuristic score
+LINE_WEIGHT = 0.7
+MARGIN_WEIGHT = 0.3
+# Progress of a winning position made by a stack of soldiers ready to become a tank, the lower stacks
+# count in proportion
+READY_STACK_WEIGHT = 0.5
+# Winning positions up to this length have the values of all their cells computed when the evaluator is
+# built, the longer ones when they are first seen
+PRECOMPUTED_WIN_LENGTH = 4
+
+
+def line_progress(codes, own_code, other_code):
+    """ Return how close a winning position is to be completed by the tanks of ``own_code``, between 0 and 1
+    A position holding a tank of the opponent can not be completed anymore. Every tank counts for a whole
+    cell and every stack of soldiers for its share of READY_STACK_WEIGHT, the progress is squared so that
+    the positions about to be completed weigh the most.
+        :param codes: packed codes of the cells of the winning position, like in BoardState
+    """
+    if other_code in codes:
+        return 0.0
+    progress = 0.0
+    for code in codes:
+        if code == own_code:
+            progress += 1
+        else:
+            progress += READY_STACK_WEIGHT * code / TANK_READY_CODE
+    return (progress / len(codes)) ** 2
+
+
+class LineValues(dict):
+    """ Values of the winning positions of ``win_length`` cells by the packed codes of their cells:
+    the progress of player 1's tanks minus the progress of player 2's ones. Missing values are computed
+    when first looked up.
+    """
+
+    def __init__(self, win_length):
+        dict.__init__(self)
+        self.win_length = win_length
+
+    def __missing__(self, code):
+        codes = [(code >> (CELL_BITS * i)) & CELL_MASK for i in range(self.win_length)]
+        value = self[code] = line_progress(codes, P1_TANK_CODE, P2_TANK_CODE) - \
+            line_progress(codes, P2_TANK_CODE, P1_TANK_CODE)
+        return value
+
+
+class HeuristicEvaluator:
+    """ Static evaluation of a battle still going on from the tables of the winning positions of a BoardGeometry
+    The score adds the value of every winning position, which grows with the tanks and the stacks of soldiers
+    close to becoming tanks on it, to the tank count margin deciding the battles of a full battlefield.
+    """
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        # shifts of the packed cells of every winning position, in the order of the codes of LineValues
+        self.line_shifts = [tuple(pos * CELL_BITS for pos in reversed(line)) for line in geometry.win_positions]
+        self.line_values = LineValues(geometry.win_length)
+        if geometry.win_length <= PRECOMPUTED_WIN_LENGTH:
+            for code in range(1 << (CELL_BITS * geometry.win_length)):
+                self.line_values[code]
+        self.line_weight = LINE_WEIGHT * HEURISTIC_RANGE / len(geometry.win_positions)
+        self.margin_weight = MARGIN_WEIGHT * HEURISTIC_RANGE / geometry.cells
+
+    def evaluate(self, state, marker):
+        """ Return the score of a BoardState for the bot with the ``marker`` tanks, strictly between
+        -HEURISTIC_RANGE and HEURISTIC_RANGE
+        """
+        cells = state.cells
+        line_values = self.line_values
+        lines = 0.0
+        for shifts in self.line_shifts:
+            code = 0
+            for shift in shifts:
+                code = code << CELL_BITS | (cells >> shift) & CELL_MASK
+            lines += line_values[code]
+        margin = bin(state.tanks[state.p1_marker]).count('1') - bin(state.tanks[state.p2_marker]).count('1')
+        score = self.line_weight * lines + self.margin_weight * margin
+        return score if marker == state.p1_marker else -score
+
+
+# Heuristic evaluators built so far by (size, win_length)
+_evaluators = {}
+
+
+def check_evaluator(name):
+    """ Raise a ValueError when ``name`` is not one of EVALUATORS
+    """
+    if name not in EVALUATORS:
+        raise ValueError("Error: The evaluator must be one of {}".format(", ".join(EVALUATORS)))
+
+
+def set_default_evaluator(name):
+    """ Set the evaluator of the searches on tic tac toe battlefields that do not choose one
+    """
+    global DEFAULT_EVALUATOR
+    check_evaluator(name)
+    DEFAULT_EVALUATOR = name
+
+
+def default_evaluator(geometry):
+    """ Return the name of the evaluator of the searches on a battlefield that do not choose one
+    """
+    return DEFAULT_EVALUATOR if geometry.classic else LARGE_BOARD_EVALUATOR
+
+
+def get_evaluator(name, geometry):
+    """ Return the evaluator of a battlefield, None for the TERMINAL one which scores no position
+        :param name: one of EVALUATORS
+        :param geometry: BoardGeometry of the battlefield
+    """
+    if name == TERMINAL:
+        return None
+    check_evaluator(name)
+    key = (geometry.size, geometry.win_length)
+    evaluator = _evaluators.get(key)
+    if evaluator is None:
+        evaluator = _evaluators[key] = HeuristicEvaluator(geometry)
+    return evaluator
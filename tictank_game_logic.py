@@ -1,5 +1,9 @@
-from random import getrandbits, randint, shuffle
-from tictank_db import create_connection, DATABASE_NAME
+import random
+import re
+import sqlite3
+
+from random import getrandbits
+import tictank_db
 
 # Battle tiles
 # DEBRIS_TILE = -1
@@ -10,14 +14,119 @@ PLAY_TILES = [-1, 0, 1, 2, 3, 4]
 # number of player moves per turn
 MAX_MOVES = 2
 
+# Side of the tic tac toe battlefield, won by as many tanks in a row
+DEFAULT_BOARD_SIZE = 3
+# Sides of the square battlefields the games can be played on
+MIN_BOARD_SIZE = 3
+MAX_BOARD_SIZE = 7
+# Shortest row of tanks winning a battle, and the default one of the battlefields larger than it
+MIN_WIN_LENGTH = 3
+DEFAULT_WIN_LENGTH = 4
+
+
+
+def win_lines(size, win_length):
+    """ Return the cells of every row of ``win_length`` cells of a ``size`` by ``size`` battlefield:
+    the horizontal ones, the vertical ones, then the diagonals going down to the right and to the left
+    """
+    span = range(size - win_length + 1)
+    cells = range(win_length)
+    lines = [tuple(row * size + column + i for i in cells) for row in range(size) for column in span]
+    lines += [tuple((row + i) * size + column for i in cells) for column in range(size) for row in span]
+    lines += [tuple((row + i) * size + column + i for i in cells) for row in span for column in span]
+    lines += [tuple((row + i) * size + column - i for i in cells) for row in span
+              for column in range(win_length - 1, size)]
+    return lines
+
+
+class BoardGeometry:
+    """ Square battlefield of ``size`` by ``size`` cells won by ``win_length`` tanks in a row
+    A full battlefield without a winning position is won by the player with more tanks. With an even
+    ``size`` both players can hold half of the cells, that tie goes to the player who moved second, the
+    one who did not get the first troop deployments.
+    The winning positions, the ones going through every cell and their bitmasks are generated once
+    by get_geometry and shared by all the games and searches on the same battlefield
+    """
+
+    def __init__(self, size, win_length):
+        self.size = size
+        self.win_length = win_length
+        self.cells = size * size
+        self.win_positions = win_lines(size, win_length)
+        # indexes of the winning positions going through every cell
+        self.cell_lines = [tuple(line for line, cells in enumerate(self.win_positions) if pos in cells)
+                           for pos in range(self.cells)]
+        self.win_masks = tuple(sum(1 << pos for pos in cells) for cells in self.win_positions)
+        self.full_mask = (1 << self.cells) - 1
+        self.classic = size == win_length == DEFAULT_BOARD_SIZE
+
+    def __repr__(self):
+        return "BoardGeometry({}, {})".format(self.size, self.win_length)
+
+
+# Geometries built so far by (size, win_length)
+_geometries = {}
+
+
+def get_geometry(size=DEFAULT_BOARD_SIZE, win_length=None):
+    """ Return the shared BoardGeometry of a battlefield
+        :param size: side of the battlefield, between MIN_BOARD_SIZE and MAX_BOARD_SIZE
+        :param win_length: tanks in a row winning the battle, by default the side of the battlefield up to
+        DEFAULT_WIN_LENGTH
+    """
+    if win_length is None:
+        win_length = min(size, DEFAULT_WIN_LENGTH)
+    geometry = _geometries.get((size, win_length))
+    if geometry is None:
+        if not MIN_BOARD_SIZE <= size <= MAX_BOARD_SIZE:
+            raise ValueError("Error: The board size must be between {} and {}".format(MIN_BOARD_SIZE,
+                                                                                      MAX_BOARD_SIZE))
+        if not MIN_WIN_LENGTH <= win_length <= size:
+            raise ValueError("Error: The win length must be between {} and the board size".format(MIN_WIN_LENGTH))
+        geometry = _geometries[(size, win_length)] = BoardGeometry(size, win_length)
+    return geometry
+
+
+# Tic tac toe battlefield and its winning positions
+CLASSIC = get_geometry()
+WIN_POSITIONS = CLASSIC.win_positions
+CELL_LINES = CLASSIC.cell_lines
+
+# Starting boards tiles, shuffled at the start of every game, repeated to cover the larger battlefields
+DEBRIS_TILE, EMPTY_TILE, WAR1, WAR2, WAR3, WAR4 = PLAY_TILES
+STARTING_BOARDS = {
+    1: [EMPTY_TILE] * 9,
+    2: [WAR1] * 2 + [WAR2] * 2 + [WAR3] * 1 + [WAR4] * 4,
+    3: [EMPTY_TILE] * 5 + [DEBRIS_TILE] * 4,
+}
+
+# Bits of the seeds drawn for the games played without one
+SEED_BITS = 32
+
+# Versions of the binary replay format written by encode_replay, in the first byte of every replay:
+# tic tac toe battlefields and the other geometries
+REPLAY_VERSION = 1
+REPLAY_GEOMETRY_VERSION = 2
+# Low nibble padding the last byte of a replay with an odd number of moves
+REPLAY_PADDING = 0xF
+# Move history entry in the moves_list of the game results
+MOVES_LIST_ENTRY = re.compile(r"\('(P[12])', (\d+), (-?\d+), (\d+)\)")
+
 
 class GAME:
-    def __init__(self, starting_board, player1, player2):
+    def __init__(self, starting_board, player1, player2, rng=random, geometry=CLASSIC):
         """ Initialize parameters - the board, move history list, players and deployed troops history
+            :param rng: random number generator of the random moves, a random.Random seeded for the game
+            :param geometry: BoardGeometry of the battlefield
         """
+        self.geometry = geometry
         self.board = starting_board
+        self.starting_board = list(starting_board)
+        self.rng = rng
         self.move_history = []
         self.winner = None
+        # troop deployments left in the turn of the player to move
+        self.turn_moves = MAX_MOVES
         self.p1 = player1
         self.p2 = player2
 
@@ -28,6 +137,18 @@ class GAME:
         self.potential_moves = {self.p1.marker: 0,
                                 self.p2.marker: 0}
 
+        # Kept up to date by move and revert_last_move so is_gameover does not scan the board: the tanks of
+        # each player, their tanks on every winning position and the bitmask of their complete positions
+        self.tank_count = {self.p1.marker: 0,
+                           self.p2.marker: 0}
+        self.line_tanks = {self.p1.marker: [0] * len(geometry.win_positions),
+                           self.p2.marker: [0] * len(geometry.win_positions)}
+        self.won_lines = {self.p1.marker: 0,
+                          self.p2.marker: 0}
+        for pos, value in enumerate(self.board):
+            if value in self.tank_count:
+                self.add_tank(pos, value)
+
     def get_available_moves(self):
         """ Returns the list of all available moves
         """
@@ -50,6 +171,7 @@ class GAME:
             # place tank
             self.board[pos] = marker
             self.tanks_deployed[marker] += 1
+            self.add_tank(pos, marker)
         self.potential_moves[marker] += 1
         self.move_history.append((player_id, pos, self.board[pos], marker))
         return marker
@@ -62,41 +184,52 @@ class GAME:
         if value not in PLAY_TILES:
             self.board[index] = PLAY_TILES[-1:][0]
             self.tanks_deployed[marker] -= 1
+            self.remove_tank(index, marker)
         # remove soldier
         else:
             self.board[index] = value - 1
             self.soldiers_deployed[marker] -= 1
         self.winner = None
 
+    def add_tank(self, pos, marker):
+        """ Count a new tank on the winning positions going through its cell
+        """
+        self.tank_count[marker] += 1
+        line_tanks = self.line_tanks[marker]
+        for line in self.geometry.cell_lines[pos]:
+            line_tanks[line] += 1
+            if line_tanks[line] == self.geometry.win_length:
+                self.won_lines[marker] |= 1 << line
+
+    def remove_tank(self, pos, marker):
+        """ Take back a tank from the winning positions going through its cell
+        """
+        self.tank_count[marker] -= 1
+        line_tanks = self.line_tanks[marker]
+        for line in self.geometry.cell_lines[pos]:
+            line_tanks[line] -= 1
+            self.won_lines[marker] &= ~(1 << line)
+
     def is_gameover(self):
         """ Check if the game is over
         """
 
-        # Tic tac toe winning positions
-        win_positions = [
-            (0, 1, 2),
-            (3, 4, 5),
-            (6, 7, 8),
-            (0, 3, 6),
-            (1, 4, 7),
-            (2, 5, 8),
-            (0, 4, 8),
-            (2, 4, 6)
-        ]
-
-        # check tic-tac-toe winning condition
-        for i, j, k in win_positions:
-            if (self.board[i] == self.board[j] == self.board[k]
-                    and self.board[i] in [self.p1.marker, self.p2.marker]):
-                self.winner = self.board[i]
-                return True
+        # check tic-tac-toe winning condition, the first complete winning position decides the winner
+        p1_lines = self.won_lines[self.p1.marker]
+        p2_lines = self.won_lines[self.p2.marker]
+        if p1_lines or p2_lines:
+            lines = p1_lines | p2_lines
+            first_line = lines & -lines
+            self.winner = self.p1.marker if p1_lines & first_line else self.p2.marker
+            return True
         # if no tic-tac-toe winner set winner the player with most tanks deployed
-        p1_tanks = self.board.count(self.p1.marker)
-        p2_tanks = self.board.count(self.p2.marker)
+        p1_tanks = self.tank_count[self.p1.marker]
+        p2_tanks = self.tank_count[self.p2.marker]
         if p1_tanks + p2_tanks == len(self.board):
             if p1_tanks > p2_tanks:
                 self.winner = self.p1.marker
             else:
+                # p2 also wins the tie of the even battlefields, it moved second, see BoardGeometry
                 self.winner = self.p2.marker
             return True
 
@@ -105,43 +238,46 @@ class GAME:
     def play(self):
         """Execute the game play with players
         """
+        for _ in self.play_moves():
+            pass
+
+        # GAME OVER
+        return self.game_results()
+
+    def play_moves(self):
+        """ Execute the game play with players, yielding every move history entry as soon as it is played
+        """
         turn_player = 'turn_p1'
         while not self.is_gameover():
             # moves available for each player's turn
-            turn_moves = MAX_MOVES
+            self.turn_moves = MAX_MOVES
 
-            while turn_moves > 0:
+            while self.turn_moves > 0:
                 if turn_player == 'turn_p1':
                     self.p1.move(self)
                 else:
                     self.p2.move(self)
+                yield self.move_history[-1]
                 # Do not perform remaining moves if the player already won
                 if self.is_gameover():
                     break
-                turn_moves -= 1
+                self.turn_moves -= 1
             # next player turn when current player is out of moves
             turn_player = 'turn_p1' if turn_player == 'turn_p2' else 'turn_p2'
 
-        # GAME OVER
-        return self.game_results()
-
     @staticmethod
-    def add_battle_log(winner, loser, moves_count):
-        connection = create_connection(DATABASE_NAME)
-        cursor = connection.cursor()
+    def add_battle_log(winner, loser, moves_count, replay=None):
         game_data = (winner['name'], winner['soldiers_deployed'], winner['tanks_deployed'],
                      winner['pot_moves'], winner['soldiers_deployed'] + winner['tanks_deployed'],
                      loser['name'], loser['soldiers_deployed'], loser['tanks_deployed'],
                      loser['pot_moves'], loser['soldiers_deployed'] + loser['tanks_deployed'],
-                     moves_count)
-        game_data_str = ','.join(["'{}'".format(element) for element in game_data])
+                     moves_count, sqlite3.Binary(replay) if replay is not None else None)
+        tictank_db.add_battle_log(game_data)
 
-        sql_script = "INSERT INTO battle_log " \
-                     "(winner_name, winner_soldiers, winner_tanks, winner_pot_moves, winner_moves, " \
-                     "loser_name, loser_soldiers, loser_tanks, loser_pot_moves, loser_moves, moves)" \
-                     "VALUES ({})".format(game_data_str)
-        cursor.executescript(sql_script)
-        connection.close()
+    def replay(self):
+        """ Return the game in the binary replay format of encode_replay
+        """
+        return encode_replay(self.starting_board, self.move_history, self.winner == self.p1.marker, self.geometry)
 
     def game_results(self):
         player_1 = {'name': self.p1.name,
@@ -149,18 +285,20 @@ class GAME:
                     'tank': self.p1.marker,
                     'soldiers_deployed': self.soldiers_deployed[self.p1.marker],
                     'tanks_deployed': self.tanks_deployed[self.p1.marker],
-                    'pot_moves': self.potential_moves[self.p1.marker]
+                    'pot_moves': self.potential_moves[self.p1.marker],
+                    'nodes_searched': self.p1.nodes_searched
                     }
         player_2 = {'name': self.p2.name,
                     'iq': self.p2.iq,
                     'tank': self.p2.marker,
                     'soldiers_deployed': self.soldiers_deployed[self.p2.marker],
                     'tanks_deployed': self.tanks_deployed[self.p2.marker],
-                    'pot_moves': self.potential_moves[self.p2.marker]
+                    'pot_moves': self.potential_moves[self.p2.marker],
+                    'nodes_searched': self.p2.nodes_searched
                     }
         moves_count = len(self.move_history)
-        moves_list = ''.join(str(e) for e in self.move_history)
-        ending_board = '/'.join(str(e) for e in self.board)
+        moves_list = format_moves_list(self.move_history)
+        ending_board = format_board(self.board)
 
         if self.p1.marker == self.winner:
             winner, loser = player_1, player_2
@@ -168,7 +306,7 @@ class GAME:
             winner, loser = player_2, player_1
 
         # Write battle results in the database
-        self.add_battle_log(winner, loser, moves_count)
+        self.add_battle_log(winner, loser, moves_count, self.replay())
 
         return {'player_1': player_1,
                 'player_2': player_2,
@@ -179,41 +317,161 @@ class GAME:
                 }
 
 
-def get_starting_board(board_id):
+def format_board(board):
+    """ Return a board as in the game results, its tiles and tanks separated by slashes
+    """
+    return '/'.join(map(str, board))
+
+
+def format_moves_list(moves):
+    """ Return the moves_list of the game results, the move history entries as Python tuples
+    """
+    return ''.join(map(str, moves))
+
+
+def get_starting_board(board_id, rng=random, geometry=CLASSIC):
     """ Return a starting board
         :param board_id: the board's id
+        :param rng: random number generator shuffling the tiles
+        :param geometry: BoardGeometry of the battlefield
     """
-    DEBRIS_TILE, EMPTY_TILE, WAR1, WAR2, WAR3, WAR4 = PLAY_TILES
-    boards = {
-        1: [EMPTY_TILE] * 9,
-        2: [WAR1] * 2 + [WAR2] * 2 + [WAR3] * 1 + [WAR4] * 4,
-        3: [EMPTY_TILE] * 5 + [DEBRIS_TILE] * 4,
-    }
-    board = boards[board_id]
+    tiles = STARTING_BOARDS[board_id]
+    board = [tiles[pos % len(tiles)] for pos in range(geometry.cells)]
     # Randomize the board tiles order on the board
-    shuffle(board)
+    rng.shuffle(board)
     return board
 
 
-def play_game(player1, player2):
+def new_seed():
+    """ Return a seed for a game played without one
+    """
+    return getrandbits(SEED_BITS)
+
+
+def game_random(seed=None):
+    """ Return the random number generator of a game and its seed, a new seed is drawn when not provided
+    """
+    if seed is None:
+        seed = new_seed()
+    return random.Random(seed), seed
+
+
+def draw_game_setup(rng, board_id=None, geometry=CLASSIC):
+    """ Draw the starting board and the starting player of a game
+        :param rng: random number generator of the game
+        :param board_id: optional starting board id, a random one is used by default
+        :param geometry: BoardGeometry of the battlefield
+        :return: (starting board, True when the second player moves first)
+    """
+    # select a random starting board
+    if board_id is None:
+        board_id = rng.randint(1, 3)
+    starting_board = get_starting_board(board_id, rng, geometry)
+    # Randomize to have a random starting player
+    return starting_board, bool(rng.getrandbits(1))
+
+
+def play_game(player1, player2, board_id=None, seed=None, rng=None, geometry=CLASSIC):
     """ Play a game between two AI bot players
         :param player1: AIBot instance
         :param player2: AIBot instance
+        :param board_id: optional starting board id, a random one is used by default
+        :param seed: optional seed of the game, the same seed and players play the same game
+        :param rng: optional random number generator of the game returned by game_random with ``seed``,
+        when the players were drawn with it
+        :param geometry: BoardGeometry of the battlefield
         :return Returns a dict with the game results
 
     """
-    # select a random starting board
-    starting_board = get_starting_board(randint(1, 3))
+    game, data = start_game(player1, player2, board_id=board_id, seed=seed, rng=rng, geometry=geometry)
+    data.update(game.play())
+    return data
+
+
+def start_game(player1, player2, board_id=None, seed=None, rng=None, geometry=CLASSIC):
+    """ Set up a game between two AI bot players without playing it
+        :param player1: AIBot instance
+        :param player2: AIBot instance
+        :param board_id: optional starting board id, a random one is used by default
+        :param seed: optional seed of the game, a new one is drawn by default
+        :param rng: optional random number generator of the game returned by game_random with ``seed``
+        :param geometry: BoardGeometry of the battlefield
+        :return Returns the GAME instance and a dict with the starting board, the battlefield and the seed
+    """
+    if rng is None:
+        rng, seed = game_random(seed)
+    starting_board, swap_players = draw_game_setup(rng, board_id, geometry)
     data = dict()
-    data['starting_board'] = '/'.join(str(e) for e in starting_board)
+    data['starting_board'] = format_board(starting_board)
+    data['board_size'] = geometry.size
+    data['win_length'] = geometry.win_length
+    data['seed'] = seed
 
-    # Randomize to have a random starting player
-    if bool(getrandbits(1)):
+    if swap_players:
         player1, player2 = player2, player1
 
     game = GAME(player1=player1,
                 player2=player2,
-                starting_board=starting_board)
-    data.update(game.play())
-    return data
+                starting_board=starting_board,
+                rng=rng,
+                geometry=geometry)
+    return game, data
+
+
+def add_game_results_log(game_results):
+    """ Write the battle results of a game played before, like a cached one served again
+        :param game_results: dict returned by play_game
+    """
+    player_1, player_2 = game_results['player_1'], game_results['player_2']
+    if player_1['name'] == game_results['winner']:
+        winner, loser = player_1, player_2
+    else:
+        winner, loser = player_2, player_1
+    starting_board = [int(value) for value in game_results['starting_board'].split('/')]
+    moves = [(player_id, int(pos), int(value), int(marker))
+             for player_id, pos, value, marker in MOVES_LIST_ENTRY.findall(game_results['moves_list'])]
+    geometry = get_geometry(game_results.get('board_size', DEFAULT_BOARD_SIZE), game_results.get('win_length'))
+    replay = encode_replay(starting_board, moves, winner is player_1, geometry)
+    GAME.add_battle_log(winner, loser, game_results['moves_count'], replay)
+
+
+def replay_board_bytes(cells):
+    """ Return the number of bytes of the starting board of a replay, a base 6 number of ``cells`` digits
+    """
+    return ((len(PLAY_TILES) ** cells - 1).bit_length() + 7) // 8
+
+
+def encode_replay(starting_board, moves, first_player_won, geometry=CLASSIC):
+    """ Encode a game in a few bytes, the rules of GAME.move give back everything else when replaying it
+    Byte 0 holds the format version shifted left by 2, then a bit set when the player moving first is P2 and
+    a bit set when it won. On tic tac toe battlefields the version is REPLAY_VERSION and bytes 1 to 3 hold the
+    starting board, every cell is a digit of a base 6 number, the tile minus DEBRIS_TILE. The position of
+    every move follows, two moves per byte starting with the high nibble and REPLAY_PADDING after the last
+    one of an odd number of moves. On the other battlefields the version is REPLAY_GEOMETRY_VERSION, byte 1
+    holds the board size in its high nibble and the win length in the low one, the starting board takes
+    replay_board_bytes bytes and every move position a whole byte.
+        :param starting_board: list of the starting tiles
+        :param moves: move history entries (player_id, pos, value, marker), the player moving first first
+        :param first_player_won: True when the player moving first won
+        :param geometry: BoardGeometry of the battlefield
+        :return: bytes of the replay
+    """
+    first_is_p2 = bool(moves) and moves[0][0] == 'P2'
+    version = REPLAY_VERSION if geometry.classic else REPLAY_GEOMETRY_VERSION
+    data = bytearray([version << 2 | first_is_p2 << 1 | bool(first_player_won)])
+    if not geometry.classic:
+        data.append(geometry.size << 4 | geometry.win_length)
+    board_code = 0
+    for tile in starting_board:
+        board_code = board_code * len(PLAY_TILES) + tile - DEBRIS_TILE
+    board_bytes = replay_board_bytes(geometry.cells)
+    data.extend(board_code >> (8 * i) & 0xFF for i in reversed(range(board_bytes)))
+    positions = [pos for _, pos, _, _ in moves]
+    if not geometry.classic:
+        data.extend(positions)
+        return bytes(data)
+    if len(positions) % 2:
+        positions.append(REPLAY_PADDING)
+    data.extend(positions[i] << 4 | positions[i + 1] for i in range(0, len(positions), 2))
+    return bytes(data)
 
@@ -0,0 +1,167 @@
+import os
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the search depth histogram buckets, one per thinking_depth
+DEPTH_BUCKETS = (0, 1, 2, 3, 4, 5, 6)
+
+# Metrics recorded by the server and its worker processes: name: (type, help, histogram buckets)
+METRIC_TYPES = {
+    'tictank_http_requests_total': ('counter', "Requests answered by handler and status code", None),
+    'tictank_http_request_duration_seconds': ('histogram', "Time to answer a request by handler",
+                                              LATENCY_BUCKETS),
+    'tictank_search_moves_total': ('counter', "Moves decided by the bots by thinking depth", None),
+    'tictank_search_nodes_total': ('counter', "Positions expanded by the searches by thinking depth", None),
+    'tictank_search_move_seconds': ('histogram', "Time to decide a move by thinking depth", LATENCY_BUCKETS),
+    'tictank_search_depth_reached': ('histogram', "Deepest finished search level of a move by thinking depth",
+                                     DEPTH_BUCKETS),
+    'tictank_db_query_seconds': ('histogram', "Time of the database queries by query", LATENCY_BUCKETS),
+    'tictank_db_commit_seconds': ('histogram', "Time of the battle log transactions", LATENCY_BUCKETS),
+    'tictank_battle_log_rows_total': ('counter', "Battle results written to the battle_log table", None),
+    'tictank_scheduler_rejected_total': ('counter', "Game requests refused by the game scheduler by reason", None),
+    'tictank_scheduler_wait_seconds': ('histogram', "Time the games waited in the game scheduler queue",
+                                       LATENCY_BUCKETS),
+}
+
+
+class MetricsRegistry:
+    """ Counters and histograms in the Prometheus text format, without the prometheus_client dependency
+    The metrics are only recorded once ``sample_every`` is set. With ``sample_every`` N, the callers of
+    ``sample`` record one event in N with a weight of N, so the totals stay estimates of the real ones for
+    a fraction of the cost. Every process records its own metrics: the game workers hand theirs over with
+    the result of every game, see ``collect_metrics``, and the server merges them in its own.
+    """
+
+    def __init__(self, sample_every=0):
+        self.sample_every = sample_every
+        # events seen by sample, the threads may miss a few of them which only shifts the sampled ones
+        self.events = 0
+        self.lock = threading.Lock()
+        # (name, sorted label items): counter value or histogram [count of every bucket..., sum, count]
+        self.values = {}
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.sample_every > 0
+
+    def sample(self):
+        """ Return the weight of the next event, 0 when it is not recorded
+        """
+        if not self.sample_every:
+            return 0
+        self.events += 1
+        if self.events % self.sample_every:
+            return 0
+        return self.sample_every
+
+    def process_values(self):
+        """ Return the values of the current process, a forked process does not count the metrics of its parent
+        """
+        if self.pid != os.getpid():
+            self.values = {}
+            self.pid = os.getpid()
+        return self.values
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.process_values()
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, weight=1, **labels):
+        """ Add ``weight`` observations of ``value`` to a histogram
+        """
+        buckets = METRIC_TYPES[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        index = len(buckets)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            values = self.process_values()
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = [0] * (len(buckets) + 3)
+            histogram[index] += weight
+            histogram[-2] += value * weight
+            histogram[-1] += weight
+
+    def take(self):
+        """ Return the values recorded since the last call and start again from zero
+        """
+        with self.lock:
+            values = self.process_values()
+            self.values = {}
+        return values
+
+    def merge(self, values):
+        """ Add the values taken from another process
+        """
+        with self.lock:
+            own_values = self.process_values()
+            for key, value in values.items():
+                if isinstance(value, list):
+                    histogram = own_values.get(key)
+                    if histogram is None:
+                        own_values[key] = list(value)
+                    else:
+                        for i, count in enumerate(value):
+                            histogram[i] += count
+                else:
+                    own_values[key] = own_values.get(key, 0) + value
+
+    def exposition(self, readings=()):
+        """ Return the metrics in the Prometheus text format
+            :param readings: list of (name, type, help, value) of the metrics read when scraping
+        """
+        with self.lock:
+            values = dict((key, list(value) if isinstance(value, list) else value)
+                          for key, value in self.process_values().items())
+        lines = []
+        for name in sorted(METRIC_TYPES):
+            metric_type, help_text, buckets = METRIC_TYPES[name]
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for (key_name, labels), value in sorted(values.items()):
+                if key_name != name:
+                    continue
+                if metric_type == 'counter':
+                    lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, format_labels(labels + (('le', bound),)),
+                                                         format_value(cumulative)))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(value[-2])))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), format_value(value[-1])))
+        for name, metric_type, help_text, value in readings:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            lines.append("{} {}".format(name, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in labels) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metrics of the process, enabled by the server
+METRICS = MetricsRegistry()
+
+
+def collect_metrics(fn, *args, **kwargs):
+    """ Run ``fn`` in a worker process
+        :return: (result of ``fn``, metrics recorded by the process since the last call)
+    """
+    result = fn(*args, **kwargs)
+    return result, METRICS.take()
@@ -0,0 +1,193 @@
+import logging
+import os
+import threading
+import traceback
+
+from multiprocessing import Array, Pool, cpu_count
+
+from tictank_search import INFINITY, AlphaBetaSearch
+from tictank_state import BOARD_CELLS, BoardState
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Shallower searches take less time than handing them to the worker processes
+PARALLEL_SEARCH_MIN_DEPTH = 4
+# Searches at least this deep split the second level of the tree when there are less root moves than processes
+SPLIT_SECOND_PLY_DEPTH = 5
+
+# Bounds shared with the worker processes: the best root score found so far, the index of its move and the
+# lowest score of the answers to every root move. Set in the workers by the pool initializer.
+BEST_SCORE, BEST_INDEX, ANSWER_SCORES = 0, 1, 2
+_shared_bounds = None
+
+
+def _init_worker(shared_bounds):
+    global _shared_bounds
+    _shared_bounds = shared_bounds
+
+
+def _search_task(task):
+    """ Search the subtree below one or two moves in a worker process
+    The window starts at the best root score shared by the other tasks, just below it when the root
+    move comes before the best one, so the first available move still wins the ties. An answer to a root
+    move only matters when it scores lower than the answers searched before it, and not at all once the
+    root move can not beat the best one.
+        :param task: (root index, board, p1 marker, p2 marker, marker, opponent marker, moves, depth)
+        :return: (root index, score, nodes searched), the score is None and the nodes are the traceback
+        when the search failed
+    """
+    index, board, p1_marker, p2_marker, marker, opponentmarker, moves, depth = task
+    try:
+        with _shared_bounds.get_lock():
+            best_score, best_index = _shared_bounds[BEST_SCORE], _shared_bounds[BEST_INDEX]
+            beta = _shared_bounds[ANSWER_SCORES + index]
+        alpha = best_score if index > best_index else best_score - 0.5
+        if beta <= alpha:
+            return index, beta, 0
+        search = AlphaBetaSearch(marker=marker, opponentmarker=opponentmarker)
+        state = BoardState(board, p1_marker, p2_marker)
+        for m in moves:
+            state.make_move(m, marker)
+        # the level after the root move is minimizing, the ones below it are maximizing
+        score = search.value(state, depth, maximizing=len(moves) > 1, alpha=alpha, beta=beta)
+        with _shared_bounds.get_lock():
+            if score < _shared_bounds[ANSWER_SCORES + index]:
+                _shared_bounds[ANSWER_SCORES + index] = score
+        return index, score, search.nodes
+    except Exception:
+        # the parent waits for every task, so the failure is handed over instead of raised in the pool
+        return index, None, traceback.format_exc()
+
+
+class ParallelSearch:
+    """ Splits the search of a move across worker processes, each one with its own board and transposition table
+    Every root move is a task, or every root move and answer when there are more processes than root moves.
+    A root move scores the lowest score of its answers. The tasks share the best root score found so far and
+    the lowest answer to every root move, a task only needs the exact score when it can change them, so the
+    workers prune with the results of the others.
+    The tasks wait for their elder brothers: the first root move is searched before the other ones and the
+    first answer to a root move before the other answers, so the tasks searched at the same time start with
+    bounds instead of an open window. The chosen move is the one of the sequential
+    ``AlphaBetaSearch.best_move`` finishing its full depth.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self.shared_bounds = Array('d', ANSWER_SCORES + BOARD_CELLS)
+        self.pool = Pool(self.processes, initializer=_init_worker, initargs=(self.shared_bounds,))
+        # one search at a time shares the bounds, the others search in their own process
+        self.lock = threading.Lock()
+        self.closed = False
+        self.pid = os.getpid()
+
+    def tasks(self, state, marker, opponentmarker, depth):
+        """ Return the list of tasks of every root move
+        """
+        board = state.to_board()
+        task_data = (board, state.p1_marker, state.p2_marker, marker, opponentmarker)
+        moves = state.available_moves()
+        split = depth >= SPLIT_SECOND_PLY_DEPTH and len(moves) < self.processes
+        tasks = []
+        for index, m in enumerate(moves):
+            answers = ()
+            if split:
+                state.make_move(m, marker)
+                answers = state.available_moves()
+                state.unmake_move(m)
+            if answers:
+                tasks.append([(index,) + task_data + ((m, answer), depth - 2) for answer in answers])
+            else:
+                tasks.append([(index,) + task_data + ((m,), depth - 1)])
+        return tasks
+
+    def best_move(self, gameinstance, marker, opponentmarker, depth):
+        """ Return the best move of the bot with the ``marker`` tanks, or None if the pool is busy
+            :param gameinstance: The game instance
+            :param depth: Maximum number of search in the tree before aborting
+            :return: (move, nodes searched)
+        """
+        if self.closed or not self.lock.acquire(False):
+            return None
+        try:
+            state = BoardState.from_game(gameinstance)
+            moves = state.available_moves()
+            if not moves:
+                return (-1, -1), 0
+            tasks = self.tasks(state, marker, opponentmarker, depth)
+            best_score, best_index = -INFINITY, len(moves)
+            with self.shared_bounds.get_lock():
+                self.shared_bounds[:] = [best_score, best_index] + [INFINITY] * BOARD_CELLS
+            # the moves made before handing the tasks over count like in the sequential search
+            nodes = len(moves) + sum(len(root_tasks) for root_tasks in tasks if len(root_tasks[0][6]) > 1)
+            pending = [len(root_tasks) for root_tasks in tasks]
+            scores = [INFINITY] * len(moves)
+            results = queue.Queue()
+            running = self.submit(tasks[0][:1], results)
+            while running:
+                index, score, task_nodes = results.get()
+                running -= 1
+                if score is None:
+                    self.fail(task_nodes)
+                    return None
+                nodes += task_nodes
+                scores[index] = min(scores[index], score)
+                pending[index] -= 1
+                if pending[index] == len(tasks[index]) - 1:
+                    # the first answer is known, the other answers to the root move can start
+                    running += self.submit(tasks[index][1:], results)
+                if pending[index]:
+                    continue
+                if index == 0:
+                    running += self.submit([root_tasks[0] for root_tasks in tasks[1:]], results)
+                if scores[index] > best_score or (scores[index] == best_score and index < best_index):
+                    best_score, best_index = scores[index], index
+                    with self.shared_bounds.get_lock():
+                        self.shared_bounds[BEST_SCORE] = best_score
+                        self.shared_bounds[BEST_INDEX] = best_index
+            return moves[best_index], nodes
+        finally:
+            self.lock.release()
+
+    def submit(self, tasks, results):
+        """ Send tasks to the worker processes, their results are put on the ``results`` queue
+            :return: The number of tasks sent
+        """
+        for task in tasks:
+            self.pool.apply_async(_search_task, (task,), callback=results.put)
+        return len(tasks)
+
+    def fail(self, error):
+        """ Stop the worker processes after a failed task, the bots search in their own process from now on
+        """
+        logging.error("Parallel search failed, searching sequentially from now on:\n{}".format(error))
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.pool.terminate()
+        self.pool.join()
+
+
+# Parallel search of the process, started by the server when a number of search processes is set
+SEARCH_POOL = None
+
+
+def start_search_pool(processes=None):
+    """ Start the worker processes sharing the searches of the bots of this process
+    """
+    global SEARCH_POOL
+    SEARCH_POOL = ParallelSearch(processes)
+    logging.debug("Parallel search started with {} processes".format(SEARCH_POOL.processes))
+    return SEARCH_POOL
+
+
+def get_search_pool():
+    """ Return the parallel search of the process, or None when the bots search sequentially
+    Processes forked after the pool was started, like the game workers, do not share it
+    """
+    if SEARCH_POOL is None or SEARCH_POOL.pid != os.getpid():
+        return None
+    return SEARCH_POOL
@@ -0,0 +1,109 @@
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from multiprocessing import cpu_count
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import tictank_game_logic
+from tictank_ai_logic import get_ai_players
+from tictank_game_logic import DEFAULT_BOARD_SIZE, game_random, get_geometry
+from tictank_metrics import METRICS, collect_metrics
+
+# Default number of games waiting for or running in the worker processes before new ones are refused
+DEFAULT_QUEUE_SIZE = 64
+# Default number of seconds a game may take before the request gives up on it
+DEFAULT_GAME_TIMEOUT = 30
+
+
+class PoolSaturatedError(Exception):
+    """ Raised when the game pool queue is full
+    """
+
+
+def run_game(p1_id=None, p2_id=None, move_time=None, seed=None, board_size=DEFAULT_BOARD_SIZE, win_length=None):
+    """ Play a game in a worker process between the bots with the given ids
+    If the player ids are not provided the game is played between random AI players
+        :param p1_id: Player 1's id
+        :param p2_id: Player 2's id
+        :param move_time: optional number of seconds the bots may think per move
+        :param seed: optional seed of the game, the random AI players are drawn from it too
+        :param board_size: side of the battlefield
+        :param win_length: optional number of tanks in a row winning the battle, see get_geometry
+        :return Returns a dict with the game results
+    """
+    rng, seed = game_random(seed)
+    player1, player2 = get_ai_players(p1_id=p1_id, p2_id=p2_id, move_time=move_time, rng=rng)
+    return tictank_game_logic.play_game(player1, player2, seed=seed, rng=rng,
+                                        geometry=get_geometry(board_size, win_length))
+
+
+class GamePool:
+    """ Runs the games in a pool of worker processes so the IOLoop stays free for the other requests
+    """
+
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_GAME_TIMEOUT):
+        self.workers = workers or cpu_count()
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def is_saturated(self):
+        return self.pending >= self.queue_size
+
+    def submit(self, fn, *args, **kwargs):
+        """ Run ``fn`` in a worker process and return its result
+        Raises PoolSaturatedError when the queue is full and tornado.gen.TimeoutError when the
+        result is not ready in time. A game that timed out still holds its queue place until it ends, the
+        ``running`` attribute of the TimeoutError is the future of the game in the worker process.
+        """
+        return self.submit_with_timeout(self.timeout, fn, *args, **kwargs)
+
+    @gen.coroutine
+    def submit_with_timeout(self, timeout, fn, *args, **kwargs):
+        """ Like ``submit`` for work that needs another timeout than a single game, in seconds
+        """
+        if self.is_saturated():
+            raise PoolSaturatedError("{} games are already queued".format(self.pending))
+        self.pending += 1
+        running = self.executor.submit(collect_metrics, fn, *args, **kwargs)
+        IOLoop.current().add_future(running, self.release)
+        future = running
+        if timeout:
+            future = gen.with_timeout(timedelta(seconds=timeout), running)
+        try:
+            result, _ = yield future
+        except gen.TimeoutError as e:
+            e.running = running
+            raise
+        raise gen.Return(result)
+
+    def release(self, future):
+        self.pending -= 1
+        if future.exception() is not None:
+            logging.debug("Game failed in the worker process: {}".format(future.exception()))
+            return
+        # the metrics of the worker are counted even when the request stopped waiting for the game
+        METRICS.merge(future.result()[1])
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+# Game pool of the process, started by the server
+GAME_POOL = None
+
+
+def start_game_pool(workers=None, queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_GAME_TIMEOUT):
+    """ Create the worker processes that play the games of this process
+    """
+    global GAME_POOL
+    GAME_POOL = GamePool(workers=workers, queue_size=queue_size, timeout=timeout)
+    return GAME_POOL
+
+
+def get_game_pool():
+    return GAME_POOL
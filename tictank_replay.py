@@ -0,0 +1,158 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import sys
+
+from collections import namedtuple
+
+from tictank_ai_logic import TANK_P1, TANK_P2
+from tictank_db import DATABASE_NAME, get_connection
+from tictank_game_logic import CLASSIC, DEBRIS_TILE, GAME, MAX_MOVES, PLAY_TILES, REPLAY_GEOMETRY_VERSION, \
+    REPLAY_PADDING, REPLAY_VERSION, format_board, format_moves_list, get_geometry, replay_board_bytes
+
+# Battle results read from the database at once by the export
+EXPORT_BATCH = 10000
+
+ReplayPlayer = namedtuple('ReplayPlayer', ['player_id', 'marker'])
+
+
+def read_replay(data):
+    """ Read the fields of a replay of encode_replay without playing its moves
+        :param data: bytes of the replay
+        :return: (BoardGeometry, True when P2 moves first, True when the player moving first won, starting board,
+        list of the move positions)
+    """
+    data = bytearray(data)
+    version = data[0] >> 2 if data else None
+    if version == REPLAY_VERSION:
+        geometry = CLASSIC
+        start = 1
+    elif version == REPLAY_GEOMETRY_VERSION:
+        geometry = get_geometry(data[1] >> 4, data[1] & 0xF)
+        start = 2
+    else:
+        raise ValueError("Error: Unknown replay format")
+    first_is_p2 = bool(data[0] >> 1 & 1)
+    first_player_won = bool(data[0] & 1)
+    end = start + replay_board_bytes(geometry.cells)
+    board_code = 0
+    for byte in data[start:end]:
+        board_code = board_code << 8 | byte
+    starting_board = []
+    for _ in range(geometry.cells):
+        board_code, tile = divmod(board_code, len(PLAY_TILES))
+        starting_board.append(tile + DEBRIS_TILE)
+    starting_board.reverse()
+    if version == REPLAY_GEOMETRY_VERSION:
+        positions = list(data[end:])
+    else:
+        positions = []
+        for byte in data[end:]:
+            positions.append(byte >> 4)
+            if byte & 0xF != REPLAY_PADDING:
+                positions.append(byte & 0xF)
+    return geometry, first_is_p2, first_player_won, starting_board, positions
+
+
+def decode_replay(data):
+    """ Decode a replay of encode_replay and play its moves again with the rules of GAME.move
+        :param data: bytes of the replay
+        :return: dict with the board size and win length, the starting board, the id of the player moving
+        first (P1 or P2), whether it won, the move history entries and the ending board
+    """
+    geometry, first_is_p2, first_player_won, starting_board, positions = read_replay(data)
+    p1, p2 = ReplayPlayer('P1', TANK_P1), ReplayPlayer('P2', TANK_P2)
+    first, second = (p2, p1) if first_is_p2 else (p1, p2)
+    game = GAME(list(starting_board), first, second, geometry=geometry)
+    for index, pos in enumerate(positions):
+        player = first if index // MAX_MOVES % 2 == 0 else second
+        game.move(player.player_id, player.marker, pos)
+    return {'board_size': geometry.size,
+            'win_length': geometry.win_length,
+            'starting_board': starting_board,
+            'first_player': first.player_id,
+            'first_player_won': first_player_won,
+            'moves': game.move_history,
+            'ending_board': game.board}
+
+
+def get_battle(battle_id, db_file=DATABASE_NAME):
+    """ Return the (id, winner name, loser name, created_at, replay) of a battle_log row or None
+    """
+    return get_connection(db_file).execute("SELECT id, winner_name, loser_name, created_at, replay FROM battle_log "
+                                           "WHERE id = ?", (battle_id,)).fetchone()
+
+
+def replay_records(battle):
+    """ Return the records of a replayed game in the /stream_game format: the players and starting board,
+    every move and the results
+        :param battle: row returned by get_battle, with a replay
+    """
+    battle_id, winner_name, loser_name, created_at, replay = battle
+    game = decode_replay(replay)
+    first_name, second_name = (winner_name, loser_name) if game['first_player_won'] else (loser_name, winner_name)
+    first_tank, second_tank = (TANK_P2, TANK_P1) if game['first_player'] == 'P2' else (TANK_P1, TANK_P2)
+    records = [{'id': battle_id,
+                'created_at': created_at,
+                'starting_board': format_board(game['starting_board']),
+                'board_size': game['board_size'],
+                'win_length': game['win_length'],
+                'player_1': {'name': first_name, 'tank': first_tank},
+                'player_2': {'name': second_name, 'tank': second_tank}}]
+    for player_id, pos, value, marker in game['moves']:
+        records.append({'player_id': player_id, 'pos': pos, 'value': value, 'tank': marker})
+    records.append({'moves_list': format_moves_list(game['moves']),
+                    'moves_count': len(game['moves']),
+                    'ending_board': format_board(game['ending_board']),
+                    'winner': winner_name})
+    return records
+
+
+def export_games(output, from_id=0, limit=None, db_file=DATABASE_NAME):
+    """ Write the games of battle_log with a replay as newline delimited JSON, one game per line
+        :param output: file object
+        :param from_id: only export the games with a greater id
+        :param limit: optional maximum number of games
+        :return: The number of games written
+    """
+    connection = get_connection(db_file)
+    written = 0
+    while limit is None or written < limit:
+        batch = EXPORT_BATCH if limit is None else min(EXPORT_BATCH, limit - written)
+        rows = connection.execute("SELECT id, winner_name, loser_name, created_at, replay FROM battle_log "
+                                  "WHERE id > ? AND replay IS NOT NULL ORDER BY id LIMIT ?",
+                                  (from_id, batch)).fetchall()
+        if not rows:
+            break
+        for battle_id, winner_name, loser_name, created_at, replay in rows:
+            game = decode_replay(replay)
+            output.write(json.dumps({'id': battle_id,
+                                     'created_at': created_at,
+                                     'winner': winner_name,
+                                     'loser': loser_name,
+                                     'first_player': winner_name if game['first_player_won'] else loser_name,
+                                     'board_size': game['board_size'],
+                                     'win_length': game['win_length'],
+                                     'starting_board': game['starting_board'],
+                                     'moves': game['moves'],
+                                     'ending_board': game['ending_board']}) + "\n")
+        written += len(rows)
+        from_id = rows[-1][0]
+    return written
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export the games of the battle log with their moves as NDJSON")
+    parser.add_argument("--output", default="-", help="file to write, - for the standard output")
+    parser.add_argument("--from_id", type=int, default=0, help="only export the games with a greater battle log id")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.output == "-":
+        export_games(sys.stdout, args.from_id, args.limit)
+    else:
+        with open(args.output, 'w') as output:
+            games = export_games(output, args.from_id, args.limit)
+        logging.info("{} games written to {}".format(games, args.output))
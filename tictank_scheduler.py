@@ -0,0 +1,293 @@
+import heapq
+import math
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from tictank_ai_logic import LARGE_BOARD_MOVE_TIME, AIBot
+from tictank_db import get_bot_registry
+from tictank_game_logic import CLASSIC, MAX_MOVES
+from tictank_metrics import METRICS
+
+# Estimated seconds a bot of every thinking_depth spends on a tic tac toe game
+BOT_GAME_COSTS = {0: 0.00025, 1: 0.00055, 2: 0.0013, 3: 0.0027, 4: 0.013, 5: 0.067, 6: 0.34}
+# Moves of a bot in a game by cell of the battlefield, on the larger battlefields the bots think for
+# the move time on every move
+BOT_MOVES_PER_CELL = 2.25
+# Estimated seconds of serving a request besides its games
+REQUEST_COST = 0.001
+# Weight of the last game in the measured ratio between the game durations and their estimated costs
+SPEED_SMOOTHING = 0.05
+# Bounds of the measured ratio, a single stalled game does not stop the admissions
+MIN_SPEED = 0.1
+MAX_SPEED = 10.0
+
+# Default seconds of estimated game time every client may use per second, and may save up to use at once
+DEFAULT_CLIENT_RATE = 1.0
+DEFAULT_CLIENT_BURST = 10.0
+# Default rate and burst of the batch requests of a client, like /simulate. They have a token bucket of their
+# own, so a bulk simulation does not use up the single games of the client, and a burst a few hundred games
+# of random bots fit in
+DEFAULT_BATCH_RATE = 1.0
+DEFAULT_BATCH_BURST = 300.0
+# Default estimated seconds a request may wait for the game workers before it is refused
+DEFAULT_MAX_WAIT = 10.0
+# Clients remembered before the ones with a full token bucket and no queued game are forgotten
+MAX_CLIENTS = 1024
+
+
+class AdmissionError(Exception):
+    """ Raised when a request is refused, ``retry_after`` is the estimated number of whole seconds before it
+    would not be
+    """
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+
+class RateLimitedError(AdmissionError):
+    """ Raised when the client used its share of the game workers
+    """
+
+
+class OverloadedError(AdmissionError):
+    """ Raised when the games queued for the game workers would make the request wait too long
+    """
+
+
+def bot_game_cost(iq, geometry=CLASSIC, move_time=None):
+    """ Return the estimated seconds a bot spends on a game
+        :param iq: bot iq, the thinking_depth of the bot is derived from it
+        :param geometry: BoardGeometry of the battlefield
+        :param move_time: optional number of seconds the bot may think per move
+    """
+    depth = AIBot.get_thinking_depth(iq)
+    moves = BOT_MOVES_PER_CELL * geometry.cells
+    if depth == 0:
+        # the random moves do not think, the game only lasts longer
+        return BOT_GAME_COSTS[0] * geometry.cells / CLASSIC.cells
+    if not geometry.classic:
+        return moves * (move_time or LARGE_BOARD_MOVE_TIME)
+    if move_time is not None:
+        return min(BOT_GAME_COSTS[depth], moves * move_time)
+    return BOT_GAME_COSTS[depth]
+
+
+def estimate_game_cost(p1_id=None, p2_id=None, geometry=CLASSIC, move_time=None):
+    """ Return the estimated seconds of a game between the bots with the given ids, without the ids the
+    average cost of the bots of each team
+    """
+    registry = get_bot_registry()
+    if p1_id is None and p2_id is None:
+        cost = 0.0
+        for team in (0, 1):
+            bots = registry.get_team_bots(team)
+            if bots:
+                cost += sum(bot_game_cost(iq, geometry, move_time) for _, iq in bots) / len(bots)
+        return cost
+    return sum(bot_game_cost(registry.get_bot(bot_id)[1], geometry, move_time) for bot_id in (p1_id, p2_id))
+
+
+def estimate_turn_cost(bot_id, geometry=CLASSIC):
+    """ Return the estimated seconds of the MAX_MOVES troop deployments of a turn of the bot with the given id
+    """
+    iq = get_bot_registry().get_bot(bot_id)[1]
+    return bot_game_cost(iq, geometry) * MAX_MOVES / (BOT_MOVES_PER_CELL * geometry.cells)
+
+
+class GameScheduler:
+    """ Admission control and fair scheduling of the games sent to the game pool
+    Every request is charged its estimated cost, in seconds of a game worker, on the token bucket of its
+    client: a client may use ``rate`` seconds per second and save up to ``burst`` seconds. The batch requests
+    are charged on a second bucket of the client, with ``batch_rate`` and ``batch_burst``. A request is refused
+    when the bucket is short of its cost or when the games queued before it would make it wait longer than
+    ``max_wait``. A rate or ``max_wait`` of 0 disables that check.
+
+    The admitted games wait in a single queue ordered by virtual finish times (self-clocked fair queuing): a game
+    is tagged with its cost after the previous game of the same client, so a client queuing many expensive games
+    only delays its own. At most ``slots`` games are sent to the game pool at once, the order of the games is the
+    one of this queue and not the one of the pool.
+
+    The measured durations of the games correct the estimated costs of the next ones by the ``speed`` ratio.
+    """
+
+    def __init__(self, slots, queue_size, rate=DEFAULT_CLIENT_RATE, burst=DEFAULT_CLIENT_BURST,
+                 max_wait=DEFAULT_MAX_WAIT, batch_rate=DEFAULT_BATCH_RATE, batch_burst=DEFAULT_BATCH_BURST):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.batch_rate = batch_rate
+        self.batch_burst = batch_burst
+        # measured game durations over their estimated costs
+        self.speed = 1.0
+        # games sent to the game pool and the sum of their estimated costs
+        self.running = 0
+        self.running_cost = 0.0
+        # heap of the queued games: (finish tag, order, client, cost, future)
+        self.queue = []
+        self.queued_cost = 0.0
+        self.order = 0
+        # finish tag of the last game sent to the game pool
+        self.virtual_time = 0.0
+        # client: finish tag of its last queued game
+        self.finish_tags = {}
+        # client: (tokens, time of the tokens), of the single games and of the batch requests
+        self.buckets = {}
+        self.batch_buckets = {}
+
+    def estimate(self, game_cost, games=1):
+        """ Return the estimated cost of a request playing ``games`` games of ``game_cost`` seconds
+        """
+        return game_cost * games * self.speed + REQUEST_COST
+
+    def admit(self, client, cost, batch=False):
+        """ Charge the estimated cost of a request to the token bucket of the client
+        Raises RateLimitedError or OverloadedError when the request is refused
+            :param client: key of the client, like its address
+            :param cost: estimated seconds of the request
+            :param batch: charge the bucket of the batch requests of the client
+        """
+        now = time.time()
+        if batch:
+            rate, burst, buckets = self.batch_rate, self.batch_burst, self.batch_buckets
+        else:
+            rate, burst, buckets = self.rate, self.burst, self.buckets
+        if rate > 0:
+            tokens, updated = buckets.get(client, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            # a request costing more than the burst is admitted with a full bucket, which then goes in debt
+            needed = min(cost, burst)
+            if tokens < needed:
+                buckets[client] = (tokens, now)
+                self.rejected('rate_limited')
+                raise RateLimitedError("{:.3f} seconds of games left to the client".format(tokens),
+                                       (needed - tokens) / rate)
+        if self.running + len(self.queue) >= self.queue_size:
+            self.rejected('queue_full')
+            raise OverloadedError("{} games are already queued".format(self.running + len(self.queue)),
+                                  self.estimated_wait(client, cost))
+        if self.max_wait > 0:
+            wait = self.estimated_wait(client, cost)
+            if wait > self.max_wait:
+                self.rejected('overloaded')
+                raise OverloadedError("The estimated wait is {:.3f} seconds".format(wait), wait - self.max_wait)
+        if rate > 0:
+            buckets[client] = (tokens - cost, now)
+            if len(buckets) > MAX_CLIENTS:
+                self.forget_clients(buckets, rate, burst, now)
+
+    def estimated_wait(self, client, cost):
+        """ Return the estimated seconds before a new game of the client would be sent to the game pool:
+        the games of the other clients queued before it and the running ones, shared between the slots
+        """
+        if self.running < self.slots and not self.queue:
+            return 0.0
+        tag = self.finish_tag(client, cost)
+        ahead = sum(entry[3] for entry in self.queue if entry[0] <= tag)
+        return (ahead + self.running_cost) / self.slots
+
+    def finish_tag(self, client, cost):
+        return max(self.virtual_time, self.finish_tags.get(client, 0.0)) + cost
+
+    def rejected(self, reason):
+        if METRICS.enabled:
+            METRICS.inc('tictank_scheduler_rejected_total', reason=reason)
+
+    def forget_clients(self, buckets, rate, burst, now):
+        """ Forget the clients with a full token bucket and no queued game, they are the same as new clients
+        """
+        for client, (tokens, updated) in list(buckets.items()):
+            if tokens + (now - updated) * rate >= burst and self.finish_tags.get(client, 0.0) <= self.virtual_time:
+                del buckets[client]
+                self.finish_tags.pop(client, None)
+
+    @gen.coroutine
+    def run(self, client, cost, fn, *args, **kwargs):
+        """ Wait for the turn of the game in the queue, then return the result of ``fn``, the function
+        sending the game to the game pool
+            :param client: key of the client, like its address
+            :param cost: estimated seconds of the game
+        """
+        yield self.acquire(client, cost)
+        started = time.time()
+        running = None
+        try:
+            result = yield fn(*args, **kwargs)
+            self.measure(cost, time.time() - started)
+        except gen.TimeoutError as e:
+            # the game that timed out keeps its slot until it ends in the game worker
+            running = getattr(e, 'running', None)
+            raise
+        finally:
+            if running is not None and not running.done():
+                IOLoop.current().add_future(running, lambda future: self.release(cost))
+            else:
+                self.release(cost)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def acquire(self, client, cost):
+        """ Wait for the turn of a game in the queue and take its slot, freed with ``release``
+            :param client: key of the client, like its address
+            :param cost: estimated seconds of the game
+        """
+        if self.running < self.slots and not self.queue:
+            self.running += 1
+            self.running_cost += cost
+        else:
+            tag = self.finish_tags[client] = self.finish_tag(client, cost)
+            future = Future()
+            heapq.heappush(self.queue, (tag, self.order, client, cost, future))
+            self.order += 1
+            self.queued_cost += cost
+            queued = time.time()
+            yield future
+            if METRICS.enabled:
+                METRICS.observe('tictank_scheduler_wait_seconds', time.time() - queued)
+
+    def release(self, cost):
+        """ Free the slot of a finished game and send the next queued ones to the game pool
+        """
+        self.running -= 1
+        self.running_cost -= cost
+        self.dispatch()
+
+    def measure(self, cost, seconds):
+        """ Correct the speed ratio with the duration of a game
+        """
+        ratio = min(max(seconds / (cost / self.speed), MIN_SPEED), MAX_SPEED)
+        self.speed += SPEED_SMOOTHING * (ratio - self.speed)
+
+    def dispatch(self):
+        """ Send the first queued games to the game pool while there are free slots
+        """
+        while self.running < self.slots and self.queue:
+            tag, _, client, cost, future = heapq.heappop(self.queue)
+            self.virtual_time = tag
+            self.queued_cost -= cost
+            self.running += 1
+            self.running_cost += cost
+            future.set_result(None)
+
+
+# Game scheduler of the process, started by the server
+GAME_SCHEDULER = None
+
+
+def start_game_scheduler(slots, queue_size, rate=DEFAULT_CLIENT_RATE, burst=DEFAULT_CLIENT_BURST,
+                         max_wait=DEFAULT_MAX_WAIT, batch_rate=DEFAULT_BATCH_RATE, batch_burst=DEFAULT_BATCH_BURST):
+    """ Create the scheduler of the games sent to the game pool of this process
+    """
+    global GAME_SCHEDULER
+    GAME_SCHEDULER = GameScheduler(slots, queue_size, rate=rate, burst=burst, max_wait=max_wait,
+                                   batch_rate=batch_rate, batch_burst=batch_burst)
+    return GAME_SCHEDULER
+
+
+def get_game_scheduler():
+    return GAME_SCHEDULER
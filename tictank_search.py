@@ -0,0 +1,347 @@
+import time
+
+from tictank_evaluation import TERMINAL, default_evaluator, get_evaluator
+from tictank_game_logic import CLASSIC
+from tictank_state import BoardState
+
+# Score bounds, the search can stop a level early once one of them is reached
+SCORE_WON = 1
+SCORE_LOST = -1
+INFINITY = float('inf')
+
+# Transposition table entry flags
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+# Number of slots in the process wide transposition table
+DEFAULT_TABLE_SIZE = 2 ** 18
+
+# Nodes searched between two checks of the clock on tic tac toe battlefields, the nodes of the larger ones
+# cost more and the clock is checked as much more often
+CLOCK_CHECK_NODES = 256
+# Killer moves remembered for every level of the tree
+KILLER_SLOTS = 2
+# Levels closer to the leaves are searched in board order, sorting them costs more than it saves
+ORDERING_MIN_DEPTH = 3
+
+
+class SearchAborted(Exception):
+    """ Raised inside the search when the time or node budget of the move is spent
+    """
+
+
+class TranspositionTable:
+    """ Fixed size cache of searched positions
+    Each position hashes to a single slot. A slot is replaced when it is empty, holds an entry from an
+    older search or holds a shallower search than the new one, so the table never grows past ``size``
+    """
+
+    def __init__(self, size=DEFAULT_TABLE_SIZE):
+        self.size = size
+        self.slots = [None] * size
+        self.generation = 0
+        self.hits = 0
+        self.stores = 0
+
+    def new_search(self):
+        """ Age the stored entries so that they are the first to be evicted
+        """
+        self.generation += 1
+
+    def lookup(self, key):
+        entry = self.slots[hash(key) % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def store(self, key, depth, flag, value, move):
+        index = hash(key) % self.size
+        entry = self.slots[index]
+        if entry is None or entry[0] == key or entry[5] != self.generation or entry[1] <= depth:
+            self.slots[index] = (key, depth, flag, value, move, self.generation)
+            self.stores += 1
+
+    def clear(self):
+        self.slots = [None] * self.size
+        self.hits = 0
+        self.stores = 0
+
+
+# Shared between all the bots of the process without a node budget, entries are keyed on the bot marker so
+# they never mix
+TRANSPOSITION_TABLE = TranspositionTable()
+# Tables of the other battlefields and evaluators by (size, win_length, evaluator), the packed cells of two
+# geometries may be equal and the scores of two evaluators differ
+_geometry_tables = {}
+
+
+def get_transposition_table(geometry, evaluator=TERMINAL):
+    """ Return the transposition table of the process for the battlefield of a BoardGeometry
+    searched with the named evaluator
+    """
+    if geometry.classic and evaluator == TERMINAL:
+        return TRANSPOSITION_TABLE
+    key = (geometry.size, geometry.win_length, evaluator)
+    table = _geometry_tables.get(key)
+    if table is None:
+        table = _geometry_tables[key] = TranspositionTable()
+    return table
+
+
+class AlphaBetaSearch:
+    """ Alpha-beta version of ``AIBot.minimax`` with a transposition table
+    The searched tree is the same as the one of minimax: the bot deploys its own troops on every level,
+    the first level below the root is minimizing and the deeper levels are maximizing. Root moves are
+    compared strictly, so ties keep the first available move and the chosen moves are identical.
+
+    With a time or node budget, ``best_move`` deepens the search one level at a time up to the requested
+    depth and returns the move of the deepest finished iteration when the budget runs out. The moves are
+    tried in the order learned so far: the best root move of the previous iteration first and, below the
+    root, the transposition table move, then the killer moves of the level, then the best history scores.
+
+    The leaves of battles still going on score 0 with the TERMINAL evaluator, the one of minimax, other
+    evaluators of tictank_evaluation score them between SCORE_LOST and SCORE_WON.
+    """
+
+    def __init__(self, marker, opponentmarker, table=None, evaluator=None):
+        self.marker = marker
+        self.opponentmarker = opponentmarker
+        # the table of the searched battlefield is used when none is provided
+        self.own_table = table
+        self.table = table if table is not None else TRANSPOSITION_TABLE
+        # name of the evaluator, the default one of the searched battlefield when none is provided
+        self.evaluator_name = evaluator
+        self.evaluator = None
+        # nodes expanded by the last search and by all the searches of this instance
+        self.nodes = 0
+        self.total_nodes = 0
+        # depth of the deepest iteration finished by the last search
+        self.depth_reached = 0
+        self.state = None
+        self.killers = None
+        self.history = None
+        self.deadline = None
+        self.node_limit = None
+        self.next_check = INFINITY
+        self.check_nodes = CLOCK_CHECK_NODES
+
+    def use_table(self, table):
+        """ Search with ``table`` from now on instead of the transposition table of the searched battlefield
+        """
+        self.own_table = self.table = table
+
+    def best_move(self, gameinstance, depth, time_budget=None, node_budget=None):
+        """ Return the move minimax would choose on the game board with the given depth
+            :param gameinstance: The game instance
+            :param depth: Maximum number of search in the tree before aborting
+            :param time_budget: optional number of seconds the search may take
+            :param node_budget: optional number of nodes the search may expand
+            :return The best available move of the deepest finished iteration
+        """
+        self.reset(BoardState.from_game(gameinstance), depth)
+        self.table.new_search()
+
+        moves = self.state.available_moves()
+        if not moves:
+            return -1, -1
+        started = time.time()
+        best_move = moves[0]
+        # the shallower iterations are only worth their nodes when the search may have to stop early
+        first_depth = 1 if time_budget is not None or node_budget is not None else depth
+        try:
+            for iteration_depth in range(first_depth, depth + 1):
+                best_move = self.search_root(moves, iteration_depth, best_move)
+                self.depth_reached = iteration_depth
+                # the budget starts counting after the first iteration, so there always is a searched move
+                if time_budget is not None:
+                    self.deadline = started + time_budget
+                if node_budget is not None:
+                    self.node_limit = node_budget
+                self.check_budget()
+        except SearchAborted:
+            pass
+        self.total_nodes += self.nodes
+        return best_move
+
+    def reset(self, state, depth):
+        """ Prepare a new search of ``state`` at most ``depth`` levels deep
+        """
+        self.nodes = 0
+        self.depth_reached = 0
+        self.state = state
+        name = self.evaluator_name or default_evaluator(state.geometry)
+        self.evaluator = get_evaluator(name, state.geometry)
+        if self.own_table is None:
+            self.table = get_transposition_table(state.geometry, name)
+        self.killers = [[None] * KILLER_SLOTS for _ in range(depth + 1)]
+        # separate history scores for the minimizing and the maximizing levels
+        self.history = ([0] * state.geometry.cells, [0] * state.geometry.cells)
+        self.deadline = None
+        self.node_limit = None
+        self.next_check = INFINITY
+        self.check_nodes = max(CLOCK_CHECK_NODES * CLASSIC.cells // state.geometry.cells, 1)
+
+    def value(self, state, depth, maximizing, alpha=-INFINITY, beta=INFINITY):
+        """ Return the score of a level below the root, used to search parts of the tree in other processes
+        Like every level of the search the score is exact when it is between ``alpha`` and ``beta``,
+        otherwise it is a bound on the side of the window it fell on
+            :param state: BoardState after the moves leading to the level
+            :param depth: levels left to search
+            :param maximizing: search a maximizing level, otherwise a minimizing one
+        """
+        self.reset(state, depth)
+        if maximizing:
+            score = self.max_value(depth, 0, alpha, beta)
+        else:
+            score = self.min_value(depth, 0, alpha, beta)
+        self.total_nodes += self.nodes
+        return score
+
+    def search_root(self, moves, depth, previous_best):
+        """ Return the best root move ``depth`` levels deep, the best move of the previous iteration is
+        searched first. Ties go to the first available move like in minimax: a move that comes before the
+        best one is searched with a window just below the best score, so an equal score is known exactly.
+        """
+        best_score = -INFINITY
+        best_index = None
+        for m in (previous_best,) + tuple(m for m in moves if m != previous_best):
+            index = moves.index(m)
+            alpha = best_score if best_index is None or index > best_index else best_score - 0.5
+            self.make_move(m)
+            score = self.min_value(depth - 1, 1, alpha, INFINITY)
+            self.unmake_move(m)
+            if best_index is None or score > best_score or (score == best_score and index < best_index):
+                best_score = score
+                best_index = index
+        return moves[best_index]
+
+    def check_budget(self):
+        """ Raise SearchAborted when the budget is spent and schedule the next check
+        """
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchAborted()
+        if self.deadline is not None:
+            if time.time() >= self.deadline:
+                raise SearchAborted()
+            self.next_check = self.nodes + self.check_nodes
+            if self.node_limit is not None:
+                self.next_check = min(self.next_check, self.node_limit)
+        elif self.node_limit is not None:
+            self.next_check = self.node_limit
+
+    def make_move(self, pos):
+        self.state.make_move(pos, self.marker)
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check_budget()
+
+    def unmake_move(self, pos):
+        self.state.unmake_move(pos)
+
+    def ordered_moves(self, depth, ply, maximizing, table_move):
+        """ Return the available moves, the most promising ones first
+        """
+        moves = self.state.available_moves()
+        if depth < ORDERING_MIN_DEPTH or len(moves) < 2:
+            return moves
+        ordered = sorted(moves, key=self.history[maximizing].__getitem__, reverse=True)
+        for m in reversed(self.killers[ply] + [table_move]):
+            if m is not None and m in ordered:
+                ordered.remove(m)
+                ordered.insert(0, m)
+        return ordered
+
+    def cutoff(self, move, depth, ply, maximizing):
+        """ Remember a move that ended the search of a level early
+        """
+        killers = self.killers[ply]
+        if move != killers[0]:
+            killers.pop()
+            killers.insert(0, move)
+        self.history[maximizing][move] += depth * depth
+
+    def min_value(self, depth, ply, alpha, beta):
+        if depth == 0:
+            return self.score()
+        key = (self.state.cells, False, depth, self.marker, self.state.p1_marker)
+        entry = self.table.lookup(key)
+        table_move = None
+        if entry is not None:
+            value = entry[3]
+            if entry[2] == EXACT or (entry[2] == LOWER_BOUND and value >= beta) or \
+                    (entry[2] == UPPER_BOUND and value <= alpha):
+                return value
+            table_move = entry[4]
+        alpha_orig, beta_orig = alpha, beta
+        best_score = INFINITY
+        best_move = None
+        for m in self.ordered_moves(depth, ply, False, table_move):
+            self.make_move(m)
+            # the leaves are scored here, saving a call for most of the nodes
+            score = self.score() if depth == 1 else self.max_value(depth - 1, ply + 1, alpha, beta)
+            self.unmake_move(m)
+            if score < best_score:
+                best_score = score
+                best_move = m
+            # maximizing levels never go below a lost battle, nor can this level
+            if best_score <= alpha or best_score == -INFINITY:
+                self.cutoff(m, depth, ply, False)
+                break
+            if best_score < beta:
+                beta = best_score
+        self.store(key, depth, best_score, alpha_orig, beta_orig, best_move)
+        return best_score
+
+    def max_value(self, depth, ply, alpha, beta):
+        if depth == 0:
+            return self.score()
+        key = (self.state.cells, True, depth, self.marker, self.state.p1_marker)
+        entry = self.table.lookup(key)
+        table_move = None
+        if entry is not None:
+            value = entry[3]
+            if entry[2] == EXACT or (entry[2] == LOWER_BOUND and value >= beta) or \
+                    (entry[2] == UPPER_BOUND and value <= alpha):
+                return value
+            table_move = entry[4]
+        alpha_orig, beta_orig = alpha, beta
+        best_score = -INFINITY
+        best_move = None
+        for m in self.ordered_moves(depth, ply, True, table_move):
+            self.make_move(m)
+            # the leaves are scored here, saving a call for most of the nodes
+            score = self.score() if depth == 1 else self.max_value(depth - 1, ply + 1, alpha, beta)
+            self.unmake_move(m)
+            if score > best_score:
+                best_score = score
+                best_move = m
+            # a won battle is the best any maximizing level can score
+            if best_score >= beta or best_score == SCORE_WON:
+                self.cutoff(m, depth, ply, True)
+                break
+            if best_score > alpha:
+                alpha = best_score
+        self.store(key, depth, best_score, alpha_orig, beta_orig, best_move)
+        return best_score
+
+    def store(self, key, depth, value, alpha, beta, move):
+        if value <= alpha:
+            flag = UPPER_BOUND
+        elif value >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        self.table.store(key, depth, flag, value, move)
+
+    def score(self):
+        """ Same result as ``AIBot.score`` for the searched board, the battles still going on are scored by
+        the evaluator
+        """
+        winner = self.state.winner()
+        if winner == self.marker:
+            return SCORE_WON
+        elif winner == self.opponentmarker:
+            return SCORE_LOST
+        if self.evaluator is not None:
+            return self.evaluator.evaluate(self.state, self.marker)
+        return 0
@@ -1,29 +1,319 @@
 #!/usr/bin/python
+import errno
+import json
 import logging
+import os
+import random
+import signal
+import sqlite3
 import sys
+import time
 import tornado.web
-import tictank_game_logic
 
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
 from tornado.options import define, options
+from tornado.web import GZipContentEncoding
 
 from tictank_ai_logic import get_ai_players
-from tictank_db import create_connection, DATABASE_NAME
+from tictank_cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, game_key, get_game_cache, start_game_cache
+from tictank_codec import BINARY_STREAM_TYPE, BINARY_TYPE, GZIP_MIN_LENGTH, JSON_TYPE, NDJSON_TYPE, STREAM_TYPES, \
+    Payload, encode, frame, negotiate
+from tictank_db import close_connection, get_bot_registry, get_bot_team, prepare_database
+from tictank_evaluation import DEFAULT_EVALUATOR, EVALUATORS, set_default_evaluator
+from tictank_game_logic import DEFAULT_BOARD_SIZE, add_game_results_log, game_random, get_geometry, new_seed, \
+    start_game
+from tictank_metrics import METRICS
+from tictank_parallel import get_search_pool, start_search_pool
+from tictank_pool import DEFAULT_GAME_TIMEOUT, DEFAULT_QUEUE_SIZE, PoolSaturatedError, get_game_pool, run_game, \
+    start_game_pool
+from tictank_replay import get_battle, replay_records
+from tictank_scheduler import DEFAULT_BATCH_BURST, DEFAULT_BATCH_RATE, DEFAULT_CLIENT_BURST, DEFAULT_CLIENT_RATE, \
+    DEFAULT_MAX_WAIT, OverloadedError, RateLimitedError, estimate_game_cost, estimate_turn_cost, get_game_scheduler, \
+    start_game_scheduler
+from tictank_session import DEFAULT_MAX_SESSIONS, DEFAULT_PLAYER_NAME, DEFAULT_SESSION_MEMORY, \
+    DEFAULT_SESSION_TIMEOUT, MAX_NAME_LENGTH, SESSION_SEED_BITS, Session, get_session_store, parse_session_id, \
+    play_session_turn, session_owner, start_session_store
+from tictank_simulation import DEFAULT_SIMULATION_GAMES, MAX_SIMULATION_GAMES, merge_statistics, new_statistics, \
+    simulate_games, simulation_chunks, simulation_results
+from tictank_stats import DEFAULT_LEADERBOARD_SIZE, LEADERBOARD_ORDERS, get_leaderboard, get_stats
+from tictank_tablebase import load_tablebase
+from tictank_tournament import Tournament
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+# The level of the log messages is set with the --logging option, debug logs every game
+logging.basicConfig(stream=sys.stdout)
 define("port", default=8888, type=int)
+define("workers", default=1, type=int, help="server processes sharing the port, 0 for one per core")
+define("shutdown_timeout", default=DEFAULT_GAME_TIMEOUT, type=float,
+       help="seconds to finish the requests in flight after SIGTERM before stopping")
+define("tablebase", default=None, type=str, help="solved positions file for perfect play of the IQ 190+ bots")
+define("game_workers", default=0, type=int,
+       help="game worker processes of every server process, defaults to the cores shared between them")
+define("game_queue", default=DEFAULT_QUEUE_SIZE, type=int, help="games queued or running before returning 503")
+define("game_timeout", default=DEFAULT_GAME_TIMEOUT, type=float, help="seconds to wait for a game result")
+define("stream_threads", default=4, type=int, help="threads playing the streamed games")
+define("search_processes", default=0, type=int,
+       help="processes sharing the deep searches of the streamed games, 0 to search in the stream threads")
+define("game_cache", default=DEFAULT_CACHE_SIZE, type=int, help="game results kept for repeated games, 0 to disable")
+define("game_cache_ttl", default=DEFAULT_CACHE_TTL, type=float,
+       help="seconds a game result is served from the cache, 0 to keep it until evicted")
+define("metrics_sample", default=1, type=int,
+       help="record the metrics of one bot move in N for /metrics, 0 to disable the metrics")
+define("client_rate", default=DEFAULT_CLIENT_RATE, type=float,
+       help="seconds of estimated game time every client may use per second before returning 429, 0 to disable")
+define("client_burst", default=DEFAULT_CLIENT_BURST, type=float,
+       help="seconds of estimated game time a client may save up and use at once")
+define("batch_rate", default=DEFAULT_BATCH_RATE, type=float,
+       help="seconds of estimated game time every client may use per second in /simulate before returning 429, "
+            "0 to disable")
+define("batch_burst", default=DEFAULT_BATCH_BURST, type=float,
+       help="seconds of estimated game time a client may save up and use at once in /simulate")
+define("max_wait", default=DEFAULT_MAX_WAIT, type=float,
+       help="estimated seconds a game may wait for the game workers before returning 503, 0 to disable")
+define("sessions", default=DEFAULT_MAX_SESSIONS, type=int,
+       help="live human-vs-bot sessions of every server process before the least recently used are evicted")
+define("session_memory", default=DEFAULT_SESSION_MEMORY, type=int,
+       help="megabytes of human-vs-bot sessions of every server process before the least recently used are evicted")
+define("session_timeout", default=DEFAULT_SESSION_TIMEOUT, type=int,
+       help="seconds a human-vs-bot session is kept without a request")
+define("evaluator", default=DEFAULT_EVALUATOR, type=str,
+       help="scoring of the positions searched by the bots on tic tac toe battlefields: " + ", ".join(EVALUATORS))
+define("gzip", default=True, type=bool,
+       help="gzip the responses of at least {} bytes for the clients accepting it".format(GZIP_MIN_LENGTH))
 
+# Times a crashed server process is started again before the server gives up
+MAX_SERVER_RESTARTS = 100
+# Seconds between two checks for the requests in flight while shutting down
+SHUTDOWN_CHECK_INTERVAL = 0.1
+# Seconds to connect to the server process holding a session
+SESSION_FORWARD_CONNECT_TIMEOUT = 5
 
-class RandomGameHandler(tornado.web.RequestHandler):
+# Threads stepping through the streamed games, started with the server
+stream_executor = None
+# Loopback ports of the server processes by index, the requests of a session held by another server process
+# are forwarded to its port. Empty with a single server process.
+session_ports = []
+# Requests started and not finished yet, waited for when shutting down
+requests_in_flight = set()
+# /get_bots response encoded in every format and the bots JSON of the registry it was encoded from, encoded
+# again when the registry loads other bots
+roster_payload = (None, None)
+
+
+class BatchGZipContentEncoding(GZipContentEncoding):
+    """ gzip the responses written at once of at least GZIP_MIN_LENGTH bytes, like the batches of /simulate
+    and /replay, in JSON or in the binary encoding. The records of /stream_game are sent as they are played.
+    """
+
+    CONTENT_TYPES = GZipContentEncoding.CONTENT_TYPES | set([NDJSON_TYPE, BINARY_TYPE, BINARY_STREAM_TYPE])
+    MIN_LENGTH = GZIP_MIN_LENGTH
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if not finishing:
+            self._gzipping = False
+        return GZipContentEncoding.transform_first_chunk(self, status_code, headers, chunk, finishing)
+
+
+class InstrumentedHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        requests_in_flight.add(self)
+
+    def respond(self, data):
+        """ Send a response as JSON, or in the binary encoding of tictank_codec to the clients accepting
+        application/x-tictank
+        """
+        self.set_header("Vary", "Accept")
+        if negotiate(self.request.headers.get("Accept")) == BINARY_TYPE:
+            self.set_header("Content-Type", BINARY_TYPE)
+            self.write(encode(data))
+        else:
+            self.write(data)
+
+    def start_stream(self):
+        """ Send the next records as newline delimited JSON, or as length-prefixed binary records to the
+        clients accepting application/x-tictank-stream
+        """
+        self.stream_type = negotiate(self.request.headers.get("Accept"), STREAM_TYPES)
+        self.set_header("Vary", "Accept")
+        self.set_header("Content-Type", self.stream_type)
+
+    def write_record(self, record):
+        if self.stream_type == BINARY_STREAM_TYPE:
+            self.write(frame(record))
+        else:
+            self.write(json.dumps(record) + "\n")
+
+    def on_finish(self):
+        """ Record the request in the /metrics latency histogram of the handler
+        """
+        requests_in_flight.discard(self)
+        if METRICS.enabled:
+            METRICS.inc('tictank_http_requests_total', handler=self.request.path, code=self.get_status())
+            METRICS.observe('tictank_http_request_duration_seconds', self.request.request_time(),
+                            handler=self.request.path)
+
+
+class PoolGameHandler(InstrumentedHandler):
+    def check_players(self, p1_id, p2_id):
+        """ Check that both player ids are bots of opposing teams
+            :return: True or False when an error was sent instead
+        """
+        p1_team = get_bot_team(p1_id)
+        p2_team = get_bot_team(p2_id)
+        # Provided player ids not in the database
+        if p1_team is None or p2_team is None:
+            self.write("Error: No bots in database for provided Parameters")
+            return False
+        if p1_team == p2_team:
+            self.write("Error: Provided player ids are in the same team")
+            return False
+        return True
+
+    def check_move_time(self):
+        """ Get the optional move_time user input param, the milliseconds each bot may think per move
+            :return: True or False when an error was sent instead
+        """
+        self.move_time = None
+        move_time = self.get_argument("move_time", None)
+        if move_time is None:
+            return True
+        try:
+            move_time = float(move_time)
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return False
+        if not move_time > 0:
+            self.write("Error: The move time must be a positive number of milliseconds")
+            return False
+        self.move_time = move_time / 1000
+        return True
+
+    def admit(self, cost, batch=False):
+        """ Charge the estimated cost of the request to its client in the game scheduler
+            :param cost: estimated seconds of the request, see GameScheduler.estimate
+            :param batch: charge the bucket of the batch requests of the client
+            :return: True or False when an error was sent instead
+        """
+        try:
+            get_game_scheduler().admit(self.request.remote_ip, cost, batch)
+        except RateLimitedError as e:
+            logging.debug("Game request of {} refused: {}".format(self.request.remote_ip, e))
+            self.set_status(429)
+            self.set_header("Retry-After", e.retry_after)
+            self.write("Error: Too many games requested, try again later")
+            return False
+        except OverloadedError as e:
+            logging.debug("Game request of {} refused: {}".format(self.request.remote_ip, e))
+            self.set_status(503)
+            self.set_header("Retry-After", e.retry_after)
+            self.write("Error: All the game workers are busy")
+            return False
+        return True
+
+    def check_seed(self):
+        """ Get the optional seed user input param, the same seed and bots play the same game
+            :return: True or False when an error was sent instead
+        """
+        self.seed = None
+        seed = self.get_argument("seed", None)
+        if seed is None:
+            return True
+        try:
+            self.seed = int(seed)
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return False
+        return True
+
+    def check_geometry(self):
+        """ Get the optional board_size and win_length user input params, the side of the square battlefield
+        and the number of tanks in a row winning the battle
+            :return: True or False when an error was sent instead
+        """
+        try:
+            board_size = int(self.get_argument("board_size", DEFAULT_BOARD_SIZE))
+            win_length = self.get_argument("win_length", None)
+            win_length = int(win_length) if win_length is not None else None
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return False
+        try:
+            self.geometry = get_geometry(board_size, win_length)
+        except ValueError as e:
+            self.write(str(e))
+            return False
+        return True
+
+    @gen.coroutine
+    def wait_for_pool(self, futures):
+        """ Wait for the work sent to the game pool without blocking the IOLoop
+            :param futures: future or list of futures returned by the game pool
+            :return: The results or None when an error was sent instead
+        """
+        try:
+            results = yield futures
+        except PoolSaturatedError:
+            self.set_status(503)
+            self.set_header("Retry-After", 1)
+            self.write("Error: All the game workers are busy")
+            return
+        except gen.TimeoutError:
+            self.set_status(504)
+            self.write("Error: The game took too long")
+            return
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def play_game(self, p1_id=None, p2_id=None):
+        """ Play a game in the game pool, or serve it from the game cache when it was played before
+            :return: The game results, None when an error was sent instead
+        """
+        seed = self.seed if self.seed is not None else new_seed()
+        cache = get_game_cache()
+        key = None
+        # the bots thinking against the clock do not play the same moves every time, like on the larger
+        # battlefields
+        if cache is not None and self.move_time is None and self.geometry.classic:
+            key = game_key(p1_id, p2_id, seed)
+            game_results = cache.get(key) if key is not None else None
+            if game_results is not None:
+                logging.debug("Game served from the game cache")
+                add_game_results_log(game_results)
+                raise gen.Return(dict(game_results, seed=seed))
+        scheduler = get_game_scheduler()
+        cost = scheduler.estimate(estimate_game_cost(p1_id, p2_id, self.geometry, self.move_time))
+        if not self.admit(cost):
+            return
+        game_results = yield self.wait_for_pool(scheduler.run(self.request.remote_ip, cost, get_game_pool().submit,
+                                                              run_game, p1_id, p2_id, self.move_time, seed,
+                                                              self.geometry.size, self.geometry.win_length))
+        if game_results is not None and key is not None:
+            cache.put(key, game_results)
+        raise gen.Return(game_results)
+
+
+class RandomGameHandler(PoolGameHandler):
+    @gen.coroutine
     def get(self):
         """ Get the game result between 2 random AI player bots
         """
-        player1, player2 = get_ai_players()
-        game_results = tictank_game_logic.play_game(player1, player2)
-        logging.debug("Random game played between bots: {} and {}".format(player1.name, player2.name))
-        self.write(game_results)
+        if not self.check_move_time() or not self.check_seed() or not self.check_geometry():
+            return
+        game_results = yield self.play_game()
+        if game_results is None:
+            return
+        logging.debug("Random game played between bots: {} and {}".format(game_results['player_1']['name'],
+                                                                          game_results['player_2']['name']))
+        self.respond(game_results)
 
 
-class GameHandler(tornado.web.RequestHandler):
+class GameHandler(PoolGameHandler):
     def get_params(self):
         """ Get the p1_id and p2_id user input params and check if they're valid ids
             :return: List of valid player ids
@@ -41,70 +331,518 @@ class GameHandler(tornado.web.RequestHandler):
         except ValueError:
             self.write("Error: Invalid Parameter Types")
             return
-        connection = create_connection(DATABASE_NAME)
-        cursor = connection.cursor()
-        try:
-            cursor.execute("SELECT team FROM ai_bots WHERE id={}".format(p1_id))
-            p1_team = cursor.fetchone()
-            cursor.execute("SELECT team FROM ai_bots WHERE id={}".format(p2_id))
-            p2_team = cursor.fetchone()
-        # Provided player ids not in the database
-        except TypeError:
-            self.write("Error: No bots in database for provided Parameters")
-            return
-        finally:
-            # close the db connection
-            connection.close()
-        if p1_team == p2_team:
-            self.write("Error: Provided player ids are in the same team")
+        if not self.check_players(p1_id, p2_id) or not self.check_move_time() or not self.check_seed() or \
+                not self.check_geometry():
             return
         return [p1_id, p2_id]
 
+    @gen.coroutine
     def get(self):
         """ Get the game result between the 2 selected AI player bots
         """
         params = self.get_params()
         if params is None:
             return
-        player1, player2 = get_ai_players(p1_id=params[0],
-                                          p2_id=params[1])
-        game_results = tictank_game_logic.play_game(player1, player2)
-        logging.debug("Custom game played between bots: {} and {}".format(player1.name, player2.name))
-        self.write(game_results)
+        game_results = yield self.play_game(p1_id=params[0],
+                                            p2_id=params[1])
+        if game_results is None:
+            return
+        logging.debug("Custom game played between bots: {} and {}".format(game_results['player_1']['name'],
+                                                                          game_results['player_2']['name']))
+        self.respond(game_results)
+
+
+class StreamGameHandler(GameHandler):
+    """ Streams a game as newline delimited JSON or binary records: the players and starting board first,
+    then every move as soon as it is decided and the same results as /play_game last
+    """
+
+    def on_connection_close(self):
+        self.closed = True
+
+    def get_params(self):
+        """ Get the optional p1_id and p2_id, random bots play when both are missing
+        """
+        if not self.get_arguments("p1_id") and not self.get_arguments("p2_id"):
+            if not self.check_move_time() or not self.check_seed() or not self.check_geometry():
+                return
+            return [None, None]
+        return super(StreamGameHandler, self).get_params()
+
+    @gen.coroutine
+    def send(self, data):
+        self.write_record(data)
+        yield self.flush()
+
+    @gen.coroutine
+    def get(self):
+        """ Stream the game between the 2 selected AI player bots, or 2 random ones
+        """
+        params = self.get_params()
+        if params is None:
+            return
+        scheduler = get_game_scheduler()
+        cost = scheduler.estimate(estimate_game_cost(params[0], params[1], self.geometry, self.move_time))
+        if not self.admit(cost):
+            return
+        # the streamed games are played by the stream threads, they take a slot of the game scheduler while
+        # they do so that the searches of the server process and of the game workers share the cores
+        self.closed = False
+        yield scheduler.acquire(self.request.remote_ip, cost)
+        try:
+            if self.closed:
+                logging.debug("Streamed game abandoned by the client")
+                return
+            yield self.stream_game(params)
+        finally:
+            scheduler.release(cost)
+
+    @gen.coroutine
+    def stream_game(self, params):
+        """ Play the game in the stream threads and send its records as they are played
+            :param params: the player ids, None for random bots
+        """
+        rng, seed = game_random(self.seed)
+        player1, player2 = get_ai_players(p1_id=params[0], p2_id=params[1], move_time=self.move_time, rng=rng)
+        game, data = start_game(player1, player2, seed=seed, rng=rng, geometry=self.geometry)
+        self.start_stream()
+        try:
+            yield self.send({'starting_board': data['starting_board'],
+                             'board_size': data['board_size'],
+                             'win_length': data['win_length'],
+                             'seed': seed,
+                             'player_1': {'name': game.p1.name, 'iq': game.p1.iq, 'tank': game.p1.marker},
+                             'player_2': {'name': game.p2.name, 'iq': game.p2.iq, 'tank': game.p2.marker}})
+            moves = game.play_moves()
+            while not self.closed:
+                # the bots think in another thread, the IOLoop keeps serving while they do
+                move = yield stream_executor.submit(next, moves, None)
+                if move is None:
+                    break
+                player_id, pos, value, marker = move
+                yield self.send({'player_id': player_id, 'pos': pos, 'value': value, 'tank': marker})
+            if self.closed:
+                logging.debug("Streamed game abandoned by the client")
+                return
+            data.update(game.game_results())
+            yield self.send(data)
+        except StreamClosedError:
+            logging.debug("Streamed game abandoned by the client")
+            return
+        logging.debug("Streamed game played between bots: {} and {}".format(player1.name, player2.name))
+
+
+class SimulationHandler(PoolGameHandler):
+    def get_params(self):
+        """ Get the optional p1_id, p2_id, games and seed user input params and check if they're valid
+            :return: List of valid params: player ids, number of games and seed
+        """
+        try:
+            p1_id, p2_id, seed = [int(value) if value is not None else None
+                                  for value in (self.get_argument("p1_id", None),
+                                                self.get_argument("p2_id", None),
+                                                self.get_argument("seed", None))]
+            games = int(self.get_argument("games", DEFAULT_SIMULATION_GAMES))
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        # Only one of the player ids has been provided
+        if (p1_id is None) != (p2_id is None):
+            self.write("Error: Missing Parameters")
+            return
+        if not 0 < games <= MAX_SIMULATION_GAMES:
+            self.write("Error: The number of games must be between 1 and {}".format(MAX_SIMULATION_GAMES))
+            return
+        if p1_id is not None and not self.check_players(p1_id, p2_id):
+            return
+        return [p1_id, p2_id, games, seed]
+
+    @gen.coroutine
+    def get(self):
+        """ Get the aggregated results of many games between the 2 selected or random AI player bots
+        """
+        params = self.get_params()
+        if params is None:
+            return
+        p1_id, p2_id, games, seed = params
+        pool = get_game_pool()
+        scheduler = get_game_scheduler()
+        game_cost = estimate_game_cost(p1_id, p2_id)
+        if not self.admit(scheduler.estimate(game_cost, games), batch=True):
+            return
+        statistics = new_statistics()
+        chunks = simulation_chunks(games, seed)
+        # keep at most one batch of games per worker in the pool, so other requests still get served
+        for start in range(0, len(chunks), pool.workers):
+            results = yield self.wait_for_pool([
+                scheduler.run(self.request.remote_ip, scheduler.estimate(game_cost, chunk_games),
+                              pool.submit_with_timeout, pool.timeout * chunk_games, simulate_games, chunk_games,
+                              p1_id, p2_id, chunk_seed)
+                for chunk_games, chunk_seed in chunks[start:start + pool.workers]])
+            if results is None:
+                return
+            for chunk_statistics in results:
+                merge_statistics(statistics, chunk_statistics)
+        logging.debug("Simulation of {} games played".format(games))
+        data = simulation_results(statistics)
+        data['seed'] = seed
+        self.respond(data)
+
+
+class SessionHandler(PoolGameHandler):
+    """ Games of a human player against a bot, one troop deployment per request
+    The sessions are held by the server process that started them, with several server processes the requests
+    of a session landing on another process are forwarded to the one holding it.
+    """
+
+    @gen.coroutine
+    def get_session(self):
+        """ Get the id user input param and the packed session it refers to
+            :return: (session id, packed session) or None when an error or the response of the server process
+            holding the session was sent instead
+        """
+        try:
+            session_id = parse_session_id(self.get_argument("id"))
+        except tornado.web.MissingArgumentError:
+            self.write("Error: Missing Parameters")
+            return
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        store = get_session_store()
+        owner = session_owner(session_id)
+        if owner != store.owner and owner < len(session_ports):
+            yield self.forward(session_ports[owner])
+            return
+        data = store.get(session_id)
+        if data is None:
+            self.write("Error: No session found")
+            return
+        if session_id in store.busy:
+            self.write("Error: The bot is still playing its turn")
+            return
+        raise gen.Return((session_id, data))
+
+    @gen.coroutine
+    def forward(self, port):
+        """ Send the request to the server process listening on the loopback ``port`` and send its response
+        back, the game turns are charged to the address of the client like the requests of the process
+        """
+        headers = {'X-Real-Ip': self.request.remote_ip}
+        if 'Accept' in self.request.headers:
+            headers['Accept'] = self.request.headers['Accept']
+        response = yield AsyncHTTPClient().fetch("http://127.0.0.1:{}{}".format(port, self.request.uri),
+                                                 headers=headers, decompress_response=False, raise_error=False,
+                                                 connect_timeout=SESSION_FORWARD_CONNECT_TIMEOUT,
+                                                 request_timeout=options.game_timeout + options.max_wait +
+                                                 SESSION_FORWARD_CONNECT_TIMEOUT)
+        if response.code == 599:
+            logging.warning("Session request not forwarded to port {}: {}".format(port, response.error))
+            self.set_status(503)
+            self.write("Error: The server process holding the session is not available")
+            return
+        self.set_status(response.code)
+        for name in ("Content-Type", "Retry-After"):
+            if name in response.headers:
+                self.set_header(name, response.headers[name])
+        self.write(response.body)
+
+    @gen.coroutine
+    def play_turn(self, session_id, session):
+        """ Let the bot play its turn in the game pool when it is to move, then store the session and send its
+        state with the moves of the bot, or the results when the battle is over and the session is finished
+        """
+        store = get_session_store()
+        moves = []
+        results = None
+        if session.over:
+            results = session.results()
+        elif session.to_move() is session.bot:
+            scheduler = get_game_scheduler()
+            cost = scheduler.estimate(estimate_turn_cost(session.bot_id, session.game.geometry))
+            if not self.admit(cost):
+                return
+            store.busy.add(session_id)
+            try:
+                turn = yield self.wait_for_pool(scheduler.run(self.request.remote_ip, cost, get_game_pool().submit,
+                                                              play_session_turn, session.pack()))
+            finally:
+                store.busy.discard(session_id)
+            if turn is None:
+                return
+            data, moves, results = turn
+            session = Session.unpack(data)
+        if results is None:
+            store.put(session_id, session.pack())
+        else:
+            store.remove(session_id)
+        response = session.state(session_id)
+        response['bot_moves'] = [{'player_id': player_id, 'pos': pos, 'value': value, 'tank': marker}
+                                 for player_id, pos, value, marker in moves]
+        if results is not None:
+            response['results'] = results
+        self.respond(response)
+
+    @gen.coroutine
+    def get(self):
+        """ Get the state of a session
+        """
+        params = yield self.get_session()
+        if params is None:
+            return
+        session_id, data = params
+        self.respond(Session.unpack(data).state(session_id))
+
+
+class NewSessionHandler(SessionHandler):
+    @gen.coroutine
+    def get(self):
+        """ Start a session against the selected bot, the bot plays its first turn when it moves first
+        """
+        try:
+            bot_id = int(self.get_argument("bot_id"))
+        except tornado.web.MissingArgumentError:
+            self.write("Error: Missing Parameters")
+            return
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        if get_bot_team(bot_id) is None:
+            self.write("Error: No bots in database for provided Parameters")
+            return
+        name = self.get_argument("name", DEFAULT_PLAYER_NAME)
+        if not name or len(name.encode('utf-8')) > MAX_NAME_LENGTH:
+            self.write("Error: The name must have between 1 and {} bytes".format(MAX_NAME_LENGTH))
+            return
+        # the battle log credits the battles to the bot of the same name
+        if get_bot_registry().get_bot_id(name) is not None:
+            self.write("Error: The name is the one of a bot")
+            return
+        if not self.check_seed() or not self.check_geometry():
+            return
+        if self.seed is not None and not 0 <= self.seed < 1 << SESSION_SEED_BITS:
+            self.write("Error: The seed must be between 0 and {}".format((1 << SESSION_SEED_BITS) - 1))
+            return
+        session = Session.new(bot_id, name, self.geometry, self.seed)
+        yield self.play_turn(get_session_store().new_id(), session)
+
+
+class SessionMoveHandler(SessionHandler):
+    @gen.coroutine
+    def get(self):
+        """ Deploy the troops of the human player of a session, the bot plays its turn once the one of the
+        human player is over
+        """
+        params = yield self.get_session()
+        if params is None:
+            return
+        session_id, data = params
+        try:
+            pos = int(self.get_argument("pos"))
+        except tornado.web.MissingArgumentError:
+            self.write("Error: Missing Parameters")
+            return
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        session = Session.unpack(data)
+        try:
+            session.human_move(pos)
+        except ValueError as e:
+            self.write(str(e))
+            return
+        yield self.play_turn(session_id, session)
+
+
+class TournamentHandler(InstrumentedHandler):
+    def get(self):
+        """ Get the progress and standings of a tournament, the latest one when no id is provided
+        """
+        try:
+            tournament_id = self.get_argument("id", None)
+            tournament_id = int(tournament_id) if tournament_id is not None else None
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        try:
+            tournament = Tournament.load(tournament_id)
+        except sqlite3.OperationalError:
+            # the tournament tables are created with the first tournament
+            tournament = None
+        if tournament is None:
+            self.write("Error: No tournament found")
+            return
+        self.respond(tournament.status())
+
+
+class ReplayHandler(InstrumentedHandler):
+    def get(self):
+        """ Stream a game of the battle log again as newline delimited JSON or binary records, like /stream_game
+        """
+        try:
+            battle_id = int(self.get_argument("id"))
+        except tornado.web.MissingArgumentError:
+            self.write("Error: Missing Parameters")
+            return
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        battle = get_battle(battle_id)
+        if battle is None:
+            self.write("Error: No game found")
+            return
+        if battle[4] is None:
+            self.write("Error: No replay stored for this game")
+            return
+        self.start_stream()
+        for record in replay_records(battle):
+            self.write_record(record)
+
+
+class StatsHandler(InstrumentedHandler):
+    def get_days(self):
+        """ Get the optional since and until user input params, the first and last day of the battles as YYYY-MM-DD
+            :return: True or False when an error was sent instead
+        """
+        self.since = self.get_argument("since", None)
+        self.until = self.get_argument("until", None)
+        try:
+            for day in (self.since, self.until):
+                if day is not None:
+                    time.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return False
+        return True
+
+    def get(self):
+        """ Get the battle stats of a bot, or of all the battles when no bot_id is provided, in total and by day
+        """
+        try:
+            bot_id = self.get_argument("bot_id", None)
+            bot_id = int(bot_id) if bot_id is not None else None
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        if not self.get_days():
+            return
+        stats = get_stats(bot_id, self.since, self.until)
+        if stats is None:
+            self.write("Error: No bots in database for provided Parameters")
+            return
+        self.respond(stats)
+
+
+class LeaderboardHandler(StatsHandler):
+    def get(self):
+        """ Get the bots with the best battle stats
+        """
+        order = self.get_argument("order", LEADERBOARD_ORDERS[0])
+        try:
+            limit = int(self.get_argument("limit", DEFAULT_LEADERBOARD_SIZE))
+            team = self.get_argument("team", None)
+            team = int(team) if team is not None else None
+        except ValueError:
+            self.write("Error: Invalid Parameter Types")
+            return
+        if order not in LEADERBOARD_ORDERS:
+            self.write("Error: The order must be one of {}".format(", ".join(LEADERBOARD_ORDERS)))
+            return
+        if not self.get_days():
+            return
+        self.respond({'order': order,
+                      'bots': get_leaderboard(order, limit, self.since, self.until, team)})
 
 
-class BotsHandler(tornado.web.RequestHandler):
+class BotsHandler(InstrumentedHandler):
     def get(self):
         """ Get the bots defined in the ai_bots database
+        The response is encoded and gzipped once for every format, until the bot registry loads other bots.
         """
-        connection = create_connection(DATABASE_NAME)
-        cursor = connection.cursor()
-        cursor.execute("SELECT id, name, team, iq FROM ai_bots")
-        bots = cursor.fetchall()
-        bot_dict = {'soviet_ai': {},
-                    'german_ai': {}}
-        for id, name, team, iq in bots:
-            bot_data = {'name': name, 'iq': iq}
-            if team == 0:
-                bot_dict['soviet_ai'][id] = bot_data
-            else:
-                bot_dict['german_ai'][id] = bot_data
+        global roster_payload
         logging.debug("Bot information requested")
-        self.write(bot_dict)
+        bots_json = get_bot_registry().get_bots_json()
+        if roster_payload[0] is not bots_json:
+            roster_payload = (bots_json, Payload.from_json(bots_json))
+        payload = roster_payload[1]
+        media_type = negotiate(self.request.headers.get("Accept"))
+        gzipped = options.gzip and "gzip" in self.request.headers.get("Accept-Encoding", "")
+        self.set_header("Vary", "Accept")
+        self.set_header("Content-Type", "application/json; charset=UTF-8" if media_type == JSON_TYPE else media_type)
+        if gzipped:
+            self.set_header("Content-Encoding", "gzip")
+        self.etag = payload.etag(media_type)
+        self.write(payload.body(media_type, gzipped))
+
+    def compute_etag(self):
+        return self.etag
 
 
-class CheckHandler(tornado.web.RequestHandler):
+class CheckHandler(InstrumentedHandler):
     def get(self):
         """ Get a confirmation message for connecting to the server
         """
         logging.debug("Client connected to the server")
-        self.write({"connected": True})
+        self.respond({"connected": True})
+
+
+class MetricsHandler(InstrumentedHandler):
+    def get(self):
+        """ Get the metrics of the server and its game workers in the Prometheus text format
+        """
+        readings = []
+        pool = get_game_pool()
+        if pool is not None:
+            readings += [('tictank_game_pool_pending', 'gauge', "Games waiting for or running in the game workers",
+                          pool.pending),
+                         ('tictank_game_pool_queue_size', 'gauge', "Games queued before returning 503",
+                          pool.queue_size),
+                         ('tictank_game_pool_workers', 'gauge', "Game worker processes", pool.workers)]
+        scheduler = get_game_scheduler()
+        if scheduler is not None:
+            readings += [('tictank_scheduler_queued', 'gauge', "Games waiting in the game scheduler queue",
+                          len(scheduler.queue)),
+                         ('tictank_scheduler_queued_seconds', 'gauge',
+                          "Estimated seconds of the games waiting in the game scheduler queue", scheduler.queued_cost),
+                         ('tictank_scheduler_running', 'gauge', "Games sent to the game pool by the game scheduler",
+                          scheduler.running),
+                         ('tictank_scheduler_speed', 'gauge', "Measured game durations over their estimated costs",
+                          scheduler.speed)]
+        store = get_session_store()
+        if store is not None:
+            readings += [('tictank_sessions', 'gauge', "Live human-vs-bot sessions", len(store.sessions)),
+                         ('tictank_session_bytes', 'gauge', "Estimated bytes of the live human-vs-bot sessions",
+                          store.bytes),
+                         ('tictank_sessions_expired_total', 'counter', "Sessions dropped after the session timeout",
+                          store.expired),
+                         ('tictank_sessions_evicted_total', 'counter', "Sessions evicted from the full session store",
+                          store.evicted)]
+        cache = get_game_cache()
+        if cache is not None:
+            readings += [('tictank_game_cache_entries', 'gauge', "Game results in the game cache",
+                          len(cache.entries)),
+                         ('tictank_game_cache_hits_total', 'counter', "Games served from the game cache",
+                          cache.hits),
+                         ('tictank_game_cache_misses_total', 'counter', "Games not found in the game cache",
+                          cache.misses)]
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(METRICS.exposition(readings))
 
 
 game_server = tornado.web.Application([
     (r"/play_random", RandomGameHandler),
     (r"/play_game", GameHandler),
+    (r"/stream_game", StreamGameHandler),
+    (r"/simulate", SimulationHandler),
+    (r"/session/new", NewSessionHandler),
+    (r"/session/move", SessionMoveHandler),
+    (r"/session", SessionHandler),
+    (r"/tournament", TournamentHandler),
+    (r"/replay", ReplayHandler),
+    (r"/stats", StatsHandler),
+    (r"/leaderboard", LeaderboardHandler),
     (r"/get_bots", BotsHandler),
+    (r"/metrics", MetricsHandler),
     (r"/", CheckHandler),
 ])
 
@@ -124,9 +862,146 @@ def print_server_start():
     print 60 * "-"
 
 
+def fork_server_processes(processes):
+    """ Fork the server processes sharing the listening sockets, like tornado.process.fork_processes
+    The parent process supervises them: it starts again the ones that crash, forwards SIGTERM to them so
+    they finish their requests and stop, and exits once they all stopped.
+        :return: The index of the process, in every forked process
+    """
+    children = {}
+    stopping = []
+
+    def start_child(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the processes would draw the same seeds for the games otherwise
+            random.seed()
+            return index
+        children[pid] = index
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                # the process already stopped, os.wait takes it out of the children
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(processes):
+        if start_child(index) is not None:
+            return index
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        index = children.pop(pid, None)
+        if index is None or stopping or not (os.WIFSIGNALED(status) or os.WEXITSTATUS(status)):
+            continue
+        restarts += 1
+        if restarts > MAX_SERVER_RESTARTS:
+            raise RuntimeError("Error: The server processes crashed {} times".format(restarts))
+        logging.warning("Server process {} (pid {}) stopped with status {}, starting it again".format(
+            index, pid, status))
+        if start_child(index) is not None:
+            return index
+    sys.exit(0)
+
+
+def shutdown(http_servers):
+    """ Stop accepting connections, then stop the IOLoop once the requests in flight are finished or
+    after the shutdown timeout
+    """
+    logging.info("Shutting down, {} requests in flight".format(len(requests_in_flight)))
+    for http_server in http_servers:
+        http_server.stop()
+    deadline = time.time() + options.shutdown_timeout
+    io_loop = IOLoop.current()
+
+    def stop_when_idle():
+        if requests_in_flight and time.time() < deadline:
+            io_loop.call_later(SHUTDOWN_CHECK_INTERVAL, stop_when_idle)
+            return
+        io_loop.stop()
+
+    stop_when_idle()
+
+
 if __name__ == '__main__':
     # Start the game server
-    logging.debug("Server started")
-    print_server_start()
-    game_server.listen(options.port)
-    tornado.ioloop.IOLoop.current().start()
+    options.parse_command_line()
+    # set before the game workers are forked, so they record the metrics too
+    METRICS.sample_every = options.metrics_sample
+    # and the searches of the game workers and of the search pool use the same evaluator
+    set_default_evaluator(options.evaluator)
+    # the startup work shared by the server processes is done once, before they are forked
+    prepare_database()
+    get_bot_registry().refresh(force=True)
+    close_connection()
+    if options.tablebase:
+        # mapped once, the pages are shared with every process that plays games
+        load_tablebase(options.tablebase)
+    if options.gzip:
+        game_server.add_transform(BatchGZipContentEncoding)
+    sockets = bind_sockets(options.port)
+    processes = options.workers or cpu_count()
+    session_sockets = []
+    if processes > 1:
+        # bound before the fork so every server process knows the ports of the others, and a restarted
+        # process listens on the same one
+        session_sockets = [bind_sockets(0, '127.0.0.1')[0] for _ in range(processes)]
+        session_ports = [session_socket.getsockname()[1] for session_socket in session_sockets]
+    process_index = fork_server_processes(processes) if processes > 1 else 0
+
+    # every server process has its own database connection, game workers, threads and caches
+    pool = start_game_pool(workers=options.game_workers or max(cpu_count() // processes, 1),
+                           queue_size=options.game_queue,
+                           timeout=options.game_timeout)
+    # the games are sent to the pool by the scheduler, one per worker at a time
+    start_game_scheduler(slots=pool.workers, queue_size=options.game_queue, rate=options.client_rate,
+                         burst=options.client_burst, max_wait=options.max_wait, batch_rate=options.batch_rate,
+                         batch_burst=options.batch_burst)
+    stream_executor = ThreadPoolExecutor(max_workers=options.stream_threads)
+    if options.search_processes:
+        start_search_pool(options.search_processes)
+    if options.game_cache:
+        start_game_cache(size=options.game_cache, ttl=options.game_cache_ttl)
+    start_session_store(max_sessions=options.sessions, max_bytes=options.session_memory << 20,
+                        timeout=options.session_timeout, owner=process_index)
+    http_server = HTTPServer(game_server)
+    http_server.add_sockets(sockets)
+    http_servers = [http_server]
+    if session_sockets:
+        # the session requests forwarded by the other server processes, with the address of their client
+        session_server = HTTPServer(game_server, xheaders=True)
+        session_server.add_sockets([session_sockets[process_index]])
+        http_servers.append(session_server)
+        for index, session_socket in enumerate(session_sockets):
+            if index != process_index:
+                session_socket.close()
+    io_loop = IOLoop.current()
+    server_pid = os.getpid()
+
+    def handle_sigterm(signum, frame):
+        # the game workers forked later inherit the handler, they finish their games and stop with the pool
+        if os.getpid() == server_pid:
+            io_loop.add_callback_from_signal(shutdown, http_servers)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    logging.debug("Server process {} started".format(process_index))
+    if process_index == 0:
+        print_server_start()
+    io_loop.start()
+
+    # the IOLoop stopped after SIGTERM
+    get_game_pool().shutdown(wait=True)
+    stream_executor.shutdown(wait=False)
+    if get_search_pool() is not None:
+        get_search_pool().close()
+    logging.info("Server process {} stopped".format(process_index))
@@ -0,0 +1,288 @@
+import random
+import struct
+import time
+
+from collections import OrderedDict
+
+from tictank_ai_logic import TANK_P1, TANK_P2, AIBot
+from tictank_db import get_bot_registry
+from tictank_game_logic import CLASSIC, GAME, MAX_MOVES, draw_game_setup, encode_replay, format_board, game_random
+from tictank_replay import read_replay
+
+# Default number of live sessions of a server process, the least recently used ones are evicted past it
+DEFAULT_MAX_SESSIONS = 100000
+# Default megabytes of sessions a server process holds before the least recently used ones are evicted
+DEFAULT_SESSION_MEMORY = 64
+# Default seconds a session is kept without a request
+DEFAULT_SESSION_TIMEOUT = 1800
+# Estimated bytes of a session besides its packed data: its store entry, its id and the bytes object, measured
+# at about 220 bytes on Python 3 and 370 bytes with the OrderedDict links of Python 2
+SESSION_OVERHEAD = 350
+# Bits of the session ids, the lowest ones hold the index of the server process holding the session
+SESSION_ID_BITS = 64
+SESSION_OWNER_BITS = 8
+# Longest name of a human player, in bytes
+MAX_NAME_LENGTH = 32
+# Name of the human players who do not give one
+DEFAULT_PLAYER_NAME = "Human"
+
+# Header of a packed session: time of its last request, seed, potential moves of the bot, bot id, flags and
+# length of the player name, followed by the player name and the replay of the game so far
+SESSION_HEADER = struct.Struct('<IIIHBB')
+SESSION_TIME = struct.Struct('<I')
+# Bits of the seeds of the sessions, packed in the SESSION_HEADER
+SESSION_SEED_BITS = 32
+# Flag of the sessions where the bot moves first
+BOT_FIRST = 1
+
+# Player ids and tanks of the human player and the bot of a session
+HUMAN_ID, BOT_ID = 'P1', 'P2'
+
+# Session ids are drawn from the random source of the system, so they can not be guessed
+_id_random = random.SystemRandom()
+
+
+class HumanPlayer:
+    """ The human player of a session, its moves are the ones of the requests
+    """
+
+    player_id = HUMAN_ID
+    marker = TANK_P1
+    iq = None
+    nodes_searched = 0
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Session:
+    """ A game of a human player against a bot, unpacked from the session store for a request
+    The GAME is rebuilt by playing the moves of the packed replay again, so only the few bytes of ``pack``
+    are kept between the requests. The turns alternate every MAX_MOVES troop deployments like in
+    GAME.play_moves, the bot plays all the moves of its turn at once.
+    """
+
+    def __init__(self, bot_id, name, seed, geometry, bot_first, starting_board, positions=(), bot_pot_moves=0):
+        """ Rebuild a game
+            :param bot_id: id of the bot
+            :param name: name of the human player
+            :param seed: seed of the session, the random moves of the bot are drawn from it
+            :param geometry: BoardGeometry of the battlefield
+            :param bot_first: True when the bot moves first
+            :param starting_board: list of the starting tiles
+            :param positions: positions of the moves played so far
+            :param bot_pot_moves: potential moves of the bot so far, its moves and searched troop deployments
+        """
+        self.bot_id = bot_id
+        self.seed = seed
+        self.bot_first = bot_first
+        bot_name, iq, _ = get_bot_registry().get_bot(bot_id)
+        self.human = HumanPlayer(name)
+        self.bot = AIBot(BOT_ID, TANK_P2, TANK_P1, bot_name, iq)
+        first, second = (self.bot, self.human) if bot_first else (self.human, self.bot)
+        self.game = GAME(list(starting_board), first, second, geometry=geometry)
+        for pos in positions:
+            player = self.to_move()
+            self.game.move(player.player_id, player.marker, pos)
+        if positions:
+            self.game.potential_moves[self.bot.marker] = bot_pot_moves
+        self.over = self.game.is_gameover()
+
+    @classmethod
+    def new(cls, bot_id, name=DEFAULT_PLAYER_NAME, geometry=CLASSIC, seed=None):
+        """ Start a game against a bot on a random starting board, the bot or the human player moves first
+        """
+        rng, seed = game_random(seed)
+        starting_board, bot_first = draw_game_setup(rng, geometry=geometry)
+        return cls(bot_id, name, seed, geometry, bot_first, starting_board)
+
+    @classmethod
+    def unpack(cls, data):
+        """ Return the Session of the bytes of ``pack``
+        """
+        _, seed, bot_pot_moves, bot_id, flags, name_length = SESSION_HEADER.unpack_from(data)
+        start = SESSION_HEADER.size
+        name = data[start:start + name_length].decode('utf-8')
+        geometry, _, _, starting_board, positions = read_replay(data[start + name_length:])
+        return cls(bot_id, name, seed, geometry, bool(flags & BOT_FIRST), starting_board, positions, bot_pot_moves)
+
+    def pack(self):
+        """ Return the session in a few bytes: the SESSION_HEADER, the player name and the replay of the game
+        """
+        name = self.human.name.encode('utf-8')
+        game = self.game
+        return SESSION_HEADER.pack(int(time.time()), self.seed, game.potential_moves[self.bot.marker], self.bot_id,
+                                   BOT_FIRST if self.bot_first else 0, len(name)) + name + \
+            encode_replay(game.starting_board, game.move_history, game.winner == game.p1.marker, game.geometry)
+
+    def to_move(self):
+        """ Return the player deploying the next troops
+        """
+        return self.game.p1 if len(self.game.move_history) // MAX_MOVES % 2 == 0 else self.game.p2
+
+    def turn_moves(self):
+        """ Return the troop deployments left in the turn of the player to move
+        """
+        return MAX_MOVES - len(self.game.move_history) % MAX_MOVES
+
+    def human_move(self, pos):
+        """ Deploy the troops of the human player on ``pos``
+        Raises a ValueError when the battle is over, the bot is to move or the position is taken by a tank
+        """
+        if self.over:
+            raise ValueError("Error: The battle is over")
+        if self.to_move() is not self.human:
+            raise ValueError("Error: The bot is to move")
+        if not 0 <= pos < self.game.geometry.cells or self.game.board[pos] in (TANK_P1, TANK_P2):
+            raise ValueError("Error: The position is not available")
+        self.game.move(HUMAN_ID, self.human.marker, pos)
+        self.over = self.game.is_gameover()
+
+    def bot_turn(self):
+        """ Play the moves of the bot until its turn or the battle is over
+            :return: The move history entries of the bot
+        """
+        game = self.game
+        start = len(game.move_history)
+        while not self.over and self.to_move() is self.bot:
+            game.turn_moves = self.turn_moves()
+            # the random moves of the bot are drawn from the seed of the session and the move number
+            game.rng = random.Random(self.seed << 16 | len(game.move_history))
+            self.bot.move(game)
+            self.over = game.is_gameover()
+        return game.move_history[start:]
+
+    def results(self):
+        """ Return the results of the finished battle like play_game and write them in the battle log
+        """
+        game = self.game
+        data = {'starting_board': format_board(game.starting_board),
+                'board_size': game.geometry.size,
+                'win_length': game.geometry.win_length,
+                'seed': self.seed}
+        data.update(game.game_results())
+        return data
+
+    def state(self, session_id):
+        """ Return the state of the battle sent to the human player
+            :param session_id: id of the session in the session store
+        """
+        game = self.game
+        return {'id': format_session_id(session_id),
+                'board': format_board(game.board),
+                'board_size': game.geometry.size,
+                'win_length': game.geometry.win_length,
+                'seed': self.seed,
+                'player': {'name': self.human.name, 'tank': self.human.marker},
+                'bot': {'id': self.bot_id, 'name': self.bot.name, 'iq': self.bot.iq, 'tank': self.bot.marker},
+                'moves_count': len(game.move_history),
+                'turn_moves': self.turn_moves(),
+                'available_moves': game.get_available_moves()}
+
+
+def play_session_turn(data):
+    """ Play the turn of the bot of a packed session, in a game worker
+        :return: (packed session, move history entries of the bot, results when the battle is over or None)
+    """
+    session = Session.unpack(data)
+    moves = session.bot_turn()
+    return session.pack(), moves, session.results() if session.over else None
+
+
+def format_session_id(session_id):
+    return "{:016x}".format(session_id)
+
+
+def parse_session_id(text):
+    """ Return the session id of its hexadecimal text, raises a ValueError when it is not one
+    """
+    session_id = int(text, 16)
+    if not 0 <= session_id < 1 << SESSION_ID_BITS:
+        raise ValueError("Error: Invalid session id")
+    return session_id
+
+
+def session_owner(session_id):
+    """ Return the index of the server process holding a session
+    """
+    return session_id & ((1 << SESSION_OWNER_BITS) - 1)
+
+
+class SessionStore:
+    """ Packed sessions of a server process by id, the least recently used one first
+    Every session is a single bytes object of a few dozen bytes, see Session.pack, so a process holds hundreds
+    of thousands of them. A session is dropped after ``timeout`` seconds without a request and the least recently
+    used ones are evicted past ``max_sessions`` sessions or ``max_bytes`` estimated bytes. The battles of the
+    dropped sessions are not finished and are not written in the battle log.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, max_bytes=DEFAULT_SESSION_MEMORY << 20,
+                 timeout=DEFAULT_SESSION_TIMEOUT, owner=0):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        # index of the server process, in the ids of its sessions
+        self.owner = owner
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        # sessions waiting for the turn of their bot
+        self.busy = set()
+        self.expired = 0
+        self.evicted = 0
+
+    def new_id(self):
+        return _id_random.getrandbits(SESSION_ID_BITS - SESSION_OWNER_BITS) << SESSION_OWNER_BITS | self.owner
+
+    def get(self, session_id):
+        """ Return the packed session or None, it becomes the most recently used one
+        """
+        self.expire()
+        data = self.sessions.pop(session_id, None)
+        if data is not None:
+            data = self.sessions[session_id] = SESSION_TIME.pack(int(time.time())) + data[SESSION_TIME.size:]
+        return data
+
+    def put(self, session_id, data):
+        """ Store a packed session as the most recently used one, evicting the least recently used ones when
+        the store is full
+        """
+        self.remove(session_id)
+        self.sessions[session_id] = data
+        self.bytes += len(data) + SESSION_OVERHEAD
+        self.expire()
+        while len(self.sessions) > self.max_sessions or self.bytes > self.max_bytes:
+            self.remove(next(iter(self.sessions)))
+            self.evicted += 1
+
+    def remove(self, session_id):
+        data = self.sessions.pop(session_id, None)
+        if data is not None:
+            self.bytes -= len(data) + SESSION_OVERHEAD
+
+    def expire(self):
+        """ Drop the sessions without a request for ``timeout`` seconds, the least recently used ones are first
+        """
+        oldest = int(time.time()) - self.timeout
+        while self.sessions:
+            session_id = next(iter(self.sessions))
+            if SESSION_TIME.unpack_from(self.sessions[session_id])[0] >= oldest:
+                break
+            self.remove(session_id)
+            self.expired += 1
+
+
+# Session store of the process, started by the server
+SESSION_STORE = None
+
+
+def start_session_store(max_sessions=DEFAULT_MAX_SESSIONS, max_bytes=DEFAULT_SESSION_MEMORY << 20,
+                        timeout=DEFAULT_SESSION_TIMEOUT, owner=0):
+    """ Create the session store of this process
+    """
+    global SESSION_STORE
+    SESSION_STORE = SessionStore(max_sessions=max_sessions, max_bytes=max_bytes, timeout=timeout, owner=owner)
+    return SESSION_STORE
+
+
+def get_session_store():
+    return SESSION_STORE
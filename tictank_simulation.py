@@ -0,0 +1,142 @@
+import random
+
+from collections import Counter
+
+import tictank_game_logic
+from tictank_ai_logic import get_ai_players
+from tictank_game_logic import STARTING_BOARDS
+
+# Games played by a simulation request when not provided
+DEFAULT_SIMULATION_GAMES = 100
+# Games played by a worker process in one go
+SIMULATION_CHUNK = 250
+# Maximum number of games of a single simulation request
+MAX_SIMULATION_GAMES = 100000
+
+
+def simulate_games(games, p1_id=None, p2_id=None, seed=None):
+    """ Play ``games`` games in the current process and return their aggregated statistics
+    The battle results are queued on the battle log writer, which inserts them in batches
+        :param games: number of games to play
+        :param p1_id: Player 1's id, random bots are used for every game when the ids are not provided
+        :param p2_id: Player 2's id
+        :param seed: optional seed to replay the same games
+        :return: statistics dict, combine them with merge_statistics
+    """
+    # the games of the batch draw from a generator of their own, the random module of the worker is left alone
+    rng, seed = tictank_game_logic.game_random(seed)
+    statistics = new_statistics()
+    for _ in range(games):
+        player1, player2 = get_ai_players(p1_id=p1_id, p2_id=p2_id, rng=rng)
+        board_id = rng.choice(sorted(STARTING_BOARDS))
+        add_game(statistics, board_id, tictank_game_logic.play_game(player1, player2, board_id=board_id, seed=seed,
+                                                                    rng=rng))
+    return statistics
+
+
+def new_statistics():
+    return {'games': 0,
+            'first_player_wins': 0,
+            'bot_games': Counter(),
+            'bot_wins': Counter(),
+            'moves': Counter(),
+            'soldiers': Counter(),
+            'tanks': Counter(),
+            'boards': {}}
+
+
+def add_game(statistics, board_id, game_results):
+    """ Add the results of a game to the statistics
+    """
+    player_1, player_2 = game_results['player_1'], game_results['player_2']
+    winner = game_results['winner']
+    winner_data, loser_data = (player_1, player_2) if player_1['name'] == winner else (player_2, player_1)
+    board = statistics['boards'].setdefault(board_id, {'games': 0,
+                                                       'first_player_wins': 0,
+                                                       'moves': 0,
+                                                       'bot_wins': Counter()})
+    # player 1 of the game results is the player that moved first
+    first_player_won = int(player_1['name'] == winner)
+
+    statistics['games'] += 1
+    statistics['first_player_wins'] += first_player_won
+    statistics['bot_games'][player_1['name']] += 1
+    statistics['bot_games'][player_2['name']] += 1
+    statistics['bot_wins'][winner] += 1
+    statistics['moves'][game_results['moves_count']] += 1
+    statistics['soldiers']['winner'] += winner_data['soldiers_deployed']
+    statistics['soldiers']['loser'] += loser_data['soldiers_deployed']
+    statistics['tanks']['winner'] += winner_data['tanks_deployed']
+    statistics['tanks']['loser'] += loser_data['tanks_deployed']
+    board['games'] += 1
+    board['first_player_wins'] += first_player_won
+    board['moves'] += game_results['moves_count']
+    board['bot_wins'][winner] += 1
+
+
+def merge_statistics(statistics, other):
+    """ Add the ``other`` statistics, from another batch of games, to ``statistics``
+    """
+    for key in ('games', 'first_player_wins'):
+        statistics[key] += other[key]
+    for key in ('bot_games', 'bot_wins', 'moves', 'soldiers', 'tanks'):
+        statistics[key].update(other[key])
+    for board_id, other_board in other['boards'].items():
+        board = statistics['boards'].setdefault(board_id, {'games': 0,
+                                                           'first_player_wins': 0,
+                                                           'moves': 0,
+                                                           'bot_wins': Counter()})
+        for key in ('games', 'first_player_wins', 'moves'):
+            board[key] += other_board[key]
+        board['bot_wins'].update(other_board['bot_wins'])
+    return statistics
+
+
+def _ratio(count, total):
+    return round(float(count) / total, 4) if total else 0
+
+
+def simulation_results(statistics):
+    """ Return the response of the simulation from the aggregated statistics
+    """
+    games = statistics['games']
+    moves_total = sum(moves * count for moves, count in statistics['moves'].items())
+    bots = {}
+    for name, bot_games in statistics['bot_games'].items():
+        wins = statistics['bot_wins'][name]
+        bots[name] = {'games': bot_games,
+                      'wins': wins,
+                      'losses': bot_games - wins,
+                      'win_rate': _ratio(wins, bot_games)}
+    boards = {}
+    for board_id, board in statistics['boards'].items():
+        boards[board_id] = {'games': board['games'],
+                            'average_moves': _ratio(board['moves'], board['games']),
+                            'first_player_win_rate': _ratio(board['first_player_wins'], board['games']),
+                            'wins': dict(board['bot_wins'])}
+    return {'games': games,
+            'bots': bots,
+            'first_player_win_rate': _ratio(statistics['first_player_wins'], games),
+            'moves': {'average': _ratio(moves_total, games),
+                      'distribution': dict(statistics['moves'])},
+            'soldiers': {'winner_average': _ratio(statistics['soldiers']['winner'], games),
+                         'loser_average': _ratio(statistics['soldiers']['loser'], games)},
+            'tanks': {'winner_average': _ratio(statistics['tanks']['winner'], games),
+                      'loser_average': _ratio(statistics['tanks']['loser'], games)},
+            'boards': boards,
+            }
+
+
+def simulation_chunks(games, seed=None, chunk_size=SIMULATION_CHUNK):
+    """ Split a simulation in batches of games for the worker processes
+    Each batch gets its own seed derived from ``seed``, so a seeded simulation plays the same games
+    whatever the number of workers
+        :return: list of (games, seed) tuples
+    """
+    seeds = random.Random(seed) if seed is not None else None
+    chunks = []
+    while games > 0:
+        chunk_games = min(games, chunk_size)
+        chunks.append((chunk_games, seeds.getrandbits(32) if seeds else None))
+        games -= chunk_games
+    return chunks
@@ -0,0 +1,192 @@
+from tictank_game_logic import CLASSIC, PLAY_TILES, WIN_POSITIONS
+
+# Every cell is packed in 3 bits of a single integer: the battle tiles -1..4 are stored as 0..5,
+# player 1's tank as 6 and player 2's tank as 7
+CELL_BITS = 3
+CELL_MASK = (1 << CELL_BITS) - 1
+TANK_READY_CODE = PLAY_TILES[-1] - PLAY_TILES[0]
+P1_TANK_CODE = TANK_READY_CODE + 1
+P2_TANK_CODE = TANK_READY_CODE + 2
+
+BOARD_CELLS = 9
+FULL_MASK = (1 << BOARD_CELLS) - 1
+WIN_MASKS = tuple((1 << i) | (1 << j) | (1 << k) for i, j, k in WIN_POSITIONS)
+NO_LINE = len(WIN_MASKS)
+
+# Each troop deployment raises a cell by one level, so a game can not last longer than this
+MAX_PLIES = BOARD_CELLS * (len(PLAY_TILES) + 1)
+
+
+def _first_line(tanks):
+    for index, mask in enumerate(WIN_MASKS):
+        if tanks & mask == mask:
+            return index
+    return NO_LINE
+
+
+# Lookup tables over the 512 possible tank masks
+FIRST_LINE = tuple(_first_line(tanks) for tanks in range(FULL_MASK + 1))
+TANK_COUNT = tuple(bin(tanks).count('1') for tanks in range(FULL_MASK + 1))
+FREE_CELLS = tuple(tuple(i for i in range(BOARD_CELLS) if not tanks & (1 << i))
+                   for tanks in range(FULL_MASK + 1))
+
+
+class BoardState:
+    """ Compact board used by the AI search
+    The cells are packed in ``cells``, the tanks of each player are kept as 9 bit masks and the
+    deployments are pushed on a preallocated stack, so making and unmaking a move only touches integers
+    """
+
+    geometry = CLASSIC
+
+    def __init__(self, board, p1_marker, p2_marker):
+        self.p1_marker = p1_marker
+        self.p2_marker = p2_marker
+        self.tank_codes = {p1_marker: P1_TANK_CODE, p2_marker: P2_TANK_CODE}
+        self.tanks = {p1_marker: 0, p2_marker: 0}
+        self.cells = 0
+        for pos, value in enumerate(board):
+            if value in self.tank_codes:
+                code = self.tank_codes[value]
+                self.tanks[value] |= 1 << pos
+            else:
+                code = value - PLAY_TILES[0]
+            self.cells |= code << (pos * CELL_BITS)
+        self.stack = [None] * (len(board) * (len(PLAY_TILES) + 1))
+        self.ply = 0
+
+    @classmethod
+    def from_game(cls, gameinstance):
+        """ Return the BoardState of a game, a LineBoardState on the battlefields other than tic tac toe
+        """
+        if not gameinstance.geometry.classic:
+            return LineBoardState(gameinstance.board, gameinstance.p1.marker, gameinstance.p2.marker,
+                                  gameinstance.geometry)
+        return cls(gameinstance.board, gameinstance.p1.marker, gameinstance.p2.marker)
+
+    def to_board(self):
+        """ Return the board as the list of battle tiles used by GAME
+        """
+        board = []
+        tank_markers = {P1_TANK_CODE: self.p1_marker, P2_TANK_CODE: self.p2_marker}
+        for pos in range(self.geometry.cells):
+            code = (self.cells >> (pos * CELL_BITS)) & CELL_MASK
+            board.append(tank_markers[code] if code in tank_markers else code + PLAY_TILES[0])
+        return board
+
+    def available_moves(self):
+        """ Returns the shared tuple of the cells without tanks
+        """
+        return FREE_CELLS[self.tanks[self.p1_marker] | self.tanks[self.p2_marker]]
+
+    def make_move(self, pos, marker):
+        """ Deploys a soldier or a tank
+        """
+        shift = pos * CELL_BITS
+        if (self.cells >> shift) & CELL_MASK < TANK_READY_CODE:
+            self.cells += 1 << shift
+        else:
+            self.cells += (self.tank_codes[marker] - TANK_READY_CODE) << shift
+            self.tanks[marker] |= 1 << pos
+        self.stack[self.ply] = marker
+        self.ply += 1
+
+    def unmake_move(self, pos):
+        """ Reverts the last move made, which was deployed on ``pos``
+        """
+        self.ply -= 1
+        marker = self.stack[self.ply]
+        shift = pos * CELL_BITS
+        code = (self.cells >> shift) & CELL_MASK
+        if code > TANK_READY_CODE:
+            self.cells -= (code - TANK_READY_CODE) << shift
+            self.tanks[marker] &= ~(1 << pos)
+        else:
+            self.cells -= 1 << shift
+
+    def winner(self):
+        """ Return the marker of the winner or None while the battle goes on,
+        with the same rules as ``GAME.is_gameover``
+        """
+        p1_tanks = self.tanks[self.p1_marker]
+        p2_tanks = self.tanks[self.p2_marker]
+        p1_line = FIRST_LINE[p1_tanks]
+        p2_line = FIRST_LINE[p2_tanks]
+        if p1_line != NO_LINE or p2_line != NO_LINE:
+            return self.p1_marker if p1_line < p2_line else self.p2_marker
+        if p1_tanks | p2_tanks == FULL_MASK:
+            # the classic battlefield has an odd number of cells, so the tank count never ties
+            if TANK_COUNT[p1_tanks] > TANK_COUNT[p2_tanks]:
+                return self.p1_marker
+            return self.p2_marker
+        return None
+
+
+class LineBoardState(BoardState):
+    """ BoardState of the larger battlefields, where the tank masks are too many for lookup tables
+    Like GAME, the complete winning positions of each player are kept as a bitmask of their indexes, updated
+    when a tank is deployed or taken back, so ``winner`` does not look at every winning position
+    """
+
+    def __init__(self, board, p1_marker, p2_marker, geometry):
+        self.geometry = geometry
+        BoardState.__init__(self, board, p1_marker, p2_marker)
+        self.won_lines = {}
+        for marker, tanks in self.tanks.items():
+            self.won_lines[marker] = sum(1 << line for line, mask in enumerate(geometry.win_masks)
+                                         if tanks & mask == mask)
+
+    def available_moves(self):
+        """ Returns the tuple of the cells without tanks
+        """
+        taken = self.tanks[self.p1_marker] | self.tanks[self.p2_marker]
+        return tuple(pos for pos in range(self.geometry.cells) if not taken >> pos & 1)
+
+    def make_move(self, pos, marker):
+        """ Deploys a soldier or a tank
+        """
+        shift = pos * CELL_BITS
+        if (self.cells >> shift) & CELL_MASK < TANK_READY_CODE:
+            self.cells += 1 << shift
+        else:
+            self.cells += (self.tank_codes[marker] - TANK_READY_CODE) << shift
+            tanks = self.tanks[marker] = self.tanks[marker] | 1 << pos
+            win_masks = self.geometry.win_masks
+            for line in self.geometry.cell_lines[pos]:
+                if tanks & win_masks[line] == win_masks[line]:
+                    self.won_lines[marker] |= 1 << line
+        self.stack[self.ply] = marker
+        self.ply += 1
+
+    def unmake_move(self, pos):
+        """ Reverts the last move made, which was deployed on ``pos``
+        """
+        self.ply -= 1
+        marker = self.stack[self.ply]
+        shift = pos * CELL_BITS
+        code = (self.cells >> shift) & CELL_MASK
+        if code > TANK_READY_CODE:
+            self.cells -= (code - TANK_READY_CODE) << shift
+            self.tanks[marker] &= ~(1 << pos)
+            for line in self.geometry.cell_lines[pos]:
+                self.won_lines[marker] &= ~(1 << line)
+        else:
+            self.cells -= 1 << shift
+
+    def winner(self):
+        """ Return the marker of the winner or None while the battle goes on,
+        with the same rules as ``GAME.is_gameover``
+        """
+        p1_lines = self.won_lines[self.p1_marker]
+        p2_lines = self.won_lines[self.p2_marker]
+        if p1_lines or p2_lines:
+            lines = p1_lines | p2_lines
+            return self.p1_marker if p1_lines & (lines & -lines) else self.p2_marker
+        p1_tanks = self.tanks[self.p1_marker]
+        p2_tanks = self.tanks[self.p2_marker]
+        if p1_tanks | p2_tanks == self.geometry.full_mask:
+            # the tie of the even battlefields goes to p2, the player who moved second, see BoardGeometry
+            if bin(p1_tanks).count('1') > bin(p2_tanks).count('1'):
+                return self.p1_marker
+            return self.p2_marker
+        return None
@@ -0,0 +1,137 @@
+import time
+
+from tictank_db import DATABASE_NAME, get_connection
+from tictank_metrics import METRICS
+
+# Number of seconds a stats response is served again without querying the database
+STATS_CACHE_TTL = 1.0
+# Stats responses kept at most, the cache is emptied when it is full
+STATS_CACHE_SIZE = 256
+# Orders of the leaderboard: key of the bot stats sorted on, ties are broken by the number of wins
+LEADERBOARD_ORDERS = ('win_rate', 'wins', 'games', 'avg_moves', 'tank_ratio')
+# Bots in a leaderboard by default
+DEFAULT_LEADERBOARD_SIZE = 10
+
+STATS_COLUMNS = "SUM(games), SUM(wins), SUM(soldiers), SUM(tanks), SUM(pot_moves), SUM(moves), SUM(game_moves)"
+
+# (query name, params): (time the response was built, response)
+_cache = {}
+
+
+def bot_stats(games, wins, soldiers, tanks, pot_moves, moves, game_moves):
+    """ Return the totals of bot_stats rows and the averages derived from them
+    """
+    games = games or 0
+    return {'games': games,
+            'wins': wins or 0,
+            'losses': games - (wins or 0),
+            'win_rate': float(wins) / games if games else 0.0,
+            'soldiers': soldiers or 0,
+            'tanks': tanks or 0,
+            'tank_ratio': float(tanks) / (soldiers + tanks) if games and soldiers + tanks else 0.0,
+            'pot_moves': pot_moves or 0,
+            'avg_moves': float(moves) / games if games else 0.0,
+            'avg_game_moves': float(game_moves) / games if games else 0.0}
+
+
+def summary(values, all_bots):
+    """ Return the stats of summed bot_stats rows, for all the bots every battle is in the rows of its two bots
+    so the number of battles is the number of wins, the averages stay the ones of a bot in a battle
+    """
+    stats = bot_stats(*values)
+    if all_bots:
+        stats['games'] = stats.pop('wins')
+        del stats['losses'], stats['win_rate']
+    return stats
+
+
+def day_range(since, until):
+    """ Return the SQL condition and params on the day column of bot_stats, days are YYYY-MM-DD strings
+    """
+    conditions = []
+    params = []
+    if since is not None:
+        conditions.append("day >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("day <= ?")
+        params.append(until)
+    return " AND ".join(conditions) or "1", params
+
+
+def cached(query, params, build):
+    """ Return the response of ``build`` for these params, built again every STATS_CACHE_TTL seconds at most
+    """
+    key = (query, params)
+    entry = _cache.get(key)
+    now = time.time()
+    if entry is not None and now - entry[0] < STATS_CACHE_TTL:
+        return entry[1]
+    response = build()
+    if METRICS.enabled:
+        METRICS.observe('tictank_db_query_seconds', time.time() - now, query=query)
+    if len(_cache) >= STATS_CACHE_SIZE:
+        _cache.clear()
+    _cache[key] = (now, response)
+    return response
+
+
+def get_leaderboard(order='win_rate', limit=DEFAULT_LEADERBOARD_SIZE, since=None, until=None, team=None,
+                    db_file=DATABASE_NAME):
+    """ Return the bots with the best stats, read from the bot_stats summary table
+        :param order: one of LEADERBOARD_ORDERS
+        :param limit: maximum number of bots
+        :param since: optional first day of the battles, YYYY-MM-DD
+        :param until: optional last day of the battles
+        :param team: optional team of the bots, 0 or 1
+        :return: list of the stats of the bots with their id, name, team and iq
+    """
+    def build():
+        condition, params = day_range(since, until)
+        if team is not None:
+            condition += " AND team = ?"
+            params.append(team)
+        rows = get_connection(db_file).execute(
+            "SELECT bot_id, name, team, iq, {} FROM bot_stats JOIN ai_bots ON ai_bots.id = bot_stats.bot_id "
+            "WHERE {} GROUP BY bot_id".format(STATS_COLUMNS, condition), params).fetchall()
+        leaderboard = []
+        for row in rows:
+            stats = bot_stats(*row[4:])
+            stats.update(id=row[0], name=row[1], team=row[2], iq=row[3])
+            leaderboard.append(stats)
+        leaderboard.sort(key=lambda stats: (stats[order], stats['wins']), reverse=True)
+        return leaderboard[:limit]
+
+    return cached('leaderboard', (order, limit, since, until, team), build)
+
+
+def get_stats(bot_id=None, since=None, until=None, db_file=DATABASE_NAME):
+    """ Return the stats of a bot, or of all the battles without ``bot_id``, read from the bot_stats table
+        :param bot_id: optional bot id
+        :param since: optional first day of the battles, YYYY-MM-DD
+        :param until: optional last day of the battles
+        :return: dict of the totals and averages with the stats of every day, None if there is no such bot
+    """
+    def build():
+        connection = get_connection(db_file)
+        condition, params = day_range(since, until)
+        if bot_id is not None:
+            bot = connection.execute("SELECT name, team, iq FROM ai_bots WHERE id = ?", (bot_id,)).fetchone()
+            if bot is None:
+                return None
+            condition += " AND bot_id = ?"
+            params.append(bot_id)
+        rows = connection.execute("SELECT day, {} FROM bot_stats WHERE {} GROUP BY day ORDER BY day".format(
+            STATS_COLUMNS, condition), params).fetchall()
+        days = []
+        totals = [0] * 7
+        for row in rows:
+            days.append(dict(summary(row[1:], bot_id is None), day=row[0]))
+            totals = [total + (value or 0) for total, value in zip(totals, row[1:])]
+        stats = summary(totals, bot_id is None)
+        if bot_id is not None:
+            stats.update(id=bot_id, name=bot[0], team=bot[1], iq=bot[2])
+        stats['days'] = days
+        return stats
+
+    return cached('stats', (bot_id, since, until), build)
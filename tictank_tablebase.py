@@ -0,0 +1,330 @@
+#!/usr/bin/python
+import argparse
+import logging
+import mmap
+import re
+import struct
+import sys
+import time
+
+from array import array
+from itertools import permutations
+
+from tictank_game_logic import MAX_MOVES, PLAY_TILES, STARTING_BOARDS
+from tictank_state import BOARD_CELLS, CELL_BITS, CELL_MASK, FIRST_LINE, FULL_MASK, NO_LINE, TANK_COUNT, \
+    TANK_READY_CODE
+
+TABLEBASE_NAME = "tic_tank.tb"
+
+# The positions are stored from the point of view of the player to move: the battle tiles -1..4 are
+# 0..5 like in BoardState, the tanks of the player to move are 6 and the opponent's tanks are 7.
+# A troop deployment always adds one to its cell, a stack of 4 soldiers becomes a tank of the player.
+MY_TANK = TANK_READY_CODE + 1
+THEIR_TANK = TANK_READY_CODE + 2
+
+# The key of a position is its canonical packed board and number of moves left in the turn. The builder
+# solves them in a table with one byte for every key, 256 MiB, but only a few percent of the keys are
+# positions reachable from the starting boards. The file holds a bitmap with one bit for every key, set for the
+# solved positions, the number of solved positions before every block of the bitmap and the entries of the
+# solved positions in key order: the entry of a key is found with one block of the bitmap and its rank.
+BOARD_BITS = BOARD_CELLS * CELL_BITS
+TABLE_SIZE = MAX_MOVES << BOARD_BITS
+HEADER = b'TTTB\x03\x00\x00\x00'
+COUNT_FORMAT = struct.Struct('<I')
+# Keys of a block of the bitmap, read as 4 words of 64 bits
+BLOCK_SHIFT = 8
+BLOCK_FORMAT = struct.Struct('<4Q')
+RANK_FORMAT = struct.Struct('<I')
+BITMAP_SIZE = TABLE_SIZE >> 3
+BLOCKS = TABLE_SIZE >> BLOCK_SHIFT
+
+# Entry values: the high bit is set when the player to move wins, the low bits hold the number of
+# troop deployments left until the battle is over with perfect play
+WIN_FLAG = 0x80
+PLIES_MASK = 0x7f
+UNKNOWN = 0xff
+
+# The 8 rotations and reflections of the 3x3 battlefield, the position values hold the destination cell
+SYMMETRIES = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8),
+    (2, 5, 8, 1, 4, 7, 0, 3, 6),
+    (8, 7, 6, 5, 4, 3, 2, 1, 0),
+    (6, 3, 0, 7, 4, 1, 8, 5, 2),
+    (2, 1, 0, 5, 4, 3, 8, 7, 6),
+    (6, 7, 8, 3, 4, 5, 0, 1, 2),
+    (0, 3, 6, 1, 4, 7, 2, 5, 8),
+    (8, 5, 2, 7, 4, 1, 6, 3, 0),
+)
+ROW_CELLS = 3
+ROW_BITS = ROW_CELLS * CELL_BITS
+ROW_MASK = (1 << ROW_BITS) - 1
+
+
+def _row_tables(symmetry, swap_tanks):
+    """ Lookup tables moving the three cells of every row to their place in the symmetric board
+    """
+    tables = []
+    for row in range(BOARD_CELLS // ROW_CELLS):
+        table = []
+        for chunk in range(ROW_MASK + 1):
+            moved = 0
+            for i in range(ROW_CELLS):
+                code = (chunk >> (i * CELL_BITS)) & CELL_MASK
+                if swap_tanks and code >= MY_TANK:
+                    code = MY_TANK + THEIR_TANK - code
+                moved |= code << (symmetry[row * ROW_CELLS + i] * CELL_BITS)
+            table.append(moved)
+        tables.append(tuple(table))
+    return tuple(tables)
+
+
+def _tank_table(tank_code):
+    table = []
+    for chunk in range(ROW_MASK + 1):
+        mask = 0
+        for i in range(ROW_CELLS):
+            if (chunk >> (i * CELL_BITS)) & CELL_MASK == tank_code:
+                mask |= 1 << i
+        table.append(mask)
+    return tuple(table)
+
+
+SAME_SIDE_TABLES = tuple(_row_tables(symmetry, False) for symmetry in SYMMETRIES)
+OTHER_SIDE_TABLES = tuple(_row_tables(symmetry, True) for symmetry in SYMMETRIES)
+MY_TANKS = _tank_table(MY_TANK)
+THEIR_TANKS = _tank_table(THEIR_TANK)
+
+
+def canonical(cells, tables=SAME_SIDE_TABLES):
+    """ Return the smallest packed board among the symmetric ones
+        :param cells: packed board
+        :param tables: SAME_SIDE_TABLES or OTHER_SIDE_TABLES to also hand the move to the opponent
+    """
+    low, mid, high = cells & ROW_MASK, (cells >> ROW_BITS) & ROW_MASK, cells >> (2 * ROW_BITS)
+    return min(t0[low] | t1[mid] | t2[high] for t0, t1, t2 in tables)
+
+
+def tank_masks(cells):
+    """ Return the tank masks of the player to move and of the opponent
+    """
+    low, mid, high = cells & ROW_MASK, (cells >> ROW_BITS) & ROW_MASK, cells >> (2 * ROW_BITS)
+    return (MY_TANKS[low] | MY_TANKS[mid] << ROW_CELLS | MY_TANKS[high] << (2 * ROW_CELLS),
+            THEIR_TANKS[low] | THEIR_TANKS[mid] << ROW_CELLS | THEIR_TANKS[high] << (2 * ROW_CELLS))
+
+
+def swap_sides(cells):
+    """ Return the packed board seen by the opponent
+    """
+    return canonical(cells, OTHER_SIDE_TABLES[:1])
+
+
+def terminal_value(cells):
+    """ Return the table entry of a finished battle or None while the battle goes on
+    """
+    mine, theirs = tank_masks(cells)
+    if FIRST_LINE[mine] != NO_LINE:
+        return WIN_FLAG
+    if FIRST_LINE[theirs] != NO_LINE:
+        return 0
+    if mine | theirs == FULL_MASK:
+        # the battlefield has an odd number of cells, so the tank count never ties
+        return WIN_FLAG if TANK_COUNT[mine] > TANK_COUNT[theirs] else 0
+    return None
+
+
+def encode_board(board, marker, opponentmarker):
+    """ Pack a GAME board from the point of view of the player with the ``marker`` tanks
+    """
+    cells = 0
+    for pos, value in enumerate(board):
+        if value == marker:
+            code = MY_TANK
+        elif value == opponentmarker:
+            code = THEIR_TANK
+        else:
+            code = value - PLAY_TILES[0]
+        cells |= code << (pos * CELL_BITS)
+    return cells
+
+
+def child_entry(entry, same_side):
+    """ Return a child entry seen from the player who moved into it
+    """
+    if same_side:
+        return entry
+    return entry ^ WIN_FLAG
+
+
+def best_entry(child_entries):
+    """ Combine the entries of the children, seen by the player to move, into the entry of the position
+    Winning players take the fastest win, losing players hold out as long as possible
+    """
+    wins = [entry & PLIES_MASK for entry in child_entries if entry & WIN_FLAG]
+    if wins:
+        return WIN_FLAG | (min(wins) + 1)
+    return max(child_entries) + 1
+
+
+class TablebaseBuilder:
+    """ Retrograde solver filling the table for every position reachable from the starting boards
+    Troop deployments only ever raise the cells, so the positions form a DAG that is solved children first
+    """
+
+    def __init__(self):
+        self.table = bytearray([UNKNOWN]) * TABLE_SIZE
+        self.positions = 0
+
+    def solve(self, cells, moves_left):
+        index = canonical(cells) | ((moves_left - 1) << BOARD_BITS)
+        entry = self.table[index]
+        if entry != UNKNOWN:
+            return entry
+        entry = terminal_value(cells)
+        if entry is None:
+            child_entries = []
+            for pos in range(BOARD_CELLS):
+                shift = pos * CELL_BITS
+                if (cells >> shift) & CELL_MASK >= MY_TANK:
+                    continue
+                child = cells + (1 << shift)
+                if moves_left > 1:
+                    child_entries.append(self.solve(child, moves_left - 1))
+                else:
+                    child_entries.append(child_entry(self.solve(swap_sides(child), MAX_MOVES), False))
+            entry = best_entry(child_entries)
+        self.table[index] = entry
+        self.positions += 1
+        return entry
+
+    def build(self):
+        """ Solve all the shuffles of the starting boards with a full turn for the first player
+        """
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * BOARD_CELLS * len(PLAY_TILES)))
+        for board_id, starting_board in sorted(STARTING_BOARDS.items()):
+            started = time.time()
+            for board in set(permutations(starting_board)):
+                self.solve(encode_board(board, None, None), MAX_MOVES)
+            logging.info("Starting board {} solved in {:.1f}s, {} positions in the table".format(
+                board_id, time.time() - started, self.positions))
+
+    def save(self, path):
+        """ Write the bitmap of the solved positions and the ranks of its blocks, then their entries in key order
+        """
+        bitmap = bytearray(BITMAP_SIZE)
+        ranks = array('I', [0]) * BLOCKS
+        for match in re.finditer(b'[^\xff]', self.table):
+            key = match.start()
+            bitmap[key >> 3] |= 1 << (key & 7)
+            ranks[key >> BLOCK_SHIFT] += 1
+        # the rank of a block is the number of solved positions in the blocks before it
+        count = 0
+        for block, positions in enumerate(ranks):
+            ranks[block] = count
+            count += positions
+        if sys.byteorder == 'big':
+            ranks.byteswap()
+        with open(path, 'wb') as table_file:
+            table_file.write(HEADER)
+            table_file.write(COUNT_FORMAT.pack(count))
+            table_file.write(bitmap)
+            ranks.tofile(table_file)
+            table_file.write(self.table.translate(None, b'\xff'))
+
+
+class Tablebase:
+    """ Read only, memory mapped solved positions
+    The pages are shared by all the processes that map the file, so forked workers do not copy the table.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as table_file:
+            self.table = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.bitmap = len(HEADER) + COUNT_FORMAT.size
+        self.ranks = self.bitmap + BITMAP_SIZE
+        self.entries = self.ranks + BLOCKS * RANK_FORMAT.size
+        if self.table[:len(HEADER)] != HEADER or len(self.table) < self.entries or \
+                len(self.table) != self.entries + COUNT_FORMAT.unpack_from(self.table, len(HEADER))[0]:
+            raise ValueError("{} is not a Tic Tank Toe tablebase".format(path))
+
+    def find(self, key):
+        """ Return the entry of a position key, UNKNOWN when the position is not in the table
+        """
+        block = key >> BLOCK_SHIFT
+        words = BLOCK_FORMAT.unpack_from(self.table, self.bitmap + block * BLOCK_FORMAT.size)
+        word, bit = (key >> 6) & 3, key & 63
+        if not words[word] >> bit & 1:
+            return UNKNOWN
+        # the rank of the key is the number of solved positions before it
+        rank = RANK_FORMAT.unpack_from(self.table, self.ranks + block * RANK_FORMAT.size)[0]
+        for before in words[:word]:
+            rank += bin(before).count('1')
+        rank += bin(words[word] & ((1 << bit) - 1)).count('1')
+        return ord(self.table[self.entries + rank:self.entries + rank + 1])
+
+    def entry(self, cells, moves_left, same_side=True):
+        """ Return the table entry of a packed board, seen from the player to move unless ``same_side``
+        is False, in which case the move is handed to the opponent first
+        """
+        if same_side:
+            index = canonical(cells)
+        else:
+            index = canonical(cells, OTHER_SIDE_TABLES)
+        return self.find(index | ((moves_left - 1) << BOARD_BITS))
+
+    def best_move(self, board, marker, opponentmarker, moves_left):
+        """ Return the perfect play deployment for the player with the ``marker`` tanks
+            :param board: GAME board
+            :param moves_left: troop deployments left in the player's turn
+        """
+        cells = encode_board(board, marker, opponentmarker)
+        moves = []
+        entries = []
+        for pos in range(BOARD_CELLS):
+            shift = pos * CELL_BITS
+            if (cells >> shift) & CELL_MASK >= MY_TANK:
+                continue
+            child = cells + (1 << shift)
+            if moves_left > 1:
+                entry = self.entry(child, moves_left - 1)
+            else:
+                entry = child_entry(self.entry(child, MAX_MOVES, same_side=False), False)
+            if entry == UNKNOWN:
+                raise KeyError("Position missing from the tablebase")
+            moves.append(pos)
+            entries.append(entry)
+        if not moves:
+            return None
+        target = best_entry(entries) - 1
+        return moves[entries.index(target)]
+
+    def close(self):
+        self.table.close()
+
+
+# Tablebase of the process, loaded once by the server before the workers start
+TABLEBASE = None
+
+
+def load_tablebase(path=TABLEBASE_NAME):
+    """ Map the tablebase file for the perfect play bots of this process
+    """
+    global TABLEBASE
+    TABLEBASE = Tablebase(path)
+    logging.debug("Tablebase {} loaded".format(path))
+    return TABLEBASE
+
+
+def get_tablebase():
+    return TABLEBASE
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Solve every Tic Tank Toe position and save the tablebase")
+    parser.add_argument("--output", default=TABLEBASE_NAME)
+    args = parser.parse_args()
+
+    builder = TablebaseBuilder()
+    builder.build()
+    builder.save(args.output)
+    logging.info("Tablebase written to {}".format(args.output))
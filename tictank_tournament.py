@@ -0,0 +1,249 @@
+#!/usr/bin/python
+import argparse
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import tictank_game_logic
+from tictank_ai_logic import get_ai_players
+from tictank_db import DATABASE_NAME, DATA_DIR, create_tables, get_all_bots, get_connection
+
+TOURNAMENT_TABLES = os.path.join(DATA_DIR, "create_tournament_tables.sql")
+
+# Games played by every Soviet-German pairing when not provided
+DEFAULT_TOURNAMENT_GAMES = 1000
+# Games of a pairing played by a worker process in one go, a finished batch is never played again
+TOURNAMENT_CHUNK = 100
+
+# Elo rating of the bots at the start of a tournament
+INITIAL_RATING = 1500.0
+# Maximum rating change after a single game
+ELO_K_FACTOR = 16
+# Rating difference at which the stronger bot is expected to win 10 games out of 11
+ELO_SCALE = 400.0
+
+
+def play_match(p1_id, p2_id, games, seed=None):
+    """ Play ``games`` games in the current process between the bots with the given ids
+        :param p1_id: Soviet bot id
+        :param p2_id: German bot id
+        :param seed: optional seed to replay the same games
+        :return: list with 1 for every game won by ``p1_id`` and 0 for every game it lost
+    """
+    # the games of the batch draw from a generator of their own, the random module of the worker is left alone
+    rng, seed = tictank_game_logic.game_random(seed)
+    results = []
+    for _ in range(games):
+        player1, player2 = get_ai_players(p1_id=p1_id, p2_id=p2_id, rng=rng)
+        game_results = tictank_game_logic.play_game(player1, player2, seed=seed, rng=rng)
+        results.append(int(game_results['winner'] == player1.name))
+    return results
+
+
+def expected_score(rating, opponent_rating):
+    """ Return the expected score, between 0 and 1, of a bot against its opponent
+    """
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / ELO_SCALE))
+
+
+def update_ratings(ratings, winner_id, loser_id, k_factor=ELO_K_FACTOR):
+    """ Update the ``ratings`` dict after a game
+    """
+    change = k_factor * (1 - expected_score(ratings[winner_id], ratings[loser_id]))
+    ratings[winner_id] += change
+    ratings[loser_id] -= change
+
+
+class Tournament:
+    """ Round-robin tournament between every Soviet and every German bot
+    Every pairing plays ``games_per_pairing`` games, split in batches of TOURNAMENT_CHUNK games that run
+    in a pool of worker processes. The Elo ratings are updated game by game in the order of the pairings and
+    batches, whatever the order the workers finish them, so a seeded tournament ends with the same ratings.
+    Every batch is saved with the new standings in a single transaction, so an interrupted tournament
+    resumes by only playing the batches missing from the tournament_match table.
+    """
+
+    def __init__(self, tournament_id, games_per_pairing, seed=None, finished=False, db_file=DATABASE_NAME):
+        self.id = tournament_id
+        self.games_per_pairing = games_per_pairing
+        self.seed = seed
+        self.finished = finished
+        self.db_file = db_file
+        self.ratings = {}
+        self.teams = {}
+        for bot_id, team, rating in self.connection.execute(
+                "SELECT bot_id, team, rating FROM tournament_standings "
+                "JOIN ai_bots ON ai_bots.id = tournament_standings.bot_id "
+                "WHERE tournament_id = ?", (self.id,)):
+            self.ratings[bot_id] = rating
+            self.teams[bot_id] = team
+
+    @property
+    def connection(self):
+        return get_connection(self.db_file)
+
+    @classmethod
+    def create(cls, games_per_pairing=DEFAULT_TOURNAMENT_GAMES, seed=None, db_file=DATABASE_NAME):
+        """ Start a new tournament between all the bots of the database
+        """
+        connection = get_connection(db_file)
+        create_tables(connection, TOURNAMENT_TABLES)
+        bots = get_all_bots(db_file)
+        teams = set(team for _, _, team, _ in bots)
+        if teams != {0, 1}:
+            raise ValueError("Error: No bots found in the database for both teams")
+        with connection:
+            cursor = connection.execute("INSERT INTO tournament (games_per_pairing, seed) VALUES (?, ?)",
+                                        (games_per_pairing, seed))
+            tournament_id = cursor.lastrowid
+            connection.executemany("INSERT INTO tournament_standings (tournament_id, bot_id, rating) "
+                                   "VALUES (?, ?, ?)",
+                                   [(tournament_id, bot_id, INITIAL_RATING) for bot_id, _, _, _ in bots])
+        return cls(tournament_id, games_per_pairing, seed, db_file=db_file)
+
+    @classmethod
+    def load(cls, tournament_id=None, unfinished=False, db_file=DATABASE_NAME):
+        """ Load a tournament, the latest one when ``tournament_id`` is not provided
+            :param unfinished: only look for the tournaments that were interrupted
+            :return: Tournament instance or None if there is no such tournament
+        """
+        query = "SELECT id, games_per_pairing, seed, finished FROM tournament WHERE 1"
+        params = []
+        if tournament_id is not None:
+            query += " AND id = ?"
+            params.append(tournament_id)
+        if unfinished:
+            query += " AND NOT finished"
+        row = get_connection(db_file).execute(query + " ORDER BY id DESC LIMIT 1", params).fetchone()
+        if row is None:
+            return None
+        return cls(row[0], row[1], row[2], bool(row[3]), db_file=db_file)
+
+    def pairings(self):
+        soviets = sorted(bot_id for bot_id, team in self.teams.items() if team == 0)
+        germans = sorted(bot_id for bot_id, team in self.teams.items() if team == 1)
+        return [(p1_id, p2_id) for p1_id in soviets for p2_id in germans]
+
+    def pending_matches(self):
+        """ Return the batches of games not played yet
+            :return: list of (p1_id, p2_id, first_game, games, seed) tuples
+        """
+        played = set(self.connection.execute("SELECT p1_id, p2_id, first_game FROM tournament_match "
+                                             "WHERE tournament_id = ?", (self.id,)))
+        matches = []
+        for p1_id, p2_id in self.pairings():
+            for first_game in range(0, self.games_per_pairing, TOURNAMENT_CHUNK):
+                if (p1_id, p2_id, first_game) in played:
+                    continue
+                games = min(TOURNAMENT_CHUNK, self.games_per_pairing - first_game)
+                # every batch has its own seed, so a resumed tournament plays the same games
+                seed = None if self.seed is None else hash((self.seed, p1_id, p2_id, first_game)) & 0xffffffff
+                matches.append((p1_id, p2_id, first_game, games, seed))
+        return matches
+
+    def record(self, p1_id, p2_id, first_game, results):
+        """ Update the ratings with the results of a batch of games and save them
+            :param results: list returned by play_match
+        """
+        for p1_won in results:
+            if p1_won:
+                update_ratings(self.ratings, p1_id, p2_id)
+            else:
+                update_ratings(self.ratings, p2_id, p1_id)
+        games = len(results)
+        p1_wins = sum(results)
+        with self.connection as connection:
+            connection.execute("INSERT INTO tournament_match (tournament_id, p1_id, p2_id, first_game, games, "
+                               "p1_wins) VALUES (?, ?, ?, ?, ?, ?)",
+                               (self.id, p1_id, p2_id, first_game, games, p1_wins))
+            connection.executemany("UPDATE tournament_standings SET rating = ?, games = games + ?, "
+                                   "wins = wins + ? WHERE tournament_id = ? AND bot_id = ?",
+                                   [(self.ratings[p1_id], games, p1_wins, self.id, p1_id),
+                                    (self.ratings[p2_id], games, games - p1_wins, self.id, p2_id)])
+
+    def run(self, workers=None):
+        """ Play the games left in the tournament
+            :param workers: number of worker processes, defaults to the number of cores
+        """
+        matches = self.pending_matches()
+        total = len(self.pairings()) * self.games_per_pairing
+        played = total - sum(match[3] for match in matches)
+        logging.info("Tournament {}: {} of {} games left to play".format(self.id, total - played, total))
+        started = time.time()
+        executor = ProcessPoolExecutor(max_workers=workers or cpu_count())
+        futures = []
+        try:
+            for p1_id, p2_id, first_game, games, seed in matches:
+                futures.append((executor.submit(play_match, p1_id, p2_id, games, seed), p1_id, p2_id, first_game))
+            # the batches finished early wait for the ones before them, the Elo updates depend on their order
+            for future, p1_id, p2_id, first_game in futures:
+                results = future.result()
+                self.record(p1_id, p2_id, first_game, results)
+                played += len(results)
+                logging.info("Tournament {}: {}/{} games played in {:.1f}s".format(
+                    self.id, played, total, time.time() - started))
+        finally:
+            # an interrupted tournament does not wait for the batches that did not start
+            for future, _, _, _ in futures:
+                future.cancel()
+            executor.shutdown()
+        with self.connection as connection:
+            connection.execute("UPDATE tournament SET finished = 1 WHERE id = ?", (self.id,))
+        self.finished = True
+
+    def standings(self):
+        """ Return the bots sorted by rating
+        """
+        standings = []
+        for bot_id, name, team, rating, games, wins in self.connection.execute(
+                "SELECT bot_id, name, team, rating, games, wins FROM tournament_standings "
+                "JOIN ai_bots ON ai_bots.id = tournament_standings.bot_id "
+                "WHERE tournament_id = ? ORDER BY rating DESC", (self.id,)):
+            standings.append({'id': bot_id,
+                              'name': name,
+                              'team': 'soviet_ai' if team == 0 else 'german_ai',
+                              'rating': round(rating, 1),
+                              'games': games,
+                              'wins': wins,
+                              'losses': games - wins})
+        return standings
+
+    def status(self):
+        """ Return the /tournament response
+        """
+        played = self.connection.execute("SELECT COALESCE(SUM(games), 0) FROM tournament_match "
+                                         "WHERE tournament_id = ?", (self.id,)).fetchone()[0]
+        return {'id': self.id,
+                'finished': self.finished,
+                'games_per_pairing': self.games_per_pairing,
+                'seed': self.seed,
+                'games_played': played,
+                'games_total': len(self.pairings()) * self.games_per_pairing,
+                'standings': self.standings(),
+                }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Play a round-robin tournament between the Soviet and German bots")
+    parser.add_argument("--games", type=int, default=DEFAULT_TOURNAMENT_GAMES, help="games per pairing")
+    parser.add_argument("--workers", type=int, default=None, help="defaults to the number of cores")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--resume", type=int, nargs='?', const=0, default=None,
+                        help="resume the tournament with this id, or the latest interrupted one")
+    args = parser.parse_args()
+
+    if args.resume is not None:
+        tournament = Tournament.load(args.resume or None, unfinished=True)
+        if tournament is None:
+            sys.exit("Error: No interrupted tournament found")
+    else:
+        tournament = Tournament.create(args.games, args.seed)
+    tournament.run(args.workers)
+    for position, bot in enumerate(tournament.standings(), 1):
+        print("{:2}. {:30} {:7.1f} {:6} wins {:6} losses".format(position, bot['name'], bot['rating'],
+                                                                bot['wins'], bot['losses']))